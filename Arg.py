@@ -20,16 +20,17 @@ import tensorflow as tf
 # set_gpu_per_process_memory_fraction(0.5)
 
 # tf1 显存管理
-config = tf.ConfigProto()
-config.gpu_options.allow_growth = True
-sess = tf.Session(config=config)
+# NOTE: the session is created in `Args._session_processing`, after the input
+# args are processed, e.g. XGPU may split the host into logical CPU devices.
 
+from tensorflow.python.keras import backend as K
 from tensorflow.python.keras.callbacks import TensorBoard
 from tensorflow.python.keras.preprocessing.image import ImageDataGenerator
 
 from hat.utils import *
 from hat.datasets import *
 from hat.models import *
+from hat.tools import *
 
 
 class Args(object):
@@ -42,6 +43,9 @@ class Args(object):
     self._warning_list = []
     self._log_list = []
     self._dir_list = []
+    self._session_list = ['INTRA_THREADS', 'INTER_THREADS', 'CPU_AFFINITY', 'NUMA_NODE',
+                          'LAYOUT_OPT', 'REMAP_OPT', 'CONSTFOLD_OPT']
+    self._sessionc = {}
     # envs args
     self.IS_TRAIN = True
     self.IS_VAL = True
@@ -49,9 +53,36 @@ class Args(object):
     self.IS_GIMAGE = True
     self.IS_FLOPS = True
     self.IS_ENHANCE = False
+    self.IS_TUNE = False
+    self.IS_TUNE_THREADS = False
+    self.IS_PREDICT = False
+    self.IS_EXPORT = False
+    self.IS_QUANTIZE = False
+    self.IS_INSTRUMENT = False
+    self.IS_VAL_ASYNC = False
+    self.XLA_MODE = False
+    self.IS_RECOMPUTE = False
+    self.EXRGB_K = 0
+    self.PREDICT_DIR = ''
+    self.TOP_K = 5
+    self.DECODE_WORKERS = 8
+    self.TEACHER = ''
+    self.KD_T = 4
+    self.KD_ALPHA = 0.5
+    self.KD_EPOCHS = 1
     self.XGPU_MODE = False
     self.XGPU_NUM = 0
     self.XGPU_NMAX = 4
+    self.XWORKER_NUM = 0
+    self.LSGD_NUM = 0
+    self.LSGD_SYNC = 16
+    self.INTRA_THREADS = 0
+    self.INTER_THREADS = 0
+    self.CPU_AFFINITY = ''
+    self.NUMA_NODE = ''
+    self.LAYOUT_OPT = ''
+    self.REMAP_OPT = ''
+    self.CONSTFOLD_OPT = ''
     self.DATASETS_NAME = ''
     self.DATASET = None
     self.MODELS_NAME = ''
@@ -67,13 +98,32 @@ class Args(object):
     self.LIB_NAME = ''
     self.ADDITION = ''
     self.LR_ALT = False
+    self.MEM_LIMIT = 0
+    self.ES_PATIENCE = 0
+    self.LR_PATIENCE = 0
+    self.MONITOR = 'val_accuracy'
+    self.MIN_DELTA = 0.
+    self.LR_FACTOR = 0.1
+    self.MIN_LR = 0.
+    self.WARMUP_EPOCHS = 0
+    self.BASE_BATCH = 256
+    self.VAL_EVERY = 1
+    self.VAL_SUB = 0
+    self.TUNE_STEPS = 5
+    self.TUNE_MIN = 8
+    self.TUNE_MAX = 4096
     # build
     self.IN_ARGS = input('=>').split(' ')
     self._Log = None
     self._config = None
+    # NOTE: an option conflicts if its value is not the default any more
+    self._defaults = dict(self.__dict__)
     self.user()
     self._input_processing()
-    self._envs_processing()
+    self._IN_BATCH_SIZE = self.BATCH_SIZE
+    self._profiler = Profiler()
+    with self._profiler.span('envs_processing'):
+      self._envs_processing()
     # built
 
   # private method
@@ -82,16 +132,21 @@ class Args(object):
     self._Log(args, _T=text, _A='Error')
     os._exit(1)
 
-  def _check_args(self, item, lists, args_name, data='', force_str=False):
+  def _check_args(self, item, lists, args_name, data='', force_str=False, to_float=False):
     '''check'''
     if item not in lists:
       return False
-    elif self.__dict__[args_name]:
+    elif self.__dict__[args_name] != self._defaults.get(args_name):
       self._error(args_name, 'More than one:')
     else:
-      if type(data) == str and data.isdigit() and not force_str:
+      if type(data) == str and to_float:
+        try:
+          data = float(data)
+        except ValueError:
+          self._error(data, f'{args_name} must be a number, got:')
+      elif type(data) == str and data.isdigit() and not force_str:
         data = int(data)
-      self.__dict__[args_name] = data or item
+      self.__dict__[args_name] = item if data == '' else data
       return True
 
   def _get_args(self, dicts, cover=False):
@@ -109,19 +164,23 @@ class Args(object):
     if not self._config.if_param():
       for di in self._paramc:
         self._config.param(di)
+    if self._sessionc:
+      self._config.set_dict('session', self._sessionc)
     for di in self._specialc:
       self._config.param(di)
     for di in self._logc:
       self._config.log(di)
 
   def _special_config(self):
-    self._GLOBAL_EPOCH = self._config.get('param', 'global_epoch')
-    if self._GLOBAL_EPOCH:
-      self._GLOBAL_EPOCH = int(self._GLOBAL_EPOCH)
+    self._GLOBAL_EPOCH = int(self._config.get('param', 'global_epoch') or 0)
+    if self.IS_TRAIN:
       self._GLOBAL_EPOCH += self.EPOCHS
-    else:
-      self._GLOBAL_EPOCH = self.EPOCHS
     self._specialc.append({'GLOBAL_EPOCH': self._GLOBAL_EPOCH})
+    # tuned batch size (don't cover the input batch size)
+    _tune_batch_size = self._config.get('param', 'tune_batch_size')
+    if _tune_batch_size and not self._IN_BATCH_SIZE and self.RUN_MODE != 'tune-batch':
+      self.BATCH_SIZE = int(_tune_batch_size)
+      self._Log(self.BATCH_SIZE, _T='Using tuned batch size:')
     self._logc.append({'EPOCHS': self.EPOCHS, 'BATCH_SIZE': self.BATCH_SIZE})
 
   def _input_processing(self):
@@ -141,7 +200,36 @@ class Args(object):
           [['mode','runmode'      ], 'RUN_MODE'],
           [['-L' , 'lib'          ], 'MODEL_LIB'],
           [['-X',  'xgpu'         ], 'XGPU_NUM'],
+          [['-W',  'xworker'      ], 'XWORKER_NUM'],
           [['-A', 'add','addition'], 'ADDITION', 'force_str'],
+          [['mem', 'memory'       ], 'MEM_LIMIT'],
+          [['es' , 'early-stop'   ], 'ES_PATIENCE'],
+          [['rop', 'lr-plateau'   ], 'LR_PATIENCE'],
+          [['mon', 'monitor'      ], 'MONITOR', 'force_str'],
+          [['md' , 'min-delta'    ], 'MIN_DELTA', 'to_float'],
+          [['lrf', 'lr-factor'    ], 'LR_FACTOR', 'to_float'],
+          [['mlr', 'min-lr'       ], 'MIN_LR', 'to_float'],
+          [['ve' , 'val-every'    ], 'VAL_EVERY'],
+          [['vs' , 'val-sub'      ], 'VAL_SUB'],
+          [['lsgd','local-sgd'    ], 'LSGD_NUM'],
+          [['lss', 'lsgd-sync'    ], 'LSGD_SYNC'],
+          [['wu' , 'warmup'       ], 'WARMUP_EPOCHS'],
+          [['bb' , 'base-batch'   ], 'BASE_BATCH'],
+          [['intra','intra-threads'], 'INTRA_THREADS'],
+          [['inter','inter-threads'], 'INTER_THREADS'],
+          [['cpus', 'affinity'    ], 'CPU_AFFINITY', 'force_str'],
+          [['numa', 'numa-node'   ], 'NUMA_NODE', 'force_str'],
+          [['layout'              ], 'LAYOUT_OPT'],
+          [['remap', 'remapping'  ], 'REMAP_OPT'],
+          [['constfold'           ], 'CONSTFOLD_OPT'],
+          [['exrgb', 'extend-rgb' ], 'EXRGB_K'],
+          [['pred', 'predict-dir' ], 'PREDICT_DIR', 'force_str'],
+          [['topk', 'top-k'       ], 'TOP_K'],
+          [['dw'  , 'decode-workers'], 'DECODE_WORKERS'],
+          [['teacher', 'distill'  ], 'TEACHER', 'force_str'],
+          [['kdt' , 'kd-temperature'], 'KD_T', 'to_float'],
+          [['kda' , 'kd-alpha'    ], 'KD_ALPHA', 'to_float'],
+          [['kde' , 'kd-epochs'   ], 'KD_EPOCHS'],
         ]
         _check_box = [
           self._check_args(
@@ -149,7 +237,8 @@ class Args(object):
             j[0],
             j[1],
             temp[1],
-            force_str=True if 'force_str' in j else False)
+            force_str=True if 'force_str' in j else False,
+            to_float=True if 'to_float' in j else False)
           for j in _check_list]
         if not any(_check_box):
           self._warning_list.append(f'Unsupported option: {temp[0]}')
@@ -164,6 +253,11 @@ class Args(object):
           [['-X' , 'xgpu'        ], 'XGPU_MODE' , True],
           [['-L' , 'lr-alt'      ], 'LR_ALT'    , True],
           [['-NF', 'no-flops'    ], 'IS_FLOPS'  , False],
+          [['-I' , 'instrument'  ], 'IS_INSTRUMENT', True],
+          [['-VA', 'val-async'   ], 'IS_VAL_ASYNC', True],
+          [['-J' , 'xla'         ], 'XLA_MODE'  , True],
+          [['-RC', 'recompute'   ], 'IS_RECOMPUTE', True],
+          [['-EX', 'export'      ], 'IS_EXPORT' , True],
         ]
         _check_box = [self._check_args(i, *j) for j in _check_list]
         if not any(_check_box):
@@ -178,11 +272,24 @@ class Args(object):
     self.LIB_NAME = NLib(self.MODEL_LIB)
 
     # XGPU setting
-    if self.XGPU_NUM:
+    # NOTE: data-parallel via tf.distribute. Use GPUs if there are enough,
+    # otherwise split the host into XGPU_NUM logical CPU devices.
+    self._cpu_devices = 0
+    if self.XWORKER_NUM or is_worker():
+      # multi-worker, one replica per local process
+      self.XGPU_MODE = True
+      self.XGPU_NUM = 1
+    elif self.XGPU_NUM or self.XGPU_MODE:
       self.XGPU_MODE = True
-      if self.XGPU_NUM > self.XGPU_NMAX:
-        self._warning_list.append(f"Max NGPU {self.XGPU_NMAX}, but got {self.XGPU_NUM}. Use the Max NGPU.")
-        self.XGPU_NUM = self.XGPU_NMAX
+      self.XGPU_NUM = self.XGPU_NUM or self.XGPU_NMAX
+      _ngpu = num_gpus()
+      if _ngpu >= self.XGPU_NUM:
+        if self.XGPU_NUM > self.XGPU_NMAX:
+          self._warning_list.append(f"Max NGPU {self.XGPU_NMAX}, but got {self.XGPU_NUM}. Use the Max NGPU.")
+          self.XGPU_NUM = self.XGPU_NMAX
+      else:
+        self._cpu_devices = self.XGPU_NUM
+        self._log_list.append(f'{_ngpu} GPU(s), split the host into {self.XGPU_NUM} logical CPU devices.')
     else:
       self.XGPU_NUM = self.XGPU_NMAX
     self.XGPUINFO = {
@@ -221,11 +328,33 @@ class Args(object):
         break
     
     # Set Logger
-    self._Log = Log(log_dir=self.SAVE_DIR)
+    if worker_index():
+      self._Log = Log(log_dir=self.SAVE_DIR, log_name=f'worker{worker_index()}_{self.SAVE_TIME}')
+    else:
+      self._Log = Log(log_dir=self.SAVE_DIR)
     self._Log(self.SAVE_DIR, _T='Logs dir:')
     self._Log(self._warning_list, _A='Warning')
     self._Log(self._log_list)
-    self._timer = Timer(self._Log)
+    self._timer = Timer(self._Log, profiler=self._profiler)
+
+    # get configer
+    self._config = Config(f"{self.SAVE_DIR}/config")
+    # session setting (before any model is created)
+    self._session_processing()
+
+    # multi-worker setting
+    if self.XWORKER_NUM and not is_worker():
+      self._Log(self.XWORKER_NUM, _T='Launch local workers:')
+      in_args = [i for i in self.IN_ARGS if i.split('=')[0] not in ['-W', 'xworker']]
+      codes = [proc.wait() for proc in launch_workers(self.XWORKER_NUM, in_args)]
+      self._Log(codes, _T='Workers exit code:')
+      os._exit(max(codes))
+    if worker_index():
+      # NOTE: only the chief worker saves the h5 & writes the config
+      self.IS_SAVE = False
+      self.IS_GIMAGE = False
+      self.IS_FLOPS = False
+      self._Log(worker_index(), _T='Non-chief worker:')
 
     # get dataset object
     call_dataset = globals().get(self.DATASETS_NAME)
@@ -233,11 +362,33 @@ class Args(object):
       self._Log(self.DATASETS_NAME, _T='Loading Dataset:')
     else:
       self._error(self.DATASETS_NAME, 'Not in Datasets:')
-    self.DATASET = call_dataset()
+    with self._profiler.span('dataset_load', dataset=self.DATASETS_NAME):
+      self.DATASET = call_dataset()
+    # the h5 of an exrgb run expects 6k channels (don't cover the input exrgb)
+    _exrgb = self._config.get('param', 'exrgb_k')
+    if _exrgb and not self.EXRGB_K:
+      self.EXRGB_K = int(_exrgb)
+      if self.EXRGB_K:
+        self._Log(self.EXRGB_K, _T='Using the exrgb of the config:')
+    if self.EXRGB_K:
+      # ExtendRGB once per dataset, not once per step
+      with self._profiler.span('dataset_exrgb', k=self.EXRGB_K):
+        try:
+          extended = self.DATASET.extend_rgb(self.EXRGB_K)
+        except ValueError as e:
+          self._error(self.DATASETS_NAME, f'ExtendRGB: {e}')
+      if not extended:
+        self._Log('exrgb only extends the in-memory datasets, ignored.', _A='Warning')
+        self.EXRGB_K = 0
+    self._specialc.append({'EXRGB_K': self.EXRGB_K})
     _dataset = self.DATASET.ginfo()
     self._get_args(_dataset[0])
     self._paramc.append(_dataset[1])
     self._Log(self.DATASETS_NAME, _T='Loaded Dataset:')
+    if is_worker() and self.DATASET.train_x is not None:
+      # each worker trains on its own partition
+      self.DATASET.train_x = self.DATASET.train_x[worker_index()::num_workers()]
+      self.DATASET.train_y = self.DATASET.train_y[worker_index()::num_workers()]
 
     # get model object
     try:
@@ -245,10 +396,8 @@ class Args(object):
       self._Log(self.MODELS_NAME, _T='Loading Model:')
     except:
       self._error(self.MODELS_NAME, 'Not in Models:')
-    if self.XGPU_MODE:
-      self.MODEL = call_model(DATAINFO=self.DATAINFO, XGPUINFO=self.XGPUINFO)
-    else:
-      self.MODEL = call_model(DATAINFO=self.DATAINFO)
+    self._call_model = call_model
+    self.MODEL = self._new_model()
     _model = self.MODEL.ginfo()
     self._get_args(_model[0])
     self._paramc.extend(_model)
@@ -256,33 +405,12 @@ class Args(object):
     # load user args (don't cover)
     self._get_args(self.USER_DICT)
 
-    self.MODEL.build(self.LOAD_NAME)
-    
-    # compile model
-    if self.LOAD_NAME:
-      # NOTE: normally, h5 include compile.
-      # but in XGPU mode, h5 doesn't include compile
-      self._Log(self.LOAD_NAME, _T='Load h5:')
-    self.MODEL.compile(
-      optimizer=self.OPT,
-      loss=self.LOSS_MODE,
-      metrics=self.METRICS
-    )
+    self._model_processing()
+    if self.XLA_MODE:
+      self._xla_processing()
     self._Log(self.MODELS_NAME, _T='Loaded Model:')
     self._Log(self.LIB_NAME, _T='Model Lib:')
 
-    # get configer
-    self._config = Config(f"{self.SAVE_DIR}/config")
-    # processing config
-    self._special_config()
-    self._paramc.append({
-      'BATCH_SIZE': self.BATCH_SIZE,
-      'EPOCHS': self.EPOCHS,
-      'OPT': self.OPT,
-      'LOSS_MODE': self.LOSS_MODE,
-      'METRICS': self.METRICS,
-    })
-
     # mode envs
     if self.RUN_MODE == 'no-gimage':
       self.IS_GIMAGE = False
@@ -299,23 +427,92 @@ class Args(object):
       self.IS_TRAIN = False
       self.IS_SAVE = False
       self._Log('val only.')
+    elif self.RUN_MODE == 'tune-batch':
+      self.IS_TUNE = True
+      self.IS_TRAIN = False
+      self.IS_VAL = False
+      self.IS_SAVE = False
+      self._Log('tune batch size only.')
+    elif self.RUN_MODE == 'tune-threads':
+      self.IS_TUNE_THREADS = True
+      self.IS_TRAIN = False
+      self.IS_VAL = False
+      self.IS_SAVE = False
+      self._Log('tune session threads only.')
+    elif self.RUN_MODE == 'predict':
+      self.IS_PREDICT = True
+      self.IS_TRAIN = False
+      self.IS_VAL = False
+      self.IS_SAVE = False
+      self._Log('predict only.')
+    elif self.RUN_MODE == 'quantize':
+      self.IS_QUANTIZE = True
+      self.IS_TRAIN = False
+      self.IS_VAL = False
+      self.IS_SAVE = False
+      self._Log('quantize only.')
+
+    # processing config (after the mode envs, only the training counts the epochs)
+    self._special_config()
+    self._paramc.append({
+      'BATCH_SIZE': self.BATCH_SIZE,
+      'EPOCHS': self.EPOCHS,
+      'OPT': self.OPT,
+      'LOSS_MODE': self.LOSS_MODE,
+      'METRICS': self.METRICS,
+    })
 
     # log some mode info
     if self.RUN_MODE not in ['gimage']:
       self._Log(self.EPOCHS, _T='Epochs:')
       self._Log(self.BATCH_SIZE, _T='Batch size:')
       self._Log('', _L=['Model Optimizer exist.', f'Using Optimizer: {self.OPT}'], _B=self.OPT != None)
-      if self.RUN_MODE == 'val':
-        self._Log('', _L=['h5 exist.', 'h5 not exist, valing a fresh model.'], _B=self.LOAD_NAME)
+      if self.RUN_MODE in ['val', 'predict', 'quantize']:
+        self._Log('', _L=['h5 exist.', f'h5 not exist, {self.RUN_MODE} a fresh model.'], _B=self.LOAD_NAME)
       else:
         self._Log('', _L=['h5 exist.', 'h5 not exist, create one.'], _B=self.LOAD_NAME)
       
     if self.IS_ENHANCE:
       self._Log('Enhance data.')
     if self.XGPU_MODE:
-      self._Log('Muti-GPUs.')
+      if is_worker():
+        self._Log(f'{worker_index()}/{num_workers()}', _T='Multi-worker data-parallel, worker:')
+      else:
+        self._Log(self.XGPU_NUM, _T='Data-parallel, replicas:')
     if self.LR_ALT:
       self._Log('Learning Rate Alterable.')
+    if self.WARMUP_EPOCHS:
+      self._Log(f'{self.WARMUP_EPOCHS} epochs, lr * {self.BATCH_SIZE}/{self.BASE_BATCH}', _T='Linear warmup:')
+    if self.XLA_MODE:
+      self._Log('XLA JIT compiled train & predict.')
+    if self.IS_RECOMPUTE:
+      self._Log('Recompute the block activations in backward.')
+    if self.EXRGB_K:
+      self._Log(f'3 -> {6 * self.EXRGB_K} channels', _T='ExtendRGB dataset:')
+    if self.TEACHER:
+      self._Log(f'{self.TEACHER}, T {self.KD_T}, alpha {self.KD_ALPHA}, {self.KD_EPOCHS} cached epochs',
+                _T='Distill from teacher:')
+    if self.LSGD_NUM:
+      self._Log(f'{self.LSGD_NUM} trainers, average every {self.LSGD_SYNC} steps', _T='Local SGD:')
+      if self.XGPU_MODE or self.LR_ALT or self.IS_INSTRUMENT or self.IS_VAL_ASYNC \
+          or self.ES_PATIENCE or self.LR_PATIENCE:
+        self._Log('XGPU, lr-alt, instrument, val-async and the plateau options are ignored in Local SGD mode.', _A='Warning')
+    if self.IS_INSTRUMENT:
+      self._Log('Per-step instrumentation.')
+    if self.IS_VAL_ASYNC:
+      self._Log('Asynchronous validation.')
+    if self.VAL_EVERY > 1:
+      self._Log(self.VAL_EVERY, _T='Val every N epochs:')
+    if self.VAL_SUB:
+      self._Log(self.VAL_SUB, _T='Val subsample for intermediate epochs:')
+    if (self.ES_PATIENCE or self.LR_PATIENCE) and self.MONITOR not in ['val_accuracy', 'val_loss']:
+      self._error(self.MONITOR, 'Monitor must be val_accuracy or val_loss, got:')
+    if self.ES_PATIENCE:
+      self._Log(f'{self.ES_PATIENCE} epochs, min delta {self.MIN_DELTA}',
+                _T=f'Early stopping ({self.MONITOR}), patience:')
+    if self.LR_PATIENCE:
+      self._Log(f'{self.LR_PATIENCE} epochs, lr * {self.LR_FACTOR}, min lr {self.MIN_LR}',
+                _T=f'Reduce LR on plateau ({self.MONITOR}), patience:')
 
   def _fit(self, *args, **kwargs):
     
@@ -392,6 +589,198 @@ class Args(object):
       shuffle=True
     )
 
+  def _distill_data(self):
+    """
+      The teacher log-probs store (built once, reused by the later runs),
+      and the student train Sequence
+    """
+    aug = self.AUG if self.IS_ENHANCE else None
+    generator = None
+    if self.DATASET.train_x is None:
+      self.DATASET.get_generator(self.BATCH_SIZE)
+      generator = self.DATASET.trian_generator
+    name = os.path.splitext(os.path.basename(self.TEACHER))[0]
+    store = TeacherStore(os.path.join(self.SAVE_DIR, f'teacher_{name}'))
+    meta = {
+      'teacher': os.path.abspath(self.TEACHER),
+      'teacher_mtime': os.path.getmtime(self.TEACHER),
+      'dataset': self.DATASETS_NAME,
+      'batch_size': self.BATCH_SIZE if generator is not None else 0,
+      'epochs': self.KD_EPOCHS,
+      'aug': aug is not None,
+    }
+    if store.exists(**meta):
+      self._Log(store.path, _T='Teacher store:')
+    else:
+      def _build():
+        from tensorflow.python.keras.models import load_model
+        teacher = load_model(self.TEACHER, compile=False)
+        return store.build(
+          teacher,
+          x=self.DATASET.train_x,
+          generator=generator,
+          num=self.DATASET.NUM_TRAIN,
+          epochs=self.KD_EPOCHS,
+          aug=aug,
+          batch_size=self.BATCH_SIZE,
+          meta=meta,
+          Log=self._Log)
+      _, _ = self._timer.timer('teacher', _build)
+      self._logc.append(_)
+    return DistillSequence(
+      store,
+      x=self.DATASET.train_x,
+      y=self.DATASET.train_y,
+      generator=generator,
+      batch_size=self.BATCH_SIZE,
+      aug=aug)
+
+  def _evaluate(self, full=True):
+    """
+      Evaluate on the val set, or the fixed val subsample if not full.
+    """
+    if self.DATASET.val_x is None:
+      steps = None if full or not self.VAL_SUB else -(-self.VAL_SUB // self.BATCH_SIZE)
+      return self.MODEL.evaluate_generator(
+        self.DATASET.val_generator,
+        steps=steps)
+    index = None if full else val_subsample(len(self.DATASET.val_x), self.VAL_SUB)
+    if index is None:
+      return self.MODEL.evaluate(
+        self.DATASET.val_x,
+        self.DATASET.val_y,
+        batch_size=self.BATCH_SIZE)
+    return self.MODEL.evaluate(
+      self.DATASET.val_x[index],
+      self.DATASET.val_y[index],
+      batch_size=self.BATCH_SIZE)
+
+  def _new_model(self):
+    """
+      Create the model object
+    """
+    kwargs = {'DATAINFO': self.DATAINFO}
+    if self.XGPU_MODE:
+      kwargs['XGPUINFO'] = self.XGPUINFO
+    if self.IS_RECOMPUTE:
+      kwargs['use_recompute'] = True
+    model = self._call_model(**kwargs)
+    if self.IS_RECOMPUTE and not getattr(model, 'RECOMPUTE', False):
+      self.IS_RECOMPUTE = False
+      self._Log(f'{self.MODELS_NAME} has no `use_recompute` argument, ignored.', _T='Recompute:', _A='Warning')
+    return model
+
+  def _model_processing(self):
+    """
+      Build & compile the model
+    """
+    with self._profiler.span('model_build', model=self.MODELS_NAME):
+      self.MODEL.build(self.LOAD_NAME)
+    
+    # compile model
+    if self.LOAD_NAME:
+      # NOTE: normally, h5 include compile.
+      # but in XGPU mode, h5 doesn't include compile
+      self._Log(self.LOAD_NAME, _T='Load h5:')
+    with self._profiler.span('model_compile'):
+      if self.TEACHER:
+        # NOTE: the targets are [label, teacher log-probs], see `_distill_data`
+        self.MODEL.compile(
+          optimizer=self.OPT,
+          loss=kd_loss(float(self.KD_T), float(self.KD_ALPHA)),
+          metrics=[kd_accuracy]
+        )
+      else:
+        self.MODEL.compile(
+          optimizer=self.OPT,
+          loss=self.LOSS_MODE,
+          metrics=self.METRICS
+        )
+
+  def _xla_processing(self):
+    """
+      Check the model can be compiled by XLA, otherwise fall back to a
+      normal session and rebuild the model.
+    """
+    _reason = ''
+    _layers = unsupported_layers(self.MODEL.model)
+    if _layers:
+      _reason = f'unsupported layers {_layers}'
+    else:
+      with self._profiler.span('xla_probe'):
+        _reason = xla_probe(self.MODEL)
+    if not _reason:
+      return
+    self._Log(_reason, _T='XLA fallback:', _A='Warning')
+    self.XLA_MODE = False
+    K.clear_session()
+    self._session_processing()
+    # NOTE: a new model object, the optimizer of the model belongs to the old graph
+    self.MODEL = self._new_model()
+    if not isinstance(self.OPT, str):
+      self.OPT = self.MODEL.OPT
+    self._model_processing()
+
+  def _local_sgd(self):
+    """
+      Train with K local SGD trainer processes, the merged weights are set
+      back to the model, and saved as the normal h5 by `save()`.
+
+      NOTE: only the final merged model is validated, and the distillation
+      (`teacher=`) is not supported.
+    """
+    if self.TEACHER:
+      self._error(self.TEACHER, 'Local SGD does not support the distillation, teacher:')
+    try:
+      check_shard(self.DATASET)
+    except ValueError as e:
+      self._error(self.DATASETS_NAME, f'Local SGD: {e}')
+    trainer = LocalSGD(
+      self.MODEL,
+      {
+        'dataset': self.DATASETS_NAME,
+        'lib': self.MODEL_LIB,
+        'model': self.MODELS_NAME,
+        'opt': self.OPT if isinstance(self.OPT, str) else None,
+        'loss': self.LOSS_MODE,
+        'metrics': self.METRICS,
+        'batch_size': self.BATCH_SIZE,
+        'exrgb': self.EXRGB_K,
+      },
+      k=self.LSGD_NUM,
+      sync=self.LSGD_SYNC,
+      aug=self.AUG if self.IS_ENHANCE else None
+    )
+    steps = trainer.steps_per_epoch(self.DATASET)
+    self._Log(steps, _T='Local SGD steps per epoch:')
+    _history = []
+    names = ['loss'] + [m if isinstance(m, str) else m.__name__ for m in self.METRICS]
+    for epoch, logs in trainer.fit(self.EPOCHS, steps):
+      _history.append({f'epoch{epoch}_train_{name}': value for name, value in zip(names, logs)})
+      self._Log(', '.join(f'{name} {value}' for name, value in zip(names, logs)),
+                _T=f'Epoch: {epoch}/{self.EPOCHS} train (mean of trainers):')
+    return _history
+
+  def _plateau_processing(self, plateau, epochs):
+    """
+      Record the stop info, fix the GLOBAL_EPOCH & restore the best weights
+    """
+    if epochs < self.EPOCHS:
+      self._GLOBAL_EPOCH -= self.EPOCHS - epochs
+      for di in self._specialc:
+        if 'GLOBAL_EPOCH' in di:
+          di['GLOBAL_EPOCH'] = self._GLOBAL_EPOCH
+      self._Log(f'{self._GLOBAL_EPOCH}', _T='Global Epochs:')
+    self._logc.append({
+      'TRAINED_EPOCHS': epochs,
+      'STOP_EPOCH': plateau.stop_epoch,
+      'STOP_REASON': plateau.stop_reason or 'epochs',
+      'BEST_EPOCH': plateau.best_epoch,
+      f'BEST_{self.MONITOR}': plateau.best,
+    })
+    if plateau.best_epoch != epochs and plateau.restore(self.MODEL):
+      self._Log(plateau.best_epoch, _T='Restore the best weights, epoch:')
+
   def _lr_update(self, i):
     st_list = [0, 100, 150, 200]
     lr_list = [0.1, 0.03, 0.009, 0.0027]
@@ -416,8 +805,138 @@ class Args(object):
     else:
       return None
 
+  def _session_processing(self):
+    """
+      Create the tf session
+
+      The input args cover the `session` section of the config.
+    """
+    _session = self._config.get_dict('session')
+    for name in self._session_list:
+      if not self.__dict__[name] and _session.get(name.lower()):
+        value = _session[name.lower()]
+        self.__dict__[name] = int(value) if name.endswith('_THREADS') else value
+
+    cpus = parse_cpus(self.CPU_AFFINITY)
+    if self.NUMA_NODE:
+      cpus = cpus or numa_cpus(self.NUMA_NODE)
+      if not cpus:
+        self._Log(self.NUMA_NODE, _T='NUMA node not found:', _A='Warning')
+    if set_affinity(cpus):
+      self._Log(f'{cpus[0]}-{cpus[-1]}' if cpus == list(range(cpus[0], cpus[-1] + 1)) else cpus,
+                _T='Pin to cpus:')
+
+    try:
+      self._sess_config = session_config(
+        intra=self.INTRA_THREADS,
+        inter=self.INTER_THREADS,
+        layout=self.LAYOUT_OPT,
+        remap=self.REMAP_OPT,
+        constfold=self.CONSTFOLD_OPT
+      )
+    except ValueError as e:
+      self._error(str(e), 'Session config:')
+    if self._cpu_devices:
+      split_cpu(self._sess_config, self._cpu_devices)
+    if self.XLA_MODE:
+      set_jit(self._sess_config)
+    K.set_session(tf.Session(config=self._sess_config))
+    if self.INTRA_THREADS or self.INTER_THREADS:
+      self._Log(f'intra {self.INTRA_THREADS}, inter {self.INTER_THREADS}', _T='Session threads:')
+    self._sessionc = {name: self.__dict__[name] for name in self._session_list if self.__dict__[name]}
+
+  def _tune_data(self, batch_size):
+    """
+      Get a batch of train data for tuning batch size
+
+      Return None if the dataset has not enough samples.
+    """
+    if self.DATASET.train_x is None:
+      self.DATASET.get_generator(batch_size)
+      x, y = self.DATASET.trian_generator[0]
+    else:
+      x = self.DATASET.train_x[:batch_size]
+      y = self.DATASET.train_y[:batch_size]
+    if len(x) < batch_size:
+      return None
+    return x, y
+
   # public method
 
+  def tune(self):
+
+    if not self.IS_TUNE: return
+
+    import time
+    import tensorflow as tf
+
+    self._Log(f'{self.TUNE_MIN}~{self.TUNE_MAX}', _T='Tune batch size:')
+    if self.MEM_LIMIT:
+      self._Log(self.MEM_LIMIT, _T='Memory limit (MiB):')
+
+    _result = {}
+    _stop = ''
+    batch_size = self.TUNE_MIN
+    while batch_size <= self.TUNE_MAX:
+      data = self._tune_data(batch_size)
+      if data is None:
+        _stop = 'dataset'
+        break
+      try:
+        # warm up, the first step includes building the train function
+        self.MODEL.train_on_batch(*data)
+        start_time = time.perf_counter()
+        for _ in range(self.TUNE_STEPS):
+          self.MODEL.train_on_batch(*data)
+        cost_time = time.perf_counter() - start_time
+      except (tf.errors.ResourceExhaustedError, MemoryError):
+        _stop = 'OOM'
+        break
+      sps = batch_size * self.TUNE_STEPS / cost_time
+      mem = peak_rss()
+      self._Log(f'{batch_size}: {sps:.2f} samples/sec, peak RSS {mem:.0f} MiB', _T='Tune batch:')
+      self._logc.append({
+        f'TUNE_{batch_size}_SPS': sps,
+        f'TUNE_{batch_size}_RSS': mem,
+      })
+      if self.MEM_LIMIT and mem >= self.MEM_LIMIT:
+        _stop = 'memory limit'
+        break
+      _result[batch_size] = sps
+      del data
+      batch_size *= 2
+
+    if _stop:
+      self._Log(f'Stop at batch size {batch_size}, reason: {_stop}', _A='Warning')
+    if not _result:
+      self._error(self.TUNE_MIN, 'No batch size fits, got:')
+
+    best = max(_result, key=_result.get)
+    self._Log(f'{best} ({_result[best]:.2f} samples/sec)', _T='Best batch size:')
+    self._specialc.append({'TUNE_BATCH_SIZE': best})
+    self._logc.append({'TUNE_BATCH_SIZE': best, 'TUNE_STOP': _stop or 'max'})
+
+  def tune_threads(self):
+
+    if not self.IS_TUNE_THREADS: return
+
+    # NOTE: each setting runs in a new process
+    best, result = benchmark_threads(
+      self.MODELS_NAME,
+      lib=self.MODEL_LIB,
+      DATAINFO=self.DATAINFO,
+      batch_size=self.BATCH_SIZE,
+      steps=self.TUNE_STEPS,
+      optimizer=self.OPT if isinstance(self.OPT, str) else 'sgd',
+      loss=self.LOSS_MODE,
+      Log=self._Log,
+      layout=self.LAYOUT_OPT,
+      remap=self.REMAP_OPT,
+      constfold=self.CONSTFOLD_OPT
+    )
+    self._logc.append({f'TUNE_THREADS_{intra}_{inter}_SPS': v for (intra, inter), v in result.items()})
+    self._sessionc.update({'INTRA_THREADS': best[0], 'INTER_THREADS': best[1]})
+
   def train(self):
     
     if not self.IS_TRAIN: return
@@ -425,6 +944,8 @@ class Args(object):
     self._Log(f'{self._GLOBAL_EPOCH-self.EPOCHS}/{self._GLOBAL_EPOCH}', _T='Global Epochs:')
 
     def _fit(*args, **kwargs):
+      if self.LSGD_NUM:
+        return self._local_sgd()
       # NOTE: Windows Bug
       # a Windows-specific bug in TensorFlow.
       # The fix is to use the platform-appropriate path separators in log_dir
@@ -441,47 +962,153 @@ class Args(object):
         write_graph=False,
         write_images=True
       )
+      callbacks = [tensorboard_callback]
       _history=[]
       
       # Data
-      if self.DATASET.train_x is None:
+      if self.TEACHER:
+        train = self._distill_data()
+      elif self.DATASET.train_x is None:
         self.DATASET.get_generator(self.BATCH_SIZE, aug=self.AUG if self.IS_ENHANCE else None)
         train = self.DATASET.trian_generator
       elif self.IS_ENHANCE:
         train = self._datagen()
-      
-      for i in range(self.EPOCHS):
-        if self.LR_ALT:
-          lr_rt = self._lr_update(i)
-          if lr_rt:
-            self._Log(f"LR Update: {lr_rt}")
-
-        self._Log(f"Epoch: {i+1}/{self.EPOCHS} train")
-        if self.DATASET.train_x is None or self.IS_ENHANCE:
-          _train = self.MODEL.fit_generator(
-            train,
-            epochs=1,
-            callbacks=[tensorboard_callback]
-          )
-        else:
-          _train = self.MODEL.fit(
-            self.DATASET.train_x,
-            self.DATASET.train_y,
-            epochs=1,
-            batch_size=self.BATCH_SIZE,
-            callbacks=[tensorboard_callback]
-          )
-        self._Log(f"Epoch: {i+1}/{self.EPOCHS} val")
-        if self.DATASET.val_x is None:
-          _val = self.MODEL.evaluate_generator(
-            self.DATASET.val_generator)
+
+      # Early stopping & reduce LR on plateau
+      plateau = None
+      if self.ES_PATIENCE or self.LR_PATIENCE:
+        plateau = Plateau(
+          monitor=self.MONITOR,
+          patience=self.ES_PATIENCE,
+          lr_patience=self.LR_PATIENCE,
+          lr_factor=self.LR_FACTOR,
+          min_lr=self.MIN_LR,
+          min_delta=self.MIN_DELTA,
+          restore_best=bool(self.ES_PATIENCE)
+        )
+
+      # Asynchronous validation
+      validator = None
+      if self.IS_VAL_ASYNC:
+        validator = AsyncValidator(
+          self.DATASETS_NAME,
+          self.BATCH_SIZE,
+          self.SAVE_DIR,
+          subsample=self.VAL_SUB
+        )
+
+      def _merge(epoch, _val, full, weights=None, record_only=False):
+        """merge the val result, return True if stop"""
+        _pre = f'epoch{epoch}_val' if full else f'epoch{epoch}_val_sub'
+        _history.append(dict(zip([f'{_pre}_loss', f'{_pre}_accuracy'], _val)))
+        self._Log(f'loss {_val[0]}, accuracy {_val[1]}', _T=f'Epoch: {epoch} val{"" if full else " (subsample)"}:')
+        # NOTE: the subsample and the full val are not comparable, the
+        # plateau only sees the subsample results when `vs` is set
+        if plateau is None or record_only or full != (not self.VAL_SUB):
+          return False
+        action = plateau.update(epoch, {'val_loss': _val[0], 'val_accuracy': _val[1]}, self.MODEL, weights)
+        if action == 'reduce_lr':
+          self._Log(f"LR Update: {K.get_value(self.MODEL.parallel_model.optimizer.lr)}")
+        elif action == 'stop':
+          self._Log(f'Epoch {epoch}, {plateau.stop_reason}', _T='Early stopping:')
+          return True
+        return False
+
+      # Linear warmup (the trained epochs of the loaded h5 count)
+      if self.WARMUP_EPOCHS:
+        _trained = self._GLOBAL_EPOCH - self.EPOCHS
+        # NOTE: the lr of a h5 saved during the warmup is partly warmed, the
+        # unscaled lr of the first run is kept in the config
+        _base_lr = self._config.get('param', 'warmup_base_lr')
+        if _base_lr:
+          _base_lr = float(_base_lr)
         else:
-          _val = self.MODEL.evaluate(
-            self.DATASET.val_x,
-            self.DATASET.val_y,
-            batch_size=self.BATCH_SIZE)
-        _history.extend([{f"epoch{i+1}_train_{item}": _train.history[item][0] for item in _train.history},
-                        dict(zip([f'epoch{i+1}_val_loss', f'epoch{i+1}_val_accuracy'], _val))])
+          _base_lr = float(K.get_value(self.MODEL.parallel_model.optimizer.lr))
+        self._specialc.append({'WARMUP_BASE_LR': _base_lr})
+        if _trained < self.WARMUP_EPOCHS:
+          callbacks.append(LinearWarmup(
+            self.BATCH_SIZE,
+            warmup_epochs=self.WARMUP_EPOCHS,
+            base_batch_size=self.BASE_BATCH,
+            base_lr=_base_lr,
+            initial_epoch=_trained,
+            Log=self._Log
+          ))
+
+      # Instrumentation
+      if self.IS_INSTRUMENT:
+        step_timer = StepTimer(self.BATCH_SIZE, self._Log)
+        callbacks.append(step_timer)
+        if self.DATASET.train_x is None:
+          train = step_timer.wrap(train)
+      
+      _epochs = 0
+      _stop = False
+      try:
+        for i in range(self.EPOCHS):
+          _epochs = i + 1
+          self._profiler.begin('epoch', epoch=i+1)
+          if self.LR_ALT:
+            lr_rt = self._lr_update(i)
+            if lr_rt:
+              self._Log(f"LR Update: {lr_rt}")
+
+          self._Log(f"Epoch: {i+1}/{self.EPOCHS} train")
+          self._profiler.begin('fit')
+          if self.DATASET.train_x is None or self.IS_ENHANCE or self.TEACHER:
+            _train = self.MODEL.fit_generator(
+              train,
+              epochs=1,
+              callbacks=callbacks
+            )
+          else:
+            _train = self.MODEL.fit(
+              self.DATASET.train_x,
+              self.DATASET.train_y,
+              epochs=1,
+              batch_size=self.BATCH_SIZE,
+              callbacks=callbacks
+            )
+          self._profiler.end()
+          _history.append({f"epoch{i+1}_train_{item}": _train.history[item][0] for item in _train.history})
+          if self.IS_INSTRUMENT:
+            _history.append(step_timer.history[-1])
+
+          # val
+          _stop = False
+          _last = i + 1 == self.EPOCHS
+          _full = _last or not self.VAL_SUB
+          if (i + 1) % self.VAL_EVERY == 0 or _last:
+            self._Log(f"Epoch: {i+1}/{self.EPOCHS} val")
+            # the last epoch is also validated on the subsample for the plateau
+            _kinds = [_full, False] if _full and self.VAL_SUB and plateau is not None else [_full]
+            if validator is not None:
+              for full in _kinds:
+                validator.submit(i+1, self.MODEL, full=full)
+            else:
+              for full in _kinds:
+                self._profiler.begin('evaluate')
+                _val = self._evaluate(full=full)
+                self._profiler.end()
+                _stop = _merge(i+1, _val, full) or _stop
+          if validator is not None:
+            for epoch, _val, weights, full in validator.poll():
+              _stop = _merge(epoch, _val, full, weights) or _stop
+          self._profiler.end()
+          if _stop:
+            break
+
+        if validator is not None:
+          # NOTE: after an early stop, the late results are only recorded,
+          # the stop decision (and the best epoch) is already made
+          with self._profiler.span('wait_val'):
+            for epoch, _val, weights, full in validator.poll(wait=True):
+              _merge(epoch, _val, full, weights, record_only=_stop)
+      finally:
+        if validator is not None:
+          validator.close()
+      if plateau is not None:
+        self._plateau_processing(plateau, _epochs)
       return _history
 
     _, result = self._timer.timer('train', _fit)
@@ -513,14 +1140,86 @@ class Args(object):
   def test(self):
     return
 
+  def predict(self):
+    """
+      Top-k of the latest h5 over the image folder (`pred=`) or test_x
+    """
+    if not self.IS_PREDICT: return
+
+    if self.PREDICT_DIR:
+      source = list_images(self.PREDICT_DIR)
+      try:
+        decode = dataset_decoder(self.DATASET, self.EXRGB_K)
+      except ValueError as e:
+        self._Log(f'{e}', _T='Predict:', _A='Warning')
+        return
+      self._Log(f'{len(source)} images in {self.PREDICT_DIR}', _T='Predict:')
+    elif self.DATASET.test_x is not None:
+      source = self.DATASET.test_x
+      decode = None
+      self._Log(f'{len(source)} test_x', _T='Predict:')
+    else:
+      self._Log('No test_x, use pred=<image dir>.', _A='Warning')
+      return
+    filename = f'{self.SAVE_DIR}/predict_{self.SAVE_TIME - 1}'
+
+    def _predict():
+      return predict_topk(
+        self.MODEL,
+        source,
+        filename,
+        k=self.TOP_K,
+        batch_size=self.BATCH_SIZE,
+        decode=decode,
+        workers=self.DECODE_WORKERS,
+        Log=self._Log)
+
+    _, speed = self._timer.timer('predict', _predict)
+    self._Log(f'{filename}.npy, {filename}.csv', _T='Successfully write predictions:')
+    self._logc.append(_)
+    self._logc.append({'PREDICT_IMAGES_PER_SEC': speed})
+
+  def quantize(self):
+    """
+      TFLite float/dynamic/int8 of the latest h5, report on the val split
+    """
+    if not self.IS_QUANTIZE: return
+
+    if not self.LOAD_NAME:
+      self._Log('No h5 to quantize, train first.', _A='Warning')
+      return
+
+    def _quantize():
+      return quantize_report(
+        self.LOAD_NAME,
+        self.DATASET,
+        num_val=self.VAL_SUB or 1000,
+        Log=self._Log)
+
+    try:
+      _, table = self._timer.timer('quantize', _quantize)
+    except ValueError as e:
+      self._Log(f'{e}', _T='Quantize:', _A='Warning')
+      return
+    self._Log(table, _T='Quantize:')
+    self._logc.append(_)
+
   def save(self):
 
     if not self.IS_SAVE: return
 
-    self.MODEL.save(self.SAVE_NAME)
+    with self._profiler.span('save'):
+      self.MODEL.save(self.SAVE_NAME)
 
     self._Log(self.SAVE_NAME, _T='Successfully save model:')
 
+    if self.IS_EXPORT:
+      export_name = f'{self.H5_NAME}_{self.SAVE_TIME}_inference.h5'
+      with self._profiler.span('export'):
+        diff, before, after = export_inference(self.SAVE_NAME, export_name, Log=self._Log)
+      self._Log(export_name, _T='Successfully export inference model:')
+      self._logc.append({'EXPORT_MAX_DIFF': diff, 'EXPORT_MS_BEFORE': before, 'EXPORT_MS_AFTER': after})
+
   def gimage(self):
 
     img_name = f'{self.H5_NAME}_model.png'
@@ -566,19 +1265,39 @@ class Args(object):
       'METRICS': ['accuracy']
     }
 
+  def profile(self):
+    """
+      Log the span tree and export the Chrome trace-event JSON
+    """
+    trace_name = f'{self.SAVE_DIR}/trace_{self.SAVE_TIME}.json'
+    self._profiler.export(trace_name)
+    self._Log(self._profiler.summary(), _T='Profile:')
+    self._Log(trace_name, _T='Successfully write trace:')
+    self._logc.append({f'PROFILE_{k}': v for k, v in self._profiler.totals().items()})
+
   def run(self):
 
     self.gimage()
 
+    self.tune()
+
+    self.tune_threads()
+
     self.train()
 
     self.val()
 
     self.test()
 
+    self.predict()
+
+    self.quantize()
+
     self.save()
 
-    if self.RUN_MODE != 'gimage':
+    self.profile()
+
+    if self.RUN_MODE != 'gimage' and not worker_index():
       self._write_config()
     
 ARGS = Args()
@@ -20,15 +20,23 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import importlib as _importlib
 import os as _os
 import sys as _sys
 
-from hat import datasets
-from hat import models
-from hat import utils
+# NOTE: the subpackages are imported on the first access (`hat.models`),
+# `import hat.tools.npnet` does not import TensorFlow
+_SUBPACKAGES = ['datasets', 'models', 'utils', 'tools']
+
+
+def __getattr__(name):
+  if name in _SUBPACKAGES:
+    return _importlib.import_module(f'hat.{name}')
+  raise AttributeError(f"module 'hat' has no attribute '{name}'")
+
 
 _names_with_underscore = ['__version__', '__git_version__', '__compiler_version__', '__cxx11_abi_flag__', '__monolithic_build__']
-__all__ = [_s for _s in dir() if not _s.startswith('_')]
+__all__ = ['absolute_import', 'division', 'print_function'] + _SUBPACKAGES
 __all__.extend([_s for _s in _names_with_underscore])
 
 _hat_dir = _os.path.dirname(_os.path.abspath(__file__))
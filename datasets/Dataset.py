@@ -13,6 +13,11 @@ class Dataset(object):
 
     self.INPUT_SHAPE = ()
     self.NUM_CLASSES = 0
+    self.train_x = None
+    self.train_y = None
+    self.val_x = None
+    self.val_y = None
+    self.test_x = None
 
     self._list = ['mission', 'NUM_TRAIN', 'NUM_TEST', 'NUM_VAL', 'NUM_CLASSES', 'INPUT_SHAPE']
     self._dict = {}
@@ -57,6 +62,33 @@ class Dataset(object):
 
   def ginfo(self):
     return self._info_dict, self._dict
+
+  def extend_rgb(self, k, data_format=None):
+    """
+      ExtendRGB 预处理，只在加载数据集时计算一次
+
+      RGB (..., 3) -> (..., 6k), INPUT_SHAPE/DATAINFO 同时更新。
+
+      NOTE: 只处理内存数组，generator 数据集不变。
+      非 3 通道（如 mnist）抛出 ValueError。
+    """
+    from hat.models.advance.extendrgb import extend_rgb
+    if self.train_x is None:
+      return False
+    axis = 0 if data_format == 'channels_first' else -1
+    if self.INPUT_SHAPE[axis] != 3:
+      raise ValueError(f'ExtendRGB needs 3 channels (RGB), {type(self).__name__} has {self.INPUT_SHAPE[axis]}')
+    for name in ['train_x', 'val_x', 'test_x']:
+      if getattr(self, name) is not None:
+        setattr(self, name, extend_rgb(getattr(self, name), k, data_format))
+    input_shape = list(self.INPUT_SHAPE)
+    input_shape[axis] = 6 * k
+    self._built = True
+    self.INPUT_SHAPE = tuple(input_shape)
+    if self.mission == 'classfication':
+      self.DATAINFO = {'INPUT_SHAPE': self.INPUT_SHAPE, 'NUM_CLASSES': self.NUM_CLASSES}
+    self._built = False
+    return True
     
 if __name__ == "__main__":
   a = Dataset()
@@ -14,4 +14,5 @@ class cifar10(Dataset):
     self.NUM_CLASSES = 10
     self.INPUT_SHAPE = (32, 32, 3)
     (self.train_x, self.train_y), (self.val_x, self.val_y) = ds.cifar10.load_data()
-    self.train_x, self.val_x = self.train_x / 255.0, self.val_x / 255.0
+    self.RESCALE = 255.0
+    self.train_x, self.val_x = self.train_x / self.RESCALE, self.val_x / self.RESCALE
@@ -250,7 +250,7 @@ class imagenet(Dataset):
     return img
 
   def data_generator(self, mode: str, batch_size: int, aug: ImageDataGenerator=None, 
-          suffix='.gz'):
+          suffix='.gz', shard=None):
     """
       Data Generator
 
@@ -260,9 +260,12 @@ class imagenet(Dataset):
         aug: ImageDataGenerator[tensorflow.python.keras.preprocessing.image.ImageDataGenerator]. 
              Whether to use Data Argument.
         suffix: Str.
+        shard: Tuple of Int, (index, num). Only use the disjoint subset of pkls.
     """
     data_len = {'train': self.NUM_TRAIN, 'val': self.NUM_VAL}[mode]
-    return DG(os.path.join(self.DATA_DIR, 'pkl'), mode, batch_size, data_len, aug, suffix)
+    if shard:
+      data_len = data_len // shard[1]
+    return DG(os.path.join(self.DATA_DIR, 'pkl'), mode, batch_size, data_len, aug, suffix, shard)
 
   def load(self):
 
@@ -284,8 +287,8 @@ class imagenet(Dataset):
 
     return True
 
-  def get_generator(self, batch_size: int, aug=None):
-    self.trian_generator = self.data_generator('train', batch_size, aug)
+  def get_generator(self, batch_size: int, aug=None, shard=None):
+    self.trian_generator = self.data_generator('train', batch_size, aug, shard=shard)
     self.val_generator = self.data_generator('val', batch_size)
     return self.trian_generator, self.val_generator
 
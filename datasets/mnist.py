@@ -14,7 +14,8 @@ class mnist(Dataset):
     self.NUM_CLASSES = 10
     self.INPUT_SHAPE = (28, 28, 1)
     (self.train_x, self.train_y), (self.val_x, self.val_y) = ds.mnist.load_data()
-    self.train_x, self.val_x = self.train_x / 255.0, self.val_x / 255.0
+    self.RESCALE = 255.0
+    self.train_x, self.val_x = self.train_x / self.RESCALE, self.val_x / self.RESCALE
     self.train_x = self.train_x.reshape((self.NUM_TRAIN, *self.INPUT_SHAPE))
     self.val_x = self.val_x.reshape((self.NUM_TEST, *self.INPUT_SHAPE))
 
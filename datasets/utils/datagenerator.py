@@ -14,15 +14,21 @@ from tensorflow.python.keras.utils import Sequence
 class DG(Sequence):
   """
     Data Generator
+
+    Argu:
+      shard: Tuple of Int, (index, num). If something, only read the pkls
+        whose number % num == index, e.g. for the local SGD trainers.
+        `data_len` should be the length of the shard.
   """
   def __init__(self, path: str, mode: str, batch_size: int, data_len: int,
-        aug: ImageDataGenerator=None, suffix='.gz'):
+        aug: ImageDataGenerator=None, suffix='.gz', shard=None):
     self.path = path
     self.mode = mode
     self.batch_size = batch_size
     self.data_len = data_len
     self.aug = aug
     self.suffix = suffix
+    self.shard = shard
 
     self.x = []
     self.y = []
@@ -33,7 +39,10 @@ class DG(Sequence):
   
   def __getitem__(self, idx):
     
-    next_pkl = os.path.join(self.path, f'{self.mode}{self.inx}{self.suffix}')
+    pkl_inx = self.inx
+    if self.shard:
+      pkl_inx = self.inx * self.shard[1] + self.shard[0]
+    next_pkl = os.path.join(self.path, f'{self.mode}{pkl_inx}{self.suffix}')
 
     if len(self.x) < self.batch_size and not os.path.exists(next_pkl):
       batch_x = np.array(self.x)
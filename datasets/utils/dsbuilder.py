@@ -57,6 +57,7 @@ class DSBuilder(object):
     self.shuffle = shuffle
     self.pklen = pklen or self._cpklen(size)
     self.pklname = pklname
+    self.mode = None
 
     self.classes_dict = {}
 
@@ -100,7 +101,10 @@ class DSBuilder(object):
         fillx
         stretch
         crop
+
+      NOTE: mode 会记录在 self.mode，预测时用同样的 img_func(filename, mode)。
     """
+    self.mode = mode
     train, val, test = self.load()
     if any([train, val, test]):
       train_x, train_y = train
@@ -4,5 +4,12 @@
 
 
 from hat.models.network import *
+from hat.models.distribute import *
 from hat.models.advance import *
 from hat.models.utils import *
+from hat.models.callbacks import *
+from hat.models.validator import *
+from hat.models.localsgd import *
+from hat.models.session import *
+from hat.models.xla import *
+from hat.models.distill import *
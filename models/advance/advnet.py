@@ -106,6 +106,30 @@ class AdvNet(NetWork):
 
     return _func
 
+  def recompute(self, func, *args, **kwargs):
+    """
+      Return a python function, the block built by `func` is wrapped in a
+      sub-model, whose activations are recomputed in the backward pass
+      instead of stored (gradient checkpointing).
+
+      Usage:
+      ```python
+        x = self.recompute(self._bottle, 64, 256)(x)
+        x = self.repeat(self.recompute(self._bottle), 3, 64, 256)(x)
+      ```
+    """
+
+    def _func(x, *_args, **_kwargs):
+      if isinstance(x, (list, tuple)):
+        b_in = [Input(K.int_shape(i)[1:], name=f"RecomputeInput_{Counter('recompute_input')}") for i in x]
+      else:
+        b_in = Input(K.int_shape(x)[1:], name=f"RecomputeInput_{Counter('recompute_input')}")
+      b_out = func(b_in, *args, *_args, **kwargs, **_kwargs)
+      block = Model(inputs=b_in, outputs=b_out, name=f"RecomputeBlock_{Counter('recompute_block')}")
+      return Recompute(block, name=f"Recompute_{Counter('recompute')}")(x)
+
+    return _func
+
   def reshape(self, x, target_shape, **kwargs):
     """
       Reshape Layer
@@ -367,9 +391,12 @@ class AdvNet(NetWork):
            data_format=None, dilation_rate=(1, 1), activation=None, use_bias=True,
            kernel_initializer=KERNEL_INIT, bias_initializer='zeros',
            kernel_regularizer=None, bias_regularizer=None, activity_regularizer=None,
-           kernel_constraint=None, bias_constraint=None, split=True, rank=2, name='', **kwargs):
+           kernel_constraint=None, bias_constraint=None, split=True, fused=False, rank=2, name='', **kwargs):
     """
       Group Conv Layer
+
+      fused: all groups in one depthwise conv (rank 2), else one conv per group.
+        The depthwise intermediate is in_dim times the output, default False.
     """
     if type(kernel_size) == int:
       kernel_size = (kernel_size,) * 2
@@ -400,6 +427,7 @@ class AdvNet(NetWork):
       kernel_constraint=kernel_constraint,
       bias_constraint=bias_constraint,
       split=split,
+      fused=fused,
       rank=rank,
       name=name,
       **kwargs
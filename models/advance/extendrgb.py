@@ -1,10 +1,50 @@
 # pylint: disable=attribute-defined-outside-init
 
+import numpy as np
 from tensorflow.python.keras import backend as K
 from tensorflow.python.keras.layers import Layer
 from tensorflow.python.keras.utils import conv_utils
 
 
+def color_weight(k):
+  """
+    The fixed colour-mixing matrix of ExtendRGB, shape (3, 6k)
+  """
+  _weight = []
+  for i in range(3):
+    i_ = i + 1 if i + 1 <= 2 else 0
+    for j in range(k + 1):
+      _t = [0, 0, 0]
+      _t[i] = 1. / (1. + j / k)
+      _t[i_] = j / k / (1. + j / k)
+      _weight.append(_t)
+    for j in range(1, k):
+      _t = [0, 0, 0]
+      _t[i_] = 1. / (1. + (k - j) / k)
+      _t[i] = (k - j) / k / (1. + (k - j) / k)
+      _weight.append(_t)
+  return np.array(_weight, dtype='float32').T
+
+
+def extend_rgb(x, k, data_format=None, batch_size=1024):
+  """
+    ExtendRGB as a one-time numpy transform, e.g. of the dataset arrays.
+
+    Input:
+      (batch, ..., 3)
+
+    Output:
+      (batch, ..., k*6), float32
+  """
+  weight = color_weight(k)
+  axis = 1 if data_format == 'channels_first' else -1
+  outputs = []
+  for i in range(0, len(x), batch_size):
+    _x = np.moveaxis(np.asarray(x[i:i + batch_size], dtype='float32'), axis, -1)
+    outputs.append(np.moveaxis(_x @ weight, -1, axis))
+  return np.concatenate(outputs)
+
+
 class ExtendRGB(Layer):
   """
     Extend the RGB channels
@@ -20,6 +60,10 @@ class ExtendRGB(Layer):
     ```python
       x = ExtendRGB(4)(x) # got (batch, ..., 24)
     ```
+
+    NOTE: The weight is fixed, prefer extending the dataset once
+    (`Dataset.extend_rgb`, option `exrgb=k`), or fold the layer into the
+    next conv at export (`hat.tools.fold_extend_rgb`).
   """
 
   def __init__(self, k, data_format=None, dilation_rate=1, trainable=False, **kwargs):
@@ -27,7 +71,7 @@ class ExtendRGB(Layer):
     self.k = k
     self.data_format = data_format
     self.dilation_rate = conv_utils.normalize_tuple(dilation_rate, 2, 'dilation_rate')
-    if self.data_format == 'channels_First':
+    if self.data_format == 'channels_first':
       self.axis = 1
     else:
       self.axis = -1
@@ -38,7 +82,7 @@ class ExtendRGB(Layer):
     self.built = True
 
   def call(self, inputs, **kwargs):
-    assert inputs.shape[self.axis] != 3, f"Input Tensor must have 3 channels(RGB), but got {inputs.shape[self.axis]}"
+    assert inputs.shape[self.axis] == 3, f"Input Tensor must have 3 channels(RGB), but got {inputs.shape[self.axis]}"
     x = self._convolution_op(
       inputs, 
       self.kernel, 
@@ -49,23 +93,7 @@ class ExtendRGB(Layer):
     return x
 
   def _color_weight(self):
-    _weight = []
-    for i in range(3):
-      i_ = i + 1 if i + 1 <= 2 else 0
-      for j in range(self.k + 1):
-        _t = [0, 0, 0]
-        _t[i] = 1. / (1. + j / self.k)
-        _t[i_] = j / self.k / (1. + j / self.k)
-        _weight.append(_t)
-      for j in range(1, self.k):
-        _t = [0, 0, 0]
-        _t[i_] = 1. / (1. + (self.k - j) / self.k)
-        _t[i] = (self.k - j) / self.k / (1. + (self.k - j) / self.k)
-        _weight.append(_t)
-    _weight = K.variable(_weight)
-    _weight = K.transpose(_weight)
-    _weight = K.reshape(_weight, (1, 1, 3, 6 * self.k))
-    return _weight
+    return K.constant(np.reshape(color_weight(self.k), (1, 1, 3, 6 * self.k)))
 
   def compute_output_shape(self, input_shape):
     input_shape[self.axis] = 6 * self.k
@@ -74,6 +102,8 @@ class ExtendRGB(Layer):
   def get_config(self):
     config = {
       'k': self.k,
+      'data_format': self.data_format,
+      'dilation_rate': self.dilation_rate,
     }
     base_config = super(ExtendRGB, self).get_config()
     return dict(list(base_config.items()) + list(config.items()))
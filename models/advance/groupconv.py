@@ -9,7 +9,7 @@ from tensorflow.python.keras import (activations, constraints, initializers,
 from tensorflow.python.keras.layers import (Conv1D, InputSpec, Layer,
                                             SeparableConv1D)
 from tensorflow.python.keras.utils import conv_utils
-from tensorflow.python.ops import array_ops, nn, nn_ops
+from tensorflow.python.ops import array_ops, math_ops, nn, nn_ops
 
 
 class GroupConv(Layer):
@@ -62,7 +62,19 @@ class GroupConv(Layer):
           bias after being updated by an `Optimizer`.
       trainable: Boolean, if `True` also add variables to the graph collection
         `GraphKeys.TRAINABLE_VARIABLES` (see `tf.Variable`).
+      split: Boolean, if `True` each group convolves its own slice of the
+        input channels, else each group convolves all of them.
+      fused: Boolean, if `True` (rank 2 only) the groups run as one
+        depthwise convolution, else one convolution per group. The depthwise
+        intermediate has `groups * in_dim * filters` channels, `in_dim` times
+        the output, so it is only worth it for small `in_dim`.(default False)
       name: A string, the name of the layer.
+
+    Weights:
+      All groups are packed into one kernel `(*kernel_size, in_dim, groups * filters)`
+      and one bias `(groups * filters,)`, the group `i` is `[..., i * filters:(i + 1) * filters]`.
+      The h5 saved with the per-group weights (`kernel_0..kernel_G-1`) can
+      be converted by `convert_h5`.
   """
 
   def __init__(self, groups, filters, kernel_size, strides=1, padding='valid',
@@ -71,7 +83,7 @@ class GroupConv(Layer):
                bias_initializer='zeros', kernel_regularizer=None,
                bias_regularizer=None, activity_regularizer=None,
                kernel_constraint=None, bias_constraint=None,
-               trainable=True, rank=2, split=True, name=None, **kwargs):
+               trainable=True, rank=2, split=True, fused=False, name=None, **kwargs):
     super(GroupConv, self).__init__(
         trainable=trainable,
         name=name,
@@ -79,6 +91,7 @@ class GroupConv(Layer):
         **kwargs)
     self.rank = rank
     self.split = split
+    self.fused = fused
     self.groups = groups
     self.filters = filters
     self.kernel_size = conv_utils.normalize_tuple(
@@ -119,30 +132,25 @@ class GroupConv(Layer):
       raise ValueError('The channel dimension of the inputs '
                        'should be defined. Found `None`.')
     input_dim = int(input_shape[channel_axis])
-    kernel_shape = self.kernel_size + (input_dim, self.filters)
-
-    self.kernel = []
-    for i in range(self.groups):
-      self.kernel.append(self.add_weight(
-          name=f'kernel_{i}',
-          shape=kernel_shape,
-          initializer=self.kernel_initializer,
-          regularizer=self.kernel_regularizer,
-          constraint=self.kernel_constraint,
-          trainable=True,
-          dtype=self.dtype))
-    
+    kernel_shape = self.kernel_size + (input_dim, self.groups * self.filters)
+
+    self.kernel = self.add_weight(
+        name='kernel',
+        shape=kernel_shape,
+        initializer=self.kernel_initializer,
+        regularizer=self.kernel_regularizer,
+        constraint=self.kernel_constraint,
+        trainable=True,
+        dtype=self.dtype)
     if self.use_bias:
-      self.bias = []
-      for i in range(self.groups):
-        self.bias.append(self.add_weight(
-            name=f'bias_{i}',
-            shape=(self.filters,),
-            initializer=self.bias_initializer,
-            regularizer=self.bias_regularizer,
-            constraint=self.bias_constraint,
-            trainable=True,
-            dtype=self.dtype))
+      self.bias = self.add_weight(
+          name='bias',
+          shape=(self.groups * self.filters,),
+          initializer=self.bias_initializer,
+          regularizer=self.bias_regularizer,
+          constraint=self.bias_constraint,
+          trainable=True,
+          dtype=self.dtype)
     else:
       self.bias = None
     self.input_spec = InputSpec(ndim=self.rank + 2,
@@ -151,9 +159,12 @@ class GroupConv(Layer):
       op_padding = 'valid'
     else:
       op_padding = self.padding
+    # NOTE: without split, all groups convolve the whole input, the same
+    # as one conv with the packed kernel
+    filter_shape = self.kernel_size + (input_dim, self.filters if self.split else self.groups * self.filters)
     self._convolution_op = nn_ops.Convolution(
         input_shape,
-        filter_shape=self.kernel[0].get_shape(),
+        filter_shape=tensor_shape.TensorShape(filter_shape),
         dilation_rate=self.dilation_rate,
         strides=self.strides,
         padding=op_padding.upper(),
@@ -161,6 +172,46 @@ class GroupConv(Layer):
                                                    self.rank + 2))
     self.built = True
 
+  def _grouped_conv2d(self, inputs):
+    """
+      All groups in one depthwise conv
+
+      The packed kernel (kh, kw, Ci, G*F) is rearranged to the depthwise
+      kernel (kh, kw, G*Ci, F), so each input channel is convolved by the
+      F filters of its group, then the Ci channels of each group are summed.
+    """
+    kh, kw, ci, _ = self.kernel.get_shape().as_list()
+    kernel = array_ops.reshape(self.kernel, [kh, kw, ci, self.groups, self.filters])
+    kernel = array_ops.transpose(kernel, [0, 1, 3, 2, 4])
+    kernel = array_ops.reshape(kernel, [kh, kw, self.groups * ci, self.filters])
+    _data_format = conv_utils.convert_data_format(self.data_format, 4)
+    if self.data_format == 'channels_first':
+      strides = (1, 1) + self.strides
+    else:
+      strides = (1,) + self.strides + (1,)
+    outputs = nn.depthwise_conv2d(
+        inputs,
+        kernel,
+        strides=strides,
+        padding=self.padding.upper(),
+        rate=self.dilation_rate,
+        data_format=_data_format)
+    # (..., G*Ci*F) -> (..., G, Ci, F) -> sum Ci -> (..., G*F)
+    shape = array_ops.shape(outputs)
+    if self.data_format == 'channels_first':
+      outputs = array_ops.reshape(
+          outputs, array_ops.concat([shape[:1], [self.groups, ci, self.filters], shape[2:]], 0))
+      outputs = math_ops.reduce_sum(outputs, axis=2)
+      outputs = array_ops.reshape(
+          outputs, array_ops.concat([shape[:1], [self.groups * self.filters], shape[2:]], 0))
+    else:
+      outputs = array_ops.reshape(
+          outputs, array_ops.concat([shape[:3], [self.groups, ci, self.filters]], 0))
+      outputs = math_ops.reduce_sum(outputs, axis=4)
+      outputs = array_ops.reshape(
+          outputs, array_ops.concat([shape[:3], [self.groups * self.filters]], 0))
+    return outputs
+
   def call(self, inputs, **kwargs):
     if self.data_format == 'channels_first':
       channel_axis = 1
@@ -170,42 +221,40 @@ class GroupConv(Layer):
     if self.rank == 1 and self.padding == 'causal':
       inputs = array_ops.pad(inputs, self._compute_causal_padding())
     
-    if self.split:
-      inputs = tf.split(inputs, axis=channel_axis, num_or_size_splits=[self.filters,] * self.groups)
+    if not self.split:
+      outputs = self._convolution_op(inputs, self.kernel)
+    elif self.rank == 2 and self.fused:
+      outputs = self._grouped_conv2d(inputs)
+    else:
+      inputs = tf.split(inputs, axis=channel_axis, num_or_size_splits=self.groups)
+      kernels = tf.split(self.kernel, axis=-1, num_or_size_splits=self.groups)
+      outputs = tf.concat(
+          [self._convolution_op(x, k) for x, k in zip(inputs, kernels)],
+          axis=channel_axis)
 
-    outputs = []
-    for i in range(self.groups):
-      if self.split:
-        temp = self._convolution_op(inputs[i], self.kernel[i])
+    if self.use_bias:
+      if self.data_format == 'channels_first':
+        if self.rank == 1:
+          # nn.bias_add does not accept a 1D input tensor.
+          bias = array_ops.reshape(self.bias, (1, self.groups * self.filters, 1))
+          outputs += bias
+        if self.rank == 2:
+          outputs = nn.bias_add(outputs, self.bias, data_format='NCHW')
+        if self.rank == 3:
+          # As of Mar 2017, direct addition is significantly slower than
+          # bias_add when computing gradients. To use bias_add, we collapse Z
+          # and Y into a single dimension to obtain a 4D input tensor.
+          outputs_shape = outputs.shape.as_list()
+          if outputs_shape[0] is None:
+            outputs_shape[0] = -1
+          outputs_4d = array_ops.reshape(outputs,
+                                         [outputs_shape[0], outputs_shape[1],
+                                          outputs_shape[2] * outputs_shape[3],
+                                          outputs_shape[4]])
+          outputs_4d = nn.bias_add(outputs_4d, self.bias, data_format='NCHW')
+          outputs = array_ops.reshape(outputs_4d, outputs_shape)
       else:
-        temp = self._convolution_op(inputs, self.kernel[i])
-      
-      if self.use_bias:
-        if self.data_format == 'channels_first':
-          if self.rank == 1:
-            # nn.bias_add does not accept a 1D input tensor.
-            bias = array_ops.reshape(self.bias[i], (1, self.filters, 1))
-            temp += bias
-          if self.rank == 2:
-            temp = nn.bias_add(temp, self.bias[i], data_format='NCHW')
-          if self.rank == 3:
-            # As of Mar 2017, direct addition is significantly slower than
-            # bias_add when computing gradients. To use bias_add, we collapse Z
-            # and Y into a single dimension to obtain a 4D input tensor.
-            temp_shape = temp.shape.as_list()
-            if temp_shape[0] is None:
-              temp_shape[0] = -1
-            temp_4d = array_ops.reshape(temp,
-                                       [temp_shape[0], temp_shape[1],
-                                        temp_shape[2] * temp_shape[3],
-                                        temp_shape[4]])
-            temp_4d = nn.bias_add(temp_4d, self.bias[i], data_format='NCHW')
-            temp = array_ops.reshape(temp_4d, temp_shape)
-        else:
-          temp = nn.bias_add(temp, self.bias[i], data_format='NHWC')
-      outputs.append(temp)
-
-    outputs = tf.concat(outputs, axis=channel_axis)
+        outputs = nn.bias_add(outputs, self.bias, data_format='NHWC')
 
     if self.activation is not None:
       return self.activation(outputs)
@@ -243,6 +292,8 @@ class GroupConv(Layer):
   def get_config(self):
     config = {
         'split': self.split,
+        'fused': self.fused,
+        'rank': self.rank,
         'groups' : self.groups,
         'filters': self.filters,
         'kernel_size': self.kernel_size,
@@ -272,3 +323,168 @@ class GroupConv(Layer):
     else:
       causal_padding = [[0, 0], [0, 0], [left_pad, 0]]
     return causal_padding
+
+
+def convert_h5(src, dst):
+  """
+    Convert the h5 (model or weights) saved with the per-group weights
+    `kernel_0..kernel_G-1` / `bias_0..bias_G-1` to the packed `kernel` / `bias`.
+
+    The optimizer weights are dropped, recompile after loading.
+
+    Return:
+      Int, the number of the converted layers.
+  """
+  import re
+  import shutil
+  import h5py
+  import numpy as np
+  pattern = re.compile(r'^(.*)/(kernel|bias)_(\d+):0$')
+  shutil.copyfile(src, dst)
+  count = 0
+  with h5py.File(dst, 'r+') as f:
+    if 'optimizer_weights' in f:
+      del f['optimizer_weights']
+    root = f['model_weights'] if 'model_weights' in f else f
+    for layer_name in root.attrs['layer_names']:
+      group = root[layer_name]
+      weight_names = [n.decode('utf8') if isinstance(n, bytes) else n for n in group.attrs['weight_names']]
+      packed = {}
+      for n in weight_names:
+        match = pattern.match(n)
+        if match:
+          packed.setdefault((match.group(1), match.group(2)), []).append((int(match.group(3)), n))
+      if not packed:
+        continue
+      new_names = []
+      for n in weight_names:
+        match = pattern.match(n)
+        if not match:
+          new_names.append(n)
+          continue
+        prefix, kind = match.group(1), match.group(2)
+        new_name = f'{prefix}/{kind}:0'
+        if new_name in new_names:
+          continue
+        parts = [np.array(group[name]) for _, name in sorted(packed[(prefix, kind)])]
+        for _, name in packed[(prefix, kind)]:
+          del group[name]
+        group.create_dataset(new_name, data=np.concatenate(parts, axis=-1))
+        new_names.append(new_name)
+      group.attrs['weight_names'] = [n.encode('utf8') for n in new_names]
+      count += 1
+  return count
+
+
+if __name__ == "__main__":
+  import sys
+  if len(sys.argv) == 3 and sys.argv[1] != '--bench':
+    # python groupconv.py old.h5 new.h5
+    print(f'converted {convert_h5(sys.argv[1], sys.argv[2])} layers')
+    sys.exit()
+
+  # microbenchmark: 32 groups, 128 -> 128 channels, 3x3, 56x56, batch 32
+  import json
+  import os
+  import subprocess
+  import time
+  import numpy as np
+  from tensorflow.python.keras import backend as K
+  from tensorflow.python.keras.layers import Input
+  from tensorflow.python.keras.models import Model
+  from hat.models.advance.groupconv2d import GroupConv2D
+
+  class _PerGroup(Layer):
+    """The old per-group GroupConv: `kernel_i` then `bias_i` weights, split + conv + concat"""
+
+    def __init__(self, groups, filters, **kwargs):
+      super(_PerGroup, self).__init__(**kwargs)
+      self.groups = groups
+      self.filters = filters
+
+    def build(self, input_shape):
+      input_dim = int(input_shape[-1]) // self.groups
+      self.kernels = [self.add_weight(f'kernel_{i}', (3, 3, input_dim, self.filters))
+                      for i in range(self.groups)]
+      self.biases = [self.add_weight(f'bias_{i}', (self.filters,), initializer='random_uniform')
+                     for i in range(self.groups)]
+      self.built = True
+
+    def call(self, inputs):
+      xs = tf.split(inputs, self.groups, axis=-1)
+      return tf.concat([K.bias_add(K.conv2d(x, k, padding='same'), b)
+                        for x, k, b in zip(xs, self.kernels, self.biases)], axis=-1)
+
+  def _parity(groups=8, filters=4):
+    """old per-group h5 -> convert_h5 -> packed GroupConv, and GroupConv2D fused vs conv3d"""
+    import tempfile
+    x = np.random.rand(4, 16, 16, 32).astype('float32')
+    K.clear_session()
+    x_in = Input((16, 16, 32))
+    old = Model(x_in, _PerGroup(groups, filters, name='gc')(x_in))
+    y_old = old.predict(x)
+    with tempfile.TemporaryDirectory() as tmp:
+      old.save_weights(os.path.join(tmp, 'old.h5'))
+      convert_h5(os.path.join(tmp, 'old.h5'), os.path.join(tmp, 'new.h5'))
+      for fused in [True, False]:
+        K.clear_session()
+        x_in = Input((16, 16, 32))
+        new = Model(x_in, GroupConv(groups, filters, (3, 3), padding='same', fused=fused, name='gc')(x_in))
+        new.load_weights(os.path.join(tmp, 'new.h5'))
+        print(f'convert_h5 parity (fused={fused}): max abs diff {np.abs(new.predict(x) - y_old).max():.2e}')
+    K.clear_session()
+    x_in = Input((16, 16, 32))
+    outputs = [GroupConv2D(groups, filters, (3, 3), strides=2, padding='same', use_group_bias=True,
+                           bias_initializer='random_uniform', fused=fused, name=f'gc{int(fused)}')(x_in)
+               for fused in [True, False]]
+    model = Model(x_in, outputs)
+    model.get_layer('gc0').set_weights(model.get_layer('gc1').get_weights())
+    y_fused, y_conv3d = model.predict(x)
+    print(f'GroupConv2D parity (fused vs conv3d): max abs diff {np.abs(y_fused - y_conv3d).max():.2e}')
+
+  _cases = [
+      ['GroupConv (per-group)', lambda: GroupConv(32, 4, (3, 3), padding='same')],
+      ['GroupConv (fused)', lambda: GroupConv(32, 4, (3, 3), padding='same', fused=True)],
+      ['GroupConv2D (fused)', lambda: GroupConv2D(32, 4, (3, 3), padding='same')],
+      ['GroupConv2D (conv3d)', lambda: GroupConv2D(32, 4, (3, 3), padding='same', fused=False)]]
+
+  def _bench(layer_fn, steps=20, batch_size=32):
+    """steps/sec of forward & train, and the peak RSS (MB) they add over the built model"""
+    import resource
+    K.clear_session()
+    x_in = Input((56, 56, 128))
+    model = Model(x_in, layer_fn()(x_in))
+    model.compile(optimizer='sgd', loss='mse')
+    x = np.random.rand(batch_size, 56, 56, 128).astype('float32')
+    y = np.zeros((batch_size,) + model.output_shape[1:], 'float32')
+    base = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    result = []
+    for func in [lambda: model.predict_on_batch(x), lambda: model.train_on_batch(x, y)]:
+      func()
+      start_time = time.perf_counter()
+      for _ in range(steps):
+        func()
+      result.append(steps / (time.perf_counter() - start_time))
+    # NOTE: ru_maxrss is KB on Linux
+    result.append((resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - base) / 1024)
+    return result
+
+  if len(sys.argv) == 3 and sys.argv[1] == '--bench':
+    # the child process of the benchmark, one case per process for its own peak memory
+    print(json.dumps(_bench(_cases[int(sys.argv[2])][1])))
+    sys.exit()
+
+  _parity()
+
+  import hat
+  env = dict(os.environ)
+  env['PYTHONPATH'] = os.pathsep.join(
+      [os.path.dirname(os.path.dirname(os.path.abspath(hat.__file__))), env.get('PYTHONPATH', '')])
+  for i, (name, _) in enumerate(_cases):
+    proc = subprocess.run([sys.executable, '-m', 'hat.models.advance.groupconv', '--bench', str(i)],
+                          env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    if proc.returncode != 0:
+      print(f'{name}: failed, {proc.stderr.strip().splitlines()[-1:]}')
+      continue
+    forward, train, peak = json.loads(proc.stdout.strip().splitlines()[-1])
+    print(f'{name}: forward {forward:.2f} steps/sec, train {train:.2f} steps/sec, peak +{peak:.0f} MB')
@@ -22,15 +22,19 @@ class GroupConv2D(Layer):
       groups: An int. The numbers of groups. Make sure [Channels] can be disdivided by groups.
       filters: An int. The numbers of groups filters. 0 means filters=channels//groups.(default 0)
       kernel_size: An int or tuple/list of 2 int, specifying the length of the convolution window.(default 1)
+      fused: A bool. channels_last only, fold the groups into the batch and run
+        one conv2d with the shared kernel instead of the conv3d over
+        (H, W, G). Same weights and outputs.(default True)
       others: The same as normal Convolution.
   """
   def __init__(self, groups:int, filters=0, kernel_size=1, strides=1, padding='valid',
                data_format=None, activation=None, use_bias=True, use_group_bias=False,
                kernel_initializer='glorot_uniform', bias_initializer='zeros',
                kernel_regularizer=None, bias_regularizer=None, kernel_constraint=None,
-               bias_constraint=None, **kwargs):
+               bias_constraint=None, fused=True, **kwargs):
     super().__init__(**kwargs)
     self.groups = groups
+    self.fused = fused
     self.filters = filters
     self.kernel_size = conv_utils.normalize_tuple(kernel_size, 2, 'kernel_size')
     self.strides = conv_utils.normalize_tuple(strides, 2, 'strides') 
@@ -120,13 +124,16 @@ class GroupConv2D(Layer):
     outputs = array_ops.reshape(inputs, shape_i)
     
     # Convolution
-    outputs = self._convolution_op(
-      outputs,
-      self.kernel,
-      strides=self.strides + (1,),
-      padding=self.padding,
-      data_format=self.data_format,
-    )
+    if self.fused and self.data_format == 'channels_last':
+      outputs = self._folded_conv(outputs, _shape)
+    else:
+      outputs = self._convolution_op(
+        outputs,
+        self.kernel,
+        strides=self.strides + (1,),
+        padding=self.padding,
+        data_format=self.data_format,
+      )
 
     # Group biases adding
     # NOTE: transpose the G & Ci, and add groups biases, then transpose back
@@ -170,6 +177,26 @@ class GroupConv2D(Layer):
 
     return outputs
 
+  def _folded_conv(self, inputs, _shape):
+    """
+      (N, H, W, G, Ci) -> (N * G, H, W, Ci) -> conv2d -> (N, H', W', G, Fo)
+
+      The kernel is shared by the groups (depth 1), so the conv3d over
+      (H, W, G) is the same as one conv2d on the groups folded into the batch.
+    """
+    outputs = K.permute_dimensions(inputs, [0, 3, 1, 2, 4])
+    outputs = array_ops.reshape(outputs, [-1, _shape[1], _shape[2], self.input_dim_i])
+    outputs = K.conv2d(
+      outputs,
+      self.kernel[:, :, 0],
+      strides=self.strides,
+      padding=self.padding,
+      data_format='channels_last',
+    )
+    h, w = outputs.shape.as_list()[1:3]
+    outputs = array_ops.reshape(outputs, [-1, self.groups, h, w, self.output_dim_i])
+    return K.permute_dimensions(outputs, [0, 2, 3, 1, 4])
+
   def compute_output_shape(self, input_shape):
     input_shape = tensor_shape.TensorShape(input_shape).as_list()
 
@@ -217,7 +244,8 @@ class GroupConv2D(Layer):
       'bias_regularizer': regularizers.serialize(self.bias_regularizer),
       'activity_regularizer': regularizers.serialize(self.activity_regularizer),
       'kernel_constraint': constraints.serialize(self.kernel_constraint),
-      'bias_constraint': constraints.serialize(self.bias_constraint)
+      'bias_constraint': constraints.serialize(self.bias_constraint),
+      'fused': self.fused,
     }
     base_config = super().get_config()
     return dict(list(base_config.items()) + list(config.items()))
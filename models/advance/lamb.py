@@ -0,0 +1,122 @@
+# pylint: disable=no-name-in-module
+# pylint: disable=attribute-defined-outside-init
+
+from tensorflow.python.keras import backend as K
+from tensorflow.python.keras.optimizers import Optimizer
+from tensorflow.python.ops import math_ops
+from tensorflow.python.ops import state_ops
+
+
+class LAMB(Optimizer):
+  """
+    Layer-wise Adaptive Moments for Batch training (LAMB)
+
+    Adam with decoupled weight decay, the update of each layer is scaled
+    by the trust ratio `||w|| / ||update||`.
+
+    Ref: You et al., Large Batch Optimization for Deep Learning:
+    Training BERT in 76 minutes, 2019.
+
+    Argument:
+      lr: Float. Global learning rate.
+      beta_1: Float.
+      beta_2: Float.
+      weight_decay: Float.
+      epsilon: Float.
+      exclude_1d: Boolean. Don't adapt/decay the 1-D weights (bias, BN).
+
+    Usage:
+    ```python
+      self.OPT = LAMB(lr=1e-3 * (batch_size / 256) ** 0.5, weight_decay=1e-2)
+    ```
+  """
+
+  def __init__(self, lr=1e-3, beta_1=0.9, beta_2=0.999, weight_decay=1e-2, epsilon=1e-6,
+               exclude_1d=True, **kwargs):
+    super(LAMB, self).__init__(**kwargs)
+    with K.name_scope(self.__class__.__name__):
+      self.iterations = K.variable(0, dtype='int64', name='iterations')
+      self.lr = K.variable(lr, name='lr')
+      self.beta_1 = K.variable(beta_1, name='beta_1')
+      self.beta_2 = K.variable(beta_2, name='beta_2')
+    self.weight_decay = weight_decay
+    self.epsilon = epsilon
+    self.exclude_1d = exclude_1d
+
+  def get_updates(self, loss, params):
+    grads = self.get_gradients(loss, params)
+    self.updates = [state_ops.assign_add(self.iterations, 1)]
+    t = math_ops.cast(self.iterations, K.floatx()) + 1
+    ms = [K.zeros(K.int_shape(p), dtype=K.dtype(p)) for p in params]
+    vs = [K.zeros(K.int_shape(p), dtype=K.dtype(p)) for p in params]
+    self.weights = [self.iterations] + ms + vs
+
+    for p, g, m, v in zip(params, grads, ms, vs):
+      m_t = self.beta_1 * m + (1. - self.beta_1) * g
+      v_t = self.beta_2 * v + (1. - self.beta_2) * math_ops.square(g)
+      self.updates.append(state_ops.assign(m, m_t))
+      self.updates.append(state_ops.assign(v, v_t))
+      m_hat = m_t / (1. - math_ops.pow(self.beta_1, t))
+      v_hat = v_t / (1. - math_ops.pow(self.beta_2, t))
+      r = m_hat / (math_ops.sqrt(v_hat) + self.epsilon)
+      lr = self.lr
+      if not (self.exclude_1d and len(K.int_shape(p)) <= 1):
+        r = r + self.weight_decay * p
+        w_norm = math_ops.sqrt(math_ops.reduce_sum(math_ops.square(p)))
+        r_norm = math_ops.sqrt(math_ops.reduce_sum(math_ops.square(r)))
+        # NOTE: the trust ratio is 1 if the weight or the update is all zero
+        trust = K.switch(math_ops.logical_and(w_norm > 0, r_norm > 0), w_norm / r_norm, 1.)
+        lr = lr * trust
+      new_p = p - lr * r
+      if getattr(p, 'constraint', None) is not None:
+        new_p = p.constraint(new_p)
+      self.updates.append(state_ops.assign(p, new_p))
+    return self.updates
+
+  def get_config(self):
+    config = {
+      'lr': float(K.get_value(self.lr)),
+      'beta_1': float(K.get_value(self.beta_1)),
+      'beta_2': float(K.get_value(self.beta_2)),
+      'weight_decay': self.weight_decay,
+      'epsilon': self.epsilon,
+      'exclude_1d': self.exclude_1d,
+    }
+    base_config = super(LAMB, self).get_config()
+    return dict(list(base_config.items()) + list(config.items()))
+
+
+if __name__ == "__main__":
+  # Reproduction: cifar10 + resnet50, time to accuracy of
+  #   SGD  (batch 128,  lr 0.1)
+  #   LAMB (batch 4096, sqrt scaled lr, 5 epochs linear warmup)
+  import time
+  from hat.datasets import cifar10
+  from hat.models.callbacks import LinearWarmup
+  from hat.models.standard import resnet50
+  from tensorflow.python.keras.optimizers import SGD
+
+  TARGET = 0.8
+  EPOCHS = 60
+  data = cifar10()
+
+  def time_to_accuracy(opt, batch_size, callbacks=None):
+    K.clear_session()
+    model = resnet50(DATAINFO=data.DATAINFO, built=True)
+    model.compile(optimizer=opt(), loss='sparse_categorical_crossentropy', metrics=['accuracy'])
+    cost = 0.
+    for epoch in range(EPOCHS):
+      start_time = time.perf_counter()
+      model.fit(data.train_x, data.train_y, batch_size=batch_size, epochs=1, verbose=0,
+                callbacks=callbacks)
+      cost += time.perf_counter() - start_time
+      acc = model.evaluate(data.val_x, data.val_y, batch_size=1024, verbose=0)[1]
+      print(f'batch {batch_size}, epoch {epoch + 1}: val_accuracy {acc:.4f}, train time {cost:.1f}s')
+      if acc >= TARGET:
+        return cost, epoch + 1
+    return None, EPOCHS
+
+  sgd = time_to_accuracy(lambda: SGD(lr=0.1, momentum=.9), 128)
+  lamb = time_to_accuracy(lambda: LAMB(lr=1e-3 * (4096 / 256) ** 0.5), 4096,
+                          [LinearWarmup(4096, warmup_epochs=5, base_batch_size=4096)])
+  print(f'time to {TARGET:.0%}: SGD/128 {sgd}, LAMB/4096 {lamb}')
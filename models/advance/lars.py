@@ -0,0 +1,80 @@
+# pylint: disable=no-name-in-module
+# pylint: disable=attribute-defined-outside-init
+
+from tensorflow.python.keras import backend as K
+from tensorflow.python.keras.optimizers import Optimizer
+from tensorflow.python.ops import math_ops
+from tensorflow.python.ops import state_ops
+
+
+class LARS(Optimizer):
+  """
+    Layer-wise Adaptive Rate Scaling (LARS)
+
+    SGD with momentum, the learning rate of each layer is scaled by the
+    trust ratio `eta * ||w|| / (||g|| + weight_decay * ||w||)`, which
+    keeps the large batch training stable.
+
+    Ref: You et al., Large Batch Training of Convolutional Networks, 2017.
+
+    Argument:
+      lr: Float. Global learning rate.
+      momentum: Float.
+      weight_decay: Float.
+      eta: Float. Trust coefficient.
+      epsilon: Float.
+      exclude_1d: Boolean. Don't adapt/decay the 1-D weights (bias, BN).
+
+    Usage:
+    ```python
+      self.OPT = LARS(lr=0.1 * batch_size / 256, weight_decay=5e-4)
+    ```
+  """
+
+  def __init__(self, lr=0.1, momentum=0.9, weight_decay=5e-4, eta=0.001, epsilon=1e-9,
+               exclude_1d=True, **kwargs):
+    super(LARS, self).__init__(**kwargs)
+    with K.name_scope(self.__class__.__name__):
+      self.iterations = K.variable(0, dtype='int64', name='iterations')
+      self.lr = K.variable(lr, name='lr')
+      self.momentum = K.variable(momentum, name='momentum')
+    self.weight_decay = weight_decay
+    self.eta = eta
+    self.epsilon = epsilon
+    self.exclude_1d = exclude_1d
+
+  def get_updates(self, loss, params):
+    grads = self.get_gradients(loss, params)
+    self.updates = [state_ops.assign_add(self.iterations, 1)]
+    moments = [K.zeros(K.int_shape(p), dtype=K.dtype(p)) for p in params]
+    self.weights = [self.iterations] + moments
+
+    for p, g, m in zip(params, grads, moments):
+      lr = self.lr
+      if not (self.exclude_1d and len(K.int_shape(p)) <= 1):
+        w_norm = math_ops.sqrt(math_ops.reduce_sum(math_ops.square(p)))
+        g_norm = math_ops.sqrt(math_ops.reduce_sum(math_ops.square(g)))
+        trust = self.eta * w_norm / (g_norm + self.weight_decay * w_norm + self.epsilon)
+        # NOTE: the trust ratio is 1 if the weight or the grad is all zero
+        trust = K.switch(math_ops.logical_and(w_norm > 0, g_norm > 0), trust, 1.)
+        lr = lr * trust
+        g = g + self.weight_decay * p
+      v = self.momentum * m + lr * g
+      self.updates.append(state_ops.assign(m, v))
+      new_p = p - v
+      if getattr(p, 'constraint', None) is not None:
+        new_p = p.constraint(new_p)
+      self.updates.append(state_ops.assign(p, new_p))
+    return self.updates
+
+  def get_config(self):
+    config = {
+      'lr': float(K.get_value(self.lr)),
+      'momentum': float(K.get_value(self.momentum)),
+      'weight_decay': self.weight_decay,
+      'eta': self.eta,
+      'epsilon': self.epsilon,
+      'exclude_1d': self.exclude_1d,
+    }
+    base_config = super(LARS, self).get_config()
+    return dict(list(base_config.items()) + list(config.items()))
@@ -0,0 +1,135 @@
+# pylint: disable=no-name-in-module
+# pylint: disable=arguments-differ
+
+import tensorflow as tf
+from tensorflow.python.keras.layers import Wrapper
+
+
+def _recompute_grad(func):
+  """tf.recompute_grad (tf>=1.14) or the contrib one"""
+  if hasattr(tf, 'recompute_grad'):
+    return tf.recompute_grad(func)
+  return tf.contrib.layers.recompute_grad(func)
+
+
+class Recompute(Wrapper):
+  """
+    Gradient checkpointing (activation recomputation)
+
+    Wrap a sub-model (a block), the activations inside the block are not
+    kept for backprop, but recomputed from the block inputs during the
+    backward pass. Less memory, about one more forward of the block.
+
+    Input:
+      The inputs of the sub-model, a tensor or a list of tensors.
+
+    Usage:
+    ```python
+      block = Model(inputs=b_in, outputs=b_out)
+      x = Recompute(block)(x)
+      # or in AdvNet
+      x = self.recompute(self._bottle, 64, 256)(x)
+    ```
+  """
+
+  def __init__(self, layer, **kwargs):
+    super(Recompute, self).__init__(layer, **kwargs)
+    self._forward_updates = []
+
+  def build(self, input_shape=None):
+    self.built = True
+
+  @property
+  def trainable_weights(self):
+    return self.layer.trainable_weights if self.trainable else []
+
+  @property
+  def non_trainable_weights(self):
+    if self.trainable:
+      return self.layer.non_trainable_weights
+    return self.layer.weights
+
+  @property
+  def updates(self):
+    return list(self._forward_updates)
+
+  def call(self, inputs, **kwargs):
+    if isinstance(inputs, (list, tuple)):
+      outputs = _recompute_grad(lambda *x: self.layer(list(x)))(*inputs)
+    else:
+      outputs = _recompute_grad(self.layer)(inputs)
+    # NOTE: only the updates (BN moving stats) of the forward call, the
+    # backward pass runs the block again and adds its own update ops,
+    # `self.layer.updates` would apply the moving stats twice per step
+    for update in self.layer.get_updates_for(inputs):
+      if update not in self._forward_updates:
+        self._forward_updates.append(update)
+    return outputs
+
+  def compute_output_shape(self, input_shape):
+    return self.layer.compute_output_shape(input_shape)
+
+
+def measure_train(name, batch_size=64, steps=3, input_shape=(224, 224, 3), num_classes=1000, **kwargs):
+  """
+    Peak RSS (MiB) & step time (s) of training a standard model.
+
+    NOTE: The peak RSS never decreases, run it in a fresh process.
+
+    Argument:
+      name: Str. Model name of the standard lib.
+      kwargs: The model arguments, e.g. use_recompute=True.
+  """
+  import time
+  import numpy as np
+  import hat.models.standard
+  from hat.utils.memory import peak_rss
+  model = getattr(hat.models.standard, name)(
+    DATAINFO={'INPUT_SHAPE': input_shape, 'NUM_CLASSES': num_classes},
+    built=True,
+    **kwargs)
+  model.compile(optimizer='sgd', loss='sparse_categorical_crossentropy')
+  x = np.random.rand(batch_size, *input_shape).astype('float32')
+  y = np.random.randint(num_classes, size=(batch_size, 1))
+  model.train_on_batch(x, y)
+  start_time = time.perf_counter()
+  for _ in range(steps):
+    model.train_on_batch(x, y)
+  return peak_rss(), (time.perf_counter() - start_time) / steps
+
+
+def _check_updates(steps=1):
+  """The BN moving_mean after `steps` train steps, the same with and without Recompute"""
+  import numpy as np
+  from tensorflow.python.keras import backend as K
+  from tensorflow.python.keras.layers import BatchNormalization, Conv2D, Input
+  from tensorflow.python.keras.models import Model
+  from tensorflow.python.keras.optimizers import SGD
+  x = np.random.rand(8, 8, 8, 3).astype('float32')
+  y = np.random.rand(8, 8, 8, 4).astype('float32')
+  result = []
+  for recompute in [False, True]:
+    K.clear_session()
+    b_in = Input((8, 8, 3))
+    block = Model(b_in, BatchNormalization(name='bn')(Conv2D(4, 3, padding='same', name='conv',
+                                                              kernel_initializer='ones')(b_in)))
+    x_in = Input((8, 8, 3))
+    model = Model(x_in, Recompute(block)(x_in) if recompute else block(x_in))
+    model.compile(optimizer=SGD(0), loss='mse')
+    for _ in range(steps):
+      model.train_on_batch(x, y)
+    result.append(K.get_value(block.get_layer('bn').moving_mean))
+  return float(np.abs(result[0] - result[1]).max())
+
+
+if __name__ == "__main__":
+  print(f'moving_mean after 1 step, max abs diff with and without Recompute: {_check_updates():.2e}')
+
+  # peak memory vs step time, resnet152 & densenet264, batch 64
+  import multiprocessing
+  ctx = multiprocessing.get_context('spawn')
+  for name in ['resnet152', 'densenet264']:
+    for recompute in [False, True]:
+      with ctx.Pool(1) as pool:
+        mem, step = pool.apply(measure_train, (name, 64), {'use_recompute': recompute})
+      print(f'{name}, recompute {recompute}: peak RSS {mem:.0f} MiB, {step:.3f} s/step')
@@ -1,7 +1,5 @@
 
-import tensorflow as tf
 from tensorflow.python.keras import backend as K
-from tensorflow.python.keras.layers import Reshape
 from tensorflow.python.keras.layers.merge import _Merge
 from tensorflow.python.keras.utils import tf_utils
 from tensorflow.python.ops import array_ops
@@ -12,6 +10,9 @@ class Shuffle(_Merge):
     Layer that shuffle and concatenate a list of inputs
 
     Usage: The same as keras.layers.Concatenate
+
+    NOTE: The inputs with the same channels are stacked and reshaped (one
+    copy, no Reshape layer), else concatenated and gathered.
   """
   def __init__(self, axis=-1, **kwargs):
     super(Shuffle, self).__init__(**kwargs)
@@ -39,20 +40,27 @@ class Shuffle(_Merge):
                        'Got inputs shapes: %s' % (input_shape))
 
   def _merge_function(self, inputs):
-    
-    x = K.concatenate(inputs, axis=self.axis)
-    
-    _len = len(inputs)
-    _shape = K.int_shape(x)[1:]
-    _shapex = _shape[:-1] + (_len, _shape[-1] // _len)
-    _transpose = list(range(len(_shapex)+1))
-    _transpose = _transpose[:-2] + [_transpose[-1], _transpose[-2]]
+    ndim = K.ndim(inputs[0])
+    axis = self.axis % ndim
+    sizes = [K.int_shape(x)[axis] for x in inputs]
 
-    x = Reshape(_shapex)(x)
-    x = tf.transpose(x, _transpose)
-    x = Reshape(_shape)(x)
+    if None not in sizes and len(set(sizes)) == 1:
+      # concat + shuffle in one op: stack the inputs behind the axis,
+      # (..., c, n, ...) -> (..., c * n, ...), channel i * c + k -> k * n + i
+      x = array_ops.stack(inputs, axis=axis + 1)
+      shape = array_ops.shape(x)
+      return array_ops.reshape(x, array_ops.concat(
+          [shape[:axis], [sizes[0] * len(inputs)], shape[axis + 2:]], 0))
+
+    # different channels, concat then gather with the permutation
+    x = K.concatenate(inputs, axis=self.axis)
+    return array_ops.gather(x, self._permutation(sum(sizes), len(inputs)), axis=axis)
 
-    return x 
+  @staticmethod
+  def _permutation(channels, groups):
+    """The precomputed channel order, the same as reshape -> transpose -> reshape"""
+    _hc = channels // groups
+    return [(j % groups) * _hc + j // groups for j in range(channels)]
 
   @tf_utils.shape_type_conversion
   def compute_output_shape(self, input_shape):
@@ -0,0 +1,138 @@
+# pylint: disable=no-name-in-module
+
+import tensorflow as tf
+from tensorflow.python.keras import backend as K
+from tensorflow.python.keras.layers import Layer
+
+
+TTA_OPS = ['id', 'hflip', 'vflip', 'crop_c', 'crop_tl', 'crop_tr', 'crop_bl', 'crop_br']
+TTA_POLICIES = {
+  'none': ['id'],
+  'flip': ['id', 'hflip'],
+  'crop5': ['crop_c', 'crop_tl', 'crop_tr', 'crop_bl', 'crop_br'],
+  'flip-crop5': ['id', 'hflip', 'crop_c', 'crop_tl', 'crop_tr', 'crop_bl', 'crop_br'],
+}
+
+
+class TTA(Layer):
+  """
+    Test-time augmentation as a batch expansion
+
+    Input:
+      (batch, h, w, c)
+
+    Output:
+      (n * batch, h, w, c), the n views one after another, view i is
+      `outputs[i * batch:(i + 1) * batch]`
+
+    Usage:
+
+    ```python
+      x = TTA('flip')(x)  # or TTA(['id', 'hflip', 'crop_c'])
+      x = model(x)
+      x = TTAMean(2)(x)
+    ```
+
+    NOTE: The crops keep `crop_ratio` of the height/width and are resized
+    back (bilinear) to the input size.
+  """
+
+  def __init__(self, policy='flip', crop_ratio=0.875, data_format=None, **kwargs):
+    super(TTA, self).__init__(**kwargs)
+    self.policy = TTA_POLICIES[policy] if isinstance(policy, str) else list(policy)
+    for op in self.policy:
+      if op not in TTA_OPS:
+        raise ValueError(f'TTA op must be in {TTA_OPS}, got {op}')
+    self.crop_ratio = crop_ratio
+    self.data_format = data_format or K.image_data_format()
+
+  def _view(self, x, op):
+    """channels_last view"""
+    if op == 'id':
+      return x
+    if op == 'hflip':
+      return x[:, :, ::-1]
+    if op == 'vflip':
+      return x[:, ::-1]
+    h, w = K.int_shape(x)[1:3]
+    ch, cw = int(round(h * self.crop_ratio)), int(round(w * self.crop_ratio))
+    top = {'c': (h - ch) // 2, 't': 0, 'b': h - ch}[op[5]]
+    left = {'c': (w - cw) // 2, 'l': 0, 'r': w - cw}[op[-1]]
+    x = x[:, top:top + ch, left:left + cw]
+    return tf.image.resize_bilinear(x, (h, w))
+
+  def call(self, inputs, **kwargs):
+    x = inputs
+    if self.data_format == 'channels_first':
+      x = K.permute_dimensions(x, (0, 2, 3, 1))
+    x = K.concatenate([self._view(x, op) for op in self.policy], axis=0)
+    if self.data_format == 'channels_first':
+      x = K.permute_dimensions(x, (0, 3, 1, 2))
+    return x
+
+  def compute_output_shape(self, input_shape):
+    input_shape = list(input_shape)
+    if input_shape[0] is not None:
+      input_shape[0] *= len(self.policy)
+    return tuple(input_shape)
+
+  def get_config(self):
+    config = {
+      'policy': self.policy,
+      'crop_ratio': self.crop_ratio,
+      'data_format': self.data_format,
+    }
+    base_config = super(TTA, self).get_config()
+    return dict(list(base_config.items()) + list(config.items()))
+
+
+class TTAMean(Layer):
+  """
+    Average the TTA views (and the models) back to one prediction
+
+    Input:
+      (n * batch, classes), or a list of them (one per model)
+
+    Output:
+      (batch, classes)
+
+    Argument:
+      views: Int. The n of TTA.
+      mode: Str. 'logits', average the log-probs and softmax (the
+        normalised geometric mean), or 'probs', average the probs.
+  """
+
+  def __init__(self, views, mode='logits', **kwargs):
+    super(TTAMean, self).__init__(**kwargs)
+    if mode not in ['logits', 'probs']:
+      raise ValueError(f"mode must be 'logits' or 'probs', got {mode}")
+    self.views = views
+    self.mode = mode
+
+  def call(self, inputs, **kwargs):
+    if not isinstance(inputs, (list, tuple)):
+      inputs = [inputs]
+    outputs = []
+    for x in inputs:
+      if self.mode == 'logits':
+        x = K.log(K.clip(x, K.epsilon(), 1.))
+      x = K.reshape(x, (self.views, -1, K.int_shape(x)[-1]))
+      outputs.append(K.mean(x, axis=0))
+    x = outputs[0] if len(outputs) == 1 else K.mean(K.stack(outputs), axis=0)
+    if self.mode == 'logits':
+      x = K.softmax(x)
+    return x
+
+  def compute_output_shape(self, input_shape):
+    if isinstance(input_shape, list):
+      input_shape = input_shape[0]
+    batch = input_shape[0] // self.views if input_shape[0] is not None else None
+    return (batch, input_shape[-1])
+
+  def get_config(self):
+    config = {
+      'views': self.views,
+      'mode': self.mode,
+    }
+    base_config = super(TTAMean, self).get_config()
+    return dict(list(base_config.items()) + list(config.items()))
@@ -10,6 +10,10 @@ from hat.models.advance.shuffle import Shuffle
 from hat.models.advance.squeezeexcitation import SqueezeExcitation
 from hat.models.advance.swish import Swish
 from hat.models.advance.groupconv2d import GroupConv2D
+from hat.models.advance.lars import LARS
+from hat.models.advance.lamb import LAMB
+from hat.models.advance.recompute import Recompute
+from hat.models.advance.tta import TTA, TTAMean, TTA_POLICIES
 
 
 # import setting
@@ -26,6 +30,12 @@ __all__ = [
   'EfficientNetDenseInitializer',
   'ENCI',
   'ENDI',
+  'LARS',
+  'LAMB',
+  'Recompute',
+  'TTA',
+  'TTAMean',
+  'TTA_POLICIES',
 ]
 
 
@@ -49,5 +59,13 @@ _CUSTOM_OBJECTS = {
   'EfficientNetDenseInitializer': EfficientNetDenseInitializer,
   'ENCI': ENCI,
   'ENDI': ENDI,
+  'LARS': LARS,
+  'LAMB': LAMB,
+  'Recompute': Recompute,
+  'TTA': TTA,
+  'TTAMean': TTAMean,
+  # NOTE: lower case names, so that `OPT = 'lars'` works as 'sgd'
+  'lars': LARS,
+  'lamb': LAMB,
 }
 get_custom_objects().update(_CUSTOM_OBJECTS)
@@ -0,0 +1,412 @@
+"""
+  训练过程中使用的Callbacks
+
+  包含的类：
+    StepTimer
+    Plateau
+    LinearWarmup
+    MagnitudePrune
+"""
+
+# pylint: disable=no-name-in-module
+# pylint: disable=attribute-defined-outside-init
+# pylint: disable=unused-argument
+
+import threading
+import time
+
+import numpy as np
+from tensorflow.python.keras import backend as K
+from tensorflow.python.keras.callbacks import Callback
+from tensorflow.python.keras.utils import Sequence
+
+
+# import setting
+__all__ = [
+  'StepTimer',
+  'Plateau',
+  'LinearWarmup',
+  'MagnitudePrune',
+]
+
+
+class _TimedSequence(Sequence):
+  """
+    Sequence wrapper which records the cost time of `__getitem__`
+  """
+
+  def __init__(self, sequence, record):
+    self.sequence = sequence
+    self._record = record
+
+  def __len__(self):
+    return len(self.sequence)
+
+  def __getitem__(self, idx):
+    start_time = time.perf_counter()
+    item = self.sequence[idx]
+    self._record(time.perf_counter() - start_time)
+    return item
+
+  def on_epoch_end(self):
+    self.sequence.on_epoch_end()
+
+
+class StepTimer(Callback):
+  """
+    Per-step throughput & data-stall instrumentation
+
+    For each train step, record:
+      wait:    time the train loop waited between two steps (data stall)
+      compute: time of the train step itself
+      load:    time of the generator `__getitem__` (only if wrapped)
+      sps:     samples per second
+
+    At the end of each epoch, p50/p95/p99 of the records are logged and
+    appended to `history`, which is a list of dict.
+
+    Usage:
+    ```python
+      step_timer = StepTimer(batch_size, Log)
+      generator = step_timer.wrap(generator)
+      model.fit_generator(generator, callbacks=[step_timer])
+    ```
+
+    NOTE: The epoch counter is kept by the callback itself, so one instance
+    can be shared by several `fit(epochs=1)` calls.
+  """
+
+  def __init__(self, batch_size, Log=None, percentiles=(50, 95, 99)):
+    super().__init__()
+    self.batch_size = batch_size
+    self.Log = Log
+    self.percentiles = percentiles
+    self.history = []
+    self._epoch = 0
+    self._lock = threading.Lock()
+    self._reset()
+
+  def _reset(self):
+    self._wait = []
+    self._compute = []
+    self._load = []
+    self._sps = []
+    self._last = time.perf_counter()
+    self._begin = self._last
+
+  def _record_load(self, cost_time):
+    with self._lock:
+      self._load.append(cost_time)
+
+  def wrap(self, sequence):
+    """
+      Wrap a `Sequence`(e.g. `DG`) to record the cost time of `__getitem__`
+    """
+    return _TimedSequence(sequence, self._record_load)
+
+  def on_epoch_begin(self, epoch, logs=None):
+    self._reset()
+    self._epoch += 1
+
+  def on_batch_begin(self, batch, logs=None):
+    self._begin = time.perf_counter()
+    self._wait.append(self._begin - self._last)
+
+  def on_batch_end(self, batch, logs=None):
+    self._last = time.perf_counter()
+    compute = self._last - self._begin
+    self._compute.append(compute)
+    size = (logs or {}).get('size', self.batch_size)
+    self._sps.append(size / max(compute + self._wait[-1], 1e-9))
+
+  def on_epoch_end(self, epoch, logs=None):
+    stats = {}
+    with self._lock:
+      _records = {
+        'wait': self._wait,
+        'compute': self._compute,
+        'load': self._load,
+        'sps': self._sps,
+      }
+      for name, values in _records.items():
+        if not values:
+          continue
+        for q, v in zip(self.percentiles, np.percentile(values, self.percentiles)):
+          stats[f'epoch{self._epoch}_step_{name}_p{q}'] = float(v)
+    total_wait = sum(self._wait)
+    total_time = total_wait + sum(self._compute)
+    stats[f'epoch{self._epoch}_step_wait_ratio'] = total_wait / total_time if total_time else 0.
+    self.history.append(stats)
+
+    if self.Log is not None:
+      _pre = f'epoch{self._epoch}_step_'
+      for name in ['wait', 'compute', 'load']:
+        if f'{_pre}{name}_p{self.percentiles[0]}' not in stats:
+          continue
+        self.Log(', '.join(f"p{q} {stats[f'{_pre}{name}_p{q}'] * 1e3:.2f}" for q in self.percentiles),
+                 _T=f'Step {name} (ms):')
+      if f'{_pre}sps_p{self.percentiles[0]}' in stats:
+        self.Log(', '.join(f"p{q} {stats[f'{_pre}sps_p{q}']:.2f}" for q in self.percentiles),
+                 _T='Step samples/sec:')
+      self.Log(f"{stats[f'{_pre}wait_ratio']:.2%}", _T='Data wait ratio:')
+
+
+class Plateau(object):
+  """
+    Early stopping & reduce learning rate on plateau
+
+    HAT trains one epoch per `fit` call, so the keras callbacks
+    (`EarlyStopping`, `ReduceLROnPlateau`) can not see the whole run.
+    `Plateau` is updated by the train loop with the val metrics instead.
+    The patience counts epochs, not updates, so it is the same when the
+    val runs every N epochs. A NaN metric stops only with early stopping.
+
+    Argument:
+      monitor: Str. 'val_accuracy' or 'val_loss'.
+      patience: Int. Epochs without improvement before stopping. 0 means no early stopping.
+      lr_patience: Int. Epochs without improvement (or since the last reduce) before
+        reducing the learning rate. 0 means never.
+      lr_factor: Float. new_lr = lr * lr_factor.
+      min_lr: Float. Lower bound of the learning rate.
+      min_delta: Float. Minimum change to qualify as an improvement.
+      restore_best: Boolean. Keep the best weights, which can be restored by `restore()`.
+
+    Usage:
+    ```python
+      plateau = Plateau(patience=10, lr_patience=5)
+      for i in range(epochs):
+        ...
+        if plateau.update(i + 1, {'val_loss': loss, 'val_accuracy': acc}, model) == 'stop':
+          break
+      plateau.restore(model)
+    ```
+  """
+
+  def __init__(self, monitor='val_accuracy', patience=0, lr_patience=0, lr_factor=0.1,
+               min_lr=0., min_delta=0., restore_best=True):
+    self.monitor = monitor
+    self.patience = patience
+    self.lr_patience = lr_patience
+    self.lr_factor = lr_factor
+    self.min_lr = min_lr
+    self.min_delta = abs(min_delta)
+    self.restore_best = restore_best
+    self._sign = -1 if 'loss' in monitor else 1
+
+    self.best = None
+    self.best_epoch = 0
+    self.best_weights = None
+    self.stop_epoch = 0
+    self.stop_reason = ''
+    self._lr_epoch = 0
+
+  def _improved(self, value):
+    if self.best is None:
+      return True
+    return self._sign * (value - self.best) > self.min_delta
+
+  def _reduce_lr(self, model):
+    optimizer = model.parallel_model.optimizer
+    old_lr = float(K.get_value(optimizer.lr))
+    new_lr = max(old_lr * self.lr_factor, self.min_lr)
+    if new_lr >= old_lr:
+      return None
+    K.set_value(optimizer.lr, new_lr)
+    return new_lr
+
+  def update(self, epoch, logs, model, weights=None):
+    """
+      Update with the val metrics of an epoch.
+
+      Argument:
+        epoch: Int. Count from 1.
+        logs: Dict. Must contain `monitor`.
+        model: NetWork.
+        weights: List of np.array. The weights of the epoch, if they are not
+          the current weights of the model (e.g. validated asynchronously).
+
+      Return:
+        None, 'reduce_lr' or 'stop'
+    """
+    value = logs[self.monitor]
+    if np.isnan(value):
+      if not self.patience:
+        return None
+      self.stop_epoch = epoch
+      self.stop_reason = f'{self.monitor} is NaN'
+      return 'stop'
+
+    if self._improved(value):
+      self.best = value
+      self.best_epoch = epoch
+      self._lr_epoch = epoch
+      if self.restore_best:
+        self.best_weights = weights if weights is not None else model.model.get_weights()
+      return None
+
+    if self.patience and epoch - self.best_epoch >= self.patience:
+      self.stop_epoch = epoch
+      self.stop_reason = f'{self.monitor} did not improve for {epoch - self.best_epoch} epochs'
+      return 'stop'
+    if self.lr_patience and epoch - self._lr_epoch >= self.lr_patience:
+      self._lr_epoch = epoch
+      if self._reduce_lr(model) is not None:
+        return 'reduce_lr'
+    return None
+
+  def restore(self, model):
+    """
+      Restore the best weights, return True if restored.
+    """
+    if self.best_weights is None:
+      return False
+    model.model.set_weights(self.best_weights)
+    return True
+
+
+class LinearWarmup(Callback):
+  """
+    Linear learning rate warmup which follows the batch size
+
+    The target learning rate follows the linear scaling rule,
+    `lr * batch_size / base_batch_size`, where `lr` is `base_lr`, or the
+    learning rate of the optimizer when the training begins. During the
+    first `warmup_epochs`, the learning rate grows linearly from
+    `target / warmup_steps` to the target, step by step.
+
+    Argument:
+      batch_size: Int.
+      warmup_epochs: Int or Float. The whole warmup, the resumed epochs included.
+      base_batch_size: Int. The batch size which `lr` is tuned for.
+      steps_per_epoch: Int. Default from the `fit` params.
+      base_lr: Float. The unscaled lr, give it when resuming, the lr of a
+        h5 saved during the warmup is partly warmed.
+      initial_epoch: Int or Float. The warmup epochs already trained, the
+        ramp continues from there.
+      Log: Log or None.
+
+    Usage:
+    ```python
+      model.compile(optimizer=LARS(lr=0.1), ...)
+      warmup = LinearWarmup(4096, warmup_epochs=5)
+      model.fit(x, y, batch_size=4096, callbacks=[warmup])
+    ```
+
+    NOTE: The step counter is kept by the callback itself, so one instance
+    can be shared by several `fit(epochs=1)` calls.
+  """
+
+  def __init__(self, batch_size, warmup_epochs=5, base_batch_size=256, steps_per_epoch=None,
+               base_lr=None, initial_epoch=0, Log=None):
+    super().__init__()
+    self.batch_size = batch_size
+    self.warmup_epochs = warmup_epochs
+    self.base_batch_size = base_batch_size
+    self.steps_per_epoch = steps_per_epoch
+    self.base_lr = base_lr
+    self.initial_epoch = initial_epoch
+    self.Log = Log
+    self.target_lr = None
+    self._step = 0
+    self._warmup_steps = 0
+
+  def on_train_begin(self, logs=None):
+    if self.target_lr is not None:
+      return
+    lr = float(K.get_value(self.model.optimizer.lr)) if self.base_lr is None else float(self.base_lr)
+    self.target_lr = lr * self.batch_size / self.base_batch_size
+    steps = self.steps_per_epoch or self.params.get('steps')
+    if not steps:
+      steps = -(-self.params['samples'] // self.params.get('batch_size', self.batch_size))
+    self._warmup_steps = max(int(self.warmup_epochs * steps), 1)
+    self._step = min(int(self.initial_epoch * steps), self._warmup_steps)
+    if self.Log is not None:
+      self.Log(f'{lr} -> {self.target_lr} in {self._warmup_steps} steps, from step {self._step}',
+               _T='LR warmup:')
+
+  def on_batch_begin(self, batch, logs=None):
+    if self._step >= self._warmup_steps:
+      return
+    self._step += 1
+    K.set_value(self.model.optimizer.lr, self.target_lr * self._step / self._warmup_steps)
+
+
+class MagnitudePrune(Callback):
+  """
+    Unstructured magnitude pruning during (fine-)training
+
+    Every `frequency` steps the smallest `|w|` of each kernel are masked
+    out, the sparsity grows from 0 to `sparsity` between `begin_step` and
+    `end_step` (cubic, Zhu & Gupta 2017). The masks are applied after
+    every step, so the pruned weights stay zero.
+
+    Argument:
+      sparsity: Float. The final fraction of zeros of each kernel.
+      begin_step: Int.
+      end_step: Int. Default the steps of the first `fit`.
+      frequency: Int. Steps between the mask updates.
+      layers: List of Str. Names of the layers, default all Conv/Dense.
+
+    Usage:
+    ```python
+      prune = MagnitudePrune(0.75, frequency=100)
+      model.fit(x, y, epochs=2, callbacks=[prune])
+      prune.sparsity_of()  # {layer name: fraction of zeros}
+    ```
+  """
+
+  def __init__(self, sparsity, begin_step=0, end_step=None, frequency=100, layers=None):
+    super().__init__()
+    self.sparsity = sparsity
+    self.begin_step = begin_step
+    self.end_step = end_step
+    self.frequency = frequency
+    self.layers = layers
+    self.masks = {}
+    self._kernels = {}
+    self._step = 0
+
+  def on_train_begin(self, logs=None):
+    if self.end_step is None:
+      steps = self.params.get('steps')
+      if not steps:
+        steps = -(-self.params['samples'] // self.params['batch_size'])
+      self.end_step = self.begin_step + max(steps * self.params['epochs'] - 1, 1)
+    if self._kernels:
+      return
+    for layer in self.model.layers:
+      if self.layers is not None and layer.name not in self.layers:
+        continue
+      kernel = getattr(layer, 'depthwise_kernel', None)
+      if kernel is None:
+        kernel = getattr(layer, 'kernel', None)
+      if kernel is not None and type(layer).__name__ in ['Conv1D', 'Conv2D', 'Conv3D', 'Dense',
+                                                         'DepthwiseConv2D', 'GroupConv']:
+        self._kernels[layer.name] = kernel
+
+  def _target(self):
+    if self._step < self.begin_step:
+      return 0.
+    progress = min((self._step - self.begin_step) / max(self.end_step - self.begin_step, 1), 1.)
+    return self.sparsity * (1. - (1. - progress) ** 3)
+
+  def on_batch_end(self, batch, logs=None):
+    if self._step >= self.begin_step and (self._step - self.begin_step) % self.frequency == 0 \
+        or self._step == self.end_step:
+      target = self._target()
+      for name, kernel in self._kernels.items():
+        value = np.abs(K.get_value(kernel))
+        num = int(value.size * target)
+        if num:
+          threshold = np.partition(value.ravel(), num - 1)[num - 1]
+          self.masks[name] = (value > threshold).astype(value.dtype)
+    self._step += 1
+    if self.masks:
+      K.batch_set_value([(self._kernels[name], K.get_value(self._kernels[name]) * mask)
+                         for name, mask in self.masks.items()])
+
+  def sparsity_of(self):
+    """
+      {layer name: fraction of zeros of the kernel}
+    """
+    return {name: float(np.mean(K.get_value(kernel) == 0)) for name, kernel in self._kernels.items()}
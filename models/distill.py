@@ -0,0 +1,261 @@
+"""
+  知识蒸馏
+
+  The teacher runs once over the train set (and the recorded augmentation
+  seeds of each cached epoch), its log-probabilities are kept in a
+  memory-mapped store. The student trains against the store with the KD
+  loss, no teacher forward during the student steps.
+
+  The targets of the student are `[label, teacher log-probs...]`, so the
+  normal `fit`/`fit_generator` works with the arrays and the `DG` datasets.
+"""
+
+# pylint: disable=no-name-in-module
+
+import json
+import os
+
+import numpy as np
+import tensorflow as tf
+from tensorflow.python.keras import backend as K
+from tensorflow.python.keras.utils import Sequence
+from tensorflow.python.keras.utils.generic_utils import get_custom_objects
+
+
+# import setting
+__all__ = [
+  'kd_loss',
+  'kd_accuracy',
+  'TeacherStore',
+  'DistillSequence',
+]
+
+
+def kd_loss(temperature=4., alpha=0.5):
+  """
+    Knowledge distillation loss (Hinton et al., 2015)
+
+    `alpha * CE(label, p) + (1 - alpha) * T^2 * KL(softmax(t / T) || softmax(log p / T))`
+
+    `y_true` is `[label, teacher log-probs...]`, or only the label (e.g.
+    evaluating on the val set), then it is the plain CE.
+  """
+  temperature = float(temperature)
+  alpha = float(alpha)
+
+  def _kd_loss(y_true, y_pred):
+    label = y_true[:, :1]
+    ce = K.sparse_categorical_crossentropy(label, y_pred)
+    has_teacher = tf.shape(y_true)[1] > 1
+
+    def _kl():
+      teacher = K.softmax(y_true[:, 1:] / temperature)
+      student = tf.nn.log_softmax(K.log(K.clip(y_pred, K.epsilon(), 1.)) / temperature)
+      kl = K.sum(teacher * (K.log(K.clip(teacher, K.epsilon(), 1.)) - student), axis=-1)
+      return alpha * ce + (1. - alpha) * temperature ** 2 * kl
+
+    return tf.cond(has_teacher, _kl, lambda: ce)
+
+  _kd_loss.__name__ = 'kd_loss'
+  return _kd_loss
+
+
+def kd_accuracy(y_true, y_pred):
+  """
+    Accuracy of the label column of the KD targets
+  """
+  return K.cast(K.equal(K.cast(y_true[:, 0], 'int64'), K.argmax(y_pred, axis=-1)), K.floatx())
+
+
+# NOTE: the h5 of a student is saved with `loss: 'kd_loss'`, `load_model`
+# compiles it with the default T/alpha, `Args` compiles again with its own
+get_custom_objects().update({'kd_loss': kd_loss(), 'kd_accuracy': kd_accuracy})
+
+
+def _augment(aug, x, seeds):
+  """ImageDataGenerator transform of each sample, with the given seeds"""
+  x = np.asarray(x, dtype=K.floatx())
+  if aug is None:
+    return x
+  return np.stack([aug.standardize(aug.random_transform(xi, seed=int(s))) for xi, s in zip(x, seeds)])
+
+
+def _next_batch(generator, inx):
+  """DG returns an empty batch when it resets at the end, take the next one"""
+  x, y = generator[inx]
+  if not len(x):
+    x, y = generator[inx]
+  return x, y
+
+
+class TeacherStore(object):
+  """
+    Memory-mapped teacher log-probabilities
+
+    Files in `path`:
+      logits.npy: float16 (epochs, N, C), the teacher log-probs.
+      seeds.npy: int64 (epochs, N), the augmentation seed of each sample.
+      meta.json: how the store was built.
+
+    Usage:
+    ```python
+      store = TeacherStore('logs/teacher_resnet152')
+      if not store.exists(teacher='save_3.h5', num=50000, epochs=2, seed=0):
+        store.build(teacher, x=train_x, epochs=2, aug=AUG, meta={'teacher': 'save_3.h5'})
+      train = DistillSequence(store, x=train_x, y=train_y, batch_size=128, aug=AUG)
+    ```
+  """
+
+  def __init__(self, path):
+    self.path = path
+    self.logits = None
+    self.seeds = None
+    self.meta = {}
+
+  def exists(self, **meta):
+    """
+      True if the store was built with the same meta, and opened.
+    """
+    filename = os.path.join(self.path, 'meta.json')
+    if not os.path.exists(filename):
+      return False
+    with open(filename, 'r') as f:
+      self.meta = json.load(f)
+    if any(self.meta.get(k) != v for k, v in meta.items()) or not self.meta.get('done'):
+      return False
+    self.open()
+    return True
+
+  def open(self):
+    self.logits = np.load(os.path.join(self.path, 'logits.npy'), mmap_mode='r')
+    self.seeds = np.load(os.path.join(self.path, 'seeds.npy'), mmap_mode='r')
+    return self
+
+  def build(self, teacher, x=None, generator=None, num=None, epochs=1, aug=None, seed=0,
+            batch_size=256, meta=None, Log=print):
+    """
+      Run the teacher once per cached epoch, in the order of the data.
+
+      Argument:
+        teacher: A keras Model or NetWork, the outputs are the probabilities.
+        x: Array. The train inputs, or
+        generator: DG (without aug) of the train set, with `num` samples.
+        epochs: Int. The augmented epochs to cache, the student cycles them.
+        aug: ImageDataGenerator. The seed of epoch `e` sample `i` is
+          `seed + e * N + i`.
+        meta: Dict. Written to meta.json, checked by `exists`.
+    """
+    num = len(x) if x is not None else num
+    os.makedirs(self.path, exist_ok=True)
+    seeds = np.lib.format.open_memmap(os.path.join(self.path, 'seeds.npy'), mode='w+',
+                                      dtype='int64', shape=(epochs, num))
+    seeds[:] = seed + np.arange(epochs * num, dtype='int64').reshape(epochs, num)
+    logits = None
+    for e in range(epochs):
+      pos = 0
+      steps = -(-num // batch_size) if x is not None else len(generator)
+      for inx in range(steps):
+        if x is not None:
+          batch = x[pos:pos + batch_size]
+        else:
+          batch = _next_batch(generator, inx)[0]
+        batch = _augment(aug, batch, seeds[e, pos:pos + len(batch)])
+        prob = teacher.predict(batch, batch_size=len(batch), verbose=0)
+        if logits is None:
+          logits = np.lib.format.open_memmap(os.path.join(self.path, 'logits.npy'), mode='w+',
+                                             dtype='float16', shape=(epochs, num, prob.shape[-1]))
+        logits[e, pos:pos + len(batch)] = np.log(np.clip(prob, 1e-8, 1.))
+        pos += len(batch)
+      Log(f'[distill] teacher epoch {e + 1}/{epochs}: {pos} samples')
+    logits.flush()
+    seeds.flush()
+    del logits, seeds
+    self.meta = {**(meta or {}), 'num': num, 'epochs': epochs, 'seed': seed,
+                 'aug': aug is not None, 'done': True}
+    with open(os.path.join(self.path, 'meta.json'), 'w') as f:
+      json.dump(self.meta, f)
+    return self.open()
+
+
+class DistillSequence(Sequence):
+  """
+    The student train data, `(x, [label, teacher log-probs...])`
+
+    The inputs are augmented with the recorded seeds, so they are the
+    same as the teacher saw. The epoch `e` uses the cached epoch `e % epochs`.
+    The arrays are drawn in a new permutation every epoch (x, y, the seeds
+    and the logits through the same index), the generator in its order.
+
+    Argument:
+      store: An opened TeacherStore.
+      x, y: Arrays of the train set, or
+      generator: DG (without aug) of the train set.
+      seed: Int. The seed of the permutations.
+  """
+
+  def __init__(self, store, x=None, y=None, generator=None, batch_size=32, aug=None, seed=0):
+    self.store = store
+    self.x = x
+    self.y = y
+    self.generator = generator
+    self.batch_size = batch_size
+    self.aug = aug
+    self.num = store.logits.shape[1]
+    self.epoch = 0
+    self._pos = 0
+    self._rng = np.random.RandomState(seed)
+    self._index = self._rng.permutation(self.num) if generator is None else None
+
+  def __len__(self):
+    if self.generator is not None:
+      return len(self.generator)
+    return -(-self.num // self.batch_size)
+
+  def __getitem__(self, idx):
+    e = self.epoch % self.store.logits.shape[0]
+    if self.generator is not None:
+      # NOTE: DG reads the pkls in order, whatever the idx
+      if self._pos >= self.num:
+        self._pos = 0
+      x, y = _next_batch(self.generator, idx)
+      start = self._pos
+      self._pos += len(x)
+      index = slice(start, start + len(x))
+    else:
+      # NOTE: sorted in the batch, the memmaps read forward
+      index = np.sort(self._index[idx * self.batch_size:(idx + 1) * self.batch_size])
+      x, y = self.x[index], self.y[index]
+    x = _augment(self.aug, x, self.store.seeds[e, index])
+    label = np.asarray(y, dtype='float32').reshape(len(x), -1)
+    if label.shape[-1] > 1:
+      # one-hot
+      label = np.argmax(label, axis=-1)[:, None].astype('float32')
+    return x, np.concatenate([label, self.store.logits[e, index].astype('float32')], axis=-1)
+
+  def on_epoch_end(self):
+    self.epoch += 1
+    self._pos = 0
+    if self._index is not None:
+      self._index = self._rng.permutation(self.num)
+
+
+# test part
+if __name__ == "__main__":
+  import tempfile
+  from tensorflow.python.keras.layers import Dense, Flatten
+  from tensorflow.python.keras.models import Sequential, load_model
+  _x = np.random.rand(256, 8, 8, 3).astype('float32')
+  _y = np.random.randint(0, 10, (256, 1))
+  _teacher = Sequential([Flatten(input_shape=(8, 8, 3)), Dense(10, activation='softmax')])
+  with tempfile.TemporaryDirectory() as tmp:
+    _store = TeacherStore(tmp).build(_teacher, x=_x, epochs=2)
+    _train = DistillSequence(_store, x=_x, y=_y, batch_size=32)
+    _student = Sequential([Flatten(input_shape=(8, 8, 3)), Dense(10, activation='softmax')])
+    _student.compile(optimizer='adam', loss=kd_loss(2., 0.7), metrics=[kd_accuracy])
+    _student.fit_generator(_train, epochs=1, verbose=0)
+    _student.save(os.path.join(tmp, 'student.h5'))
+    # resume, as `Args` does with the h5 of the last run
+    _student = load_model(os.path.join(tmp, 'student.h5'))
+    _student.compile(optimizer=_student.optimizer, loss=kd_loss(2., 0.7), metrics=[kd_accuracy])
+    _student.fit_generator(_train, epochs=1, verbose=0)
+    print('resumed student, val (label only) [loss, accuracy]:', _student.evaluate(_x, _y, verbose=0))
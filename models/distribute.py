@@ -0,0 +1,208 @@
+"""
+  数据并行
+
+  Data-parallel training built on `tf.distribute`:
+    mirrored:     one process, N replicas on N GPUs, or N logical CPU devices
+                  if there are not enough GPUs.
+    multi-worker: N local processes, synchronized by collective all-reduce.
+"""
+
+# pylint: disable=no-name-in-module
+# pylint: disable=no-member
+
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+
+import numpy as np
+import tensorflow as tf
+from tensorflow.python.client import device_lib
+from tensorflow.python.keras import backend as K
+
+
+# import setting
+__all__ = [
+  'num_gpus',
+  'split_cpu',
+  'get_devices',
+  'get_strategy',
+  'is_worker',
+  'worker_index',
+  'num_workers',
+  'launch_workers',
+  'scaling_efficiency',
+  'benchmark_scaling',
+]
+
+
+def num_gpus():
+  """
+    Number of the local GPUs
+  """
+  config = tf.ConfigProto()
+  config.gpu_options.allow_growth = True
+  devices = device_lib.list_local_devices(session_config=config)
+  return len([d for d in devices if d.device_type == 'GPU'])
+
+
+def split_cpu(config, n):
+  """
+    Split the host into N logical CPU devices.
+
+    NOTE: Must be applied before the session is created.
+
+    Argument:
+      config: tf.ConfigProto.
+      n: Int.
+  """
+  config.device_count['CPU'] = n
+  return config
+
+
+def get_devices(n, ngpu=None):
+  """
+    Return N device names, GPUs first, logical CPUs otherwise.
+  """
+  ngpu = num_gpus() if ngpu is None else ngpu
+  if ngpu >= n:
+    return [f'/gpu:{i}' for i in range(n)]
+  return [f'/cpu:{i}' for i in range(n)]
+
+
+def is_worker():
+  """
+    Whether the process is a multi-worker process (TF_CONFIG is set)
+  """
+  return 'TF_CONFIG' in os.environ
+
+
+def worker_index():
+  """
+    The task index of the multi-worker process, 0 is the chief.
+  """
+  if not is_worker():
+    return 0
+  return json.loads(os.environ['TF_CONFIG'])['task']['index']
+
+
+def num_workers():
+  """
+    Number of the multi-worker processes, 1 if not multi-worker.
+  """
+  if not is_worker():
+    return 1
+  return len(json.loads(os.environ['TF_CONFIG'])['cluster']['worker'])
+
+
+def get_strategy(n, devices=None):
+  """
+    Get a distribution strategy.
+
+    Argument:
+      n: Int. Number of replicas.
+      devices: List of Str. Default `get_devices(n)`.
+
+    Return:
+      `MultiWorkerMirroredStrategy` if TF_CONFIG is set, else `MirroredStrategy`.
+  """
+  if is_worker():
+    return tf.distribute.experimental.MultiWorkerMirroredStrategy()
+  devices = devices or get_devices(n)
+  if hasattr(tf.distribute, 'MirroredStrategy'):
+    return tf.distribute.MirroredStrategy(devices=devices)
+  # tf 1.13
+  return tf.contrib.distribute.MirroredStrategy(devices=devices)
+
+
+def _free_port():
+  with socket.socket() as s:
+    s.bind(('localhost', 0))
+    return s.getsockname()[1]
+
+
+def launch_workers(n, in_args, script=None):
+  """
+    Launch N local multi-worker processes.
+
+    Each worker runs `main.py` with the same input args, the args are
+    written to its stdin (the `=>` prompt).
+
+    Return:
+      A list of `subprocess.Popen`, worker 0 is the chief.
+  """
+  script = script or os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'main.py')
+  workers = [f'localhost:{_free_port()}' for _ in range(n)]
+  procs = []
+  for i in range(n):
+    env = dict(os.environ)
+    env['TF_CONFIG'] = json.dumps({
+      'cluster': {'worker': workers},
+      'task': {'type': 'worker', 'index': i},
+    })
+    proc = subprocess.Popen([sys.executable, script], stdin=subprocess.PIPE, env=env)
+    proc.stdin.write((' '.join(in_args) + '\n').encode())
+    proc.stdin.close()
+    procs.append(proc)
+  return procs
+
+
+def scaling_efficiency(sps_1, sps_n, n):
+  """
+    Scaling efficiency of N replicas vs one replica.
+
+    Argument:
+      sps_1: Float. samples/sec of one replica.
+      sps_n: Float. samples/sec of N replicas.
+  """
+  return sps_n / (n * sps_1)
+
+
+def benchmark_scaling(model_fn, replicas=(1, 2, 4), batch_per_replica=32, steps=10,
+                      optimizer='sgd', loss='sparse_categorical_crossentropy', Log=print):
+  """
+    Measure the samples/sec of mirrored training for several numbers of
+    replicas, and the scaling efficiency vs one replica.
+
+    On a CPU machine, the host is split into N logical CPU devices.
+
+    Argument:
+      model_fn: Callable. Return a NetWork, e.g. `lambda: resnet50(DATAINFO=...)`.
+
+    Return:
+      Dict. {replicas: (samples/sec, efficiency)}
+  """
+  result = {}
+  for n in replicas:
+    K.clear_session()
+    config = tf.ConfigProto()
+    config.gpu_options.allow_growth = True
+    split_cpu(config, n)
+    K.set_session(tf.Session(config=config))
+
+    model = model_fn()
+    if n > 1:
+      model.XGPU = True
+      model.NGPU = n
+    model.build()
+    model.compile(optimizer=optimizer, loss=loss)
+
+    batch_size = batch_per_replica * n
+    x = np.random.rand(batch_size, *model.INPUT_SHAPE).astype('float32')
+    y = np.random.randint(model.NUM_CLASSES, size=(batch_size, 1))
+    model.fit(x, y, batch_size=batch_size, epochs=1, verbose=0)
+    start_time = time.perf_counter()
+    for _ in range(steps):
+      model.fit(x, y, batch_size=batch_size, epochs=1, verbose=0)
+    sps = batch_size * steps / (time.perf_counter() - start_time)
+    efficiency = scaling_efficiency(result[1][0], sps, n) if 1 in result else 1.
+    result[n] = (sps, efficiency)
+    Log(f'[scaling] replicas {n}: {sps:.2f} samples/sec, efficiency {efficiency:.2%}')
+  return result
+
+
+if __name__ == "__main__":
+  from hat.models.standard import lenet
+  benchmark_scaling(lambda: lenet(DATAINFO={'INPUT_SHAPE': (32, 32, 3), 'NUM_CLASSES': 10}))
@@ -0,0 +1,302 @@
+"""
+  本地SGD
+
+  K local trainer processes, each on its own data partition, train
+  independently and average their weights every N steps through shared
+  memory. Much less communication than the synchronous all-reduce, so
+  every core of a many-socket box can be used.
+
+  The trainers are `python -m hat.models.localsgd` subprocesses (a spawn
+  child would re-import main.py and build `Args()`). The weights table is
+  a memory-mapped file, the main process is the barrier: every trainer
+  writes its weights and says `sync` on stdout, the main process writes the
+  mean and answers `go` on stdin.
+"""
+
+# pylint: disable=no-name-in-module
+
+import inspect
+import json
+import math
+import os
+import pickle
+import shutil
+import subprocess
+import sys
+import tempfile
+
+import numpy as np
+
+
+# import setting
+__all__ = [
+  'LocalSGD',
+  'check_shard',
+  'flat_weights',
+  'unflat_weights',
+]
+
+
+def flat_weights(weights, out=None):
+  """
+    Flatten a list of np.array into a float32 vector.
+  """
+  if out is None:
+    out = np.empty(sum(w.size for w in weights), dtype='float32')
+  start = 0
+  for w in weights:
+    out[start:start + w.size] = w.ravel()
+    start += w.size
+  return out
+
+
+def unflat_weights(vector, weights):
+  """
+    Split a vector into a list of np.array, shaped as `weights`.
+  """
+  outputs = []
+  start = 0
+  for w in weights:
+    outputs.append(np.array(vector[start:start + w.size], dtype=w.dtype).reshape(w.shape))
+    start += w.size
+  return outputs
+
+
+def _cpu_chunk(rank, k):
+  """
+    The cores of the trainer, split the available cores into K chunks.
+  """
+  if not hasattr(os, 'sched_getaffinity'):
+    return []
+  cpus = sorted(os.sched_getaffinity(0))
+  size = max(len(cpus) // k, 1)
+  return cpus[rank * size:(rank + 1) * size] or cpus
+
+
+def check_shard(dataset):
+  """
+    Raise ValueError if the dataset can not be split for the trainers: the
+    generator datasets need `get_generator(batch_size, aug, shard)`.
+  """
+  if dataset.train_x is not None:
+    return
+  get_generator = getattr(dataset, 'get_generator', None)
+  if get_generator is None or 'shard' not in inspect.signature(get_generator).parameters:
+    raise ValueError(f'{type(dataset).__name__}.get_generator does not support `shard`, '
+                     'Local SGD needs a sharded generator (like imagenet) or the array datasets.')
+
+
+def _batches(dataset, rank, k, batch_size, aug):
+  """
+    Endless batches of the train shard of the trainer.
+  """
+  if dataset.train_x is None:
+    dataset.get_generator(batch_size, aug=aug, shard=(rank, k))
+    generator = dataset.trian_generator
+    while True:
+      for i in range(len(generator)):
+        yield generator[i]
+  x = dataset.train_x[rank::k]
+  y = dataset.train_y[rank::k]
+  if aug is not None:
+    flow = aug.flow(x, y, batch_size=batch_size, shuffle=True)
+    while True:
+      yield next(flow)
+  while True:
+    index = np.random.permutation(len(x))
+    for i in range(0, len(x) - batch_size + 1, batch_size):
+      yield x[index[i:i + batch_size]], y[index[i:i + batch_size]]
+
+
+def _trainer(rank, path):
+  """
+    The trainer process, `path` is the dir of `spec.pkl` and `weights.dat`.
+  """
+  # NOTE: the prints of the dataset/keras go to stderr, stdout is the protocol
+  _out = sys.stdout
+  sys.stdout = sys.stderr
+  with open(os.path.join(path, 'spec.pkl'), 'rb') as f:
+    spec = pickle.load(f)
+  k = spec['k']
+  cpus = _cpu_chunk(rank, k)
+  if cpus:
+    os.sched_setaffinity(0, cpus)
+
+  import tensorflow as tf
+  from tensorflow.python.keras import backend as K
+  config = tf.ConfigProto()
+  config.gpu_options.allow_growth = True
+  config.intra_op_parallelism_threads = len(cpus)
+  config.inter_op_parallelism_threads = 2
+  K.set_session(tf.Session(config=config))
+
+  # NOTE: import hat.models to register the custom objects
+  import hat.datasets
+  from hat.models.utils import MLib
+  np.random.seed(spec['seed'] + rank)
+  dataset = getattr(hat.datasets, spec['dataset'])()
+  if spec.get('exrgb'):
+    dataset.extend_rgb(spec['exrgb'])
+  model = getattr(MLib(spec['lib']), spec['model'])(DATAINFO=dataset.DATAINFO)
+  model.build()
+  model.compile(
+    optimizer=spec['opt'] or model.OPT,
+    loss=spec['loss'],
+    metrics=spec['metrics']
+  )
+  weights = model.model.get_weights()
+  size = sum(w.size for w in weights)
+  table = np.memmap(os.path.join(path, 'weights.dat'), dtype='float32', mode='r+', shape=(k + 1, size))
+  model.model.set_weights(unflat_weights(table[k], weights))
+
+  def _send(message):
+    _out.write(json.dumps(message) + '\n')
+    _out.flush()
+
+  def _average():
+    flat_weights(model.model.get_weights(), out=table[rank])
+    table.flush()
+    _send({'sync': rank})
+    if sys.stdin.readline().strip() != 'go':
+      # the main process stopped
+      sys.exit(1)
+    model.model.set_weights(unflat_weights(table[k], weights))
+
+  batches = _batches(dataset, rank, k, spec['batch_size'], spec['aug'])
+  step = 0
+  for epoch in range(spec['epochs']):
+    logs = []
+    for _ in range(spec['steps']):
+      logs.append(model.train_on_batch(*next(batches)))
+      step += 1
+      if step % spec['sync'] == 0:
+        _average()
+    _average()
+    _send({'epoch': epoch + 1, 'logs': np.mean(logs, axis=0).tolist()})
+  K.clear_session()
+
+
+class LocalSGD(object):
+  """
+    Local SGD Trainer
+
+    Each trainer process builds the model by itself (same lib & name),
+    loads its shard of the dataset (`x[rank::k]`, or the `DG` pkl shard)
+    and trains `steps` steps per epoch with `train_on_batch`. Every `sync`
+    steps and at the end of each epoch, the weights (including the BN
+    moving statistics) are averaged. The optimizer states stay local.
+
+    Argument:
+      model: NetWork. The built model of the main process, its weights are
+        the initial weights, and the merged weights are set back to it.
+      spec: Dict. dataset, lib, model, opt, loss, metrics, batch_size, and
+        exrgb (the `extend_rgb` k of the dataset, 0 means off).
+      k: Int. Number of trainer processes.
+      sync: Int. Average the weights every N steps.
+      aug: ImageDataGenerator or None.
+      seed: Int.
+
+    Usage:
+    ```python
+      trainer = LocalSGD(model, spec, k=4, sync=16)
+      for epoch, logs in trainer.fit(10, trainer.steps_per_epoch(dataset)):
+        ...
+      model.save('save_N.h5')
+    ```
+  """
+
+  def __init__(self, model, spec, k, sync=16, aug=None, seed=0):
+    self.model = model
+    self.spec = dict(spec, k=k, sync=sync, aug=aug, seed=seed)
+    self.k = k
+    self._weights = model.model.get_weights()
+    self._size = sum(w.size for w in self._weights)
+
+  def steps_per_epoch(self, dataset):
+    """
+      Steps of each trainer per epoch, the same for every trainer.
+    """
+    check_shard(dataset)
+    batch_size = self.spec['batch_size']
+    if dataset.train_x is None:
+      return max(math.ceil(dataset.NUM_TRAIN / self.k / batch_size), 1)
+    return max(len(dataset.train_x) // self.k // batch_size, 1)
+
+  def fit(self, epochs, steps):
+    """
+      Start the trainers, yield (epoch, [loss, metrics...]) averaged
+      over the trainers at the end of each epoch.
+    """
+    import hat
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        [os.path.dirname(os.path.dirname(os.path.abspath(hat.__file__))), env.get('PYTHONPATH', '')])
+    path = tempfile.mkdtemp(prefix='lsgd_')
+    with open(os.path.join(path, 'spec.pkl'), 'wb') as f:
+      pickle.dump(dict(self.spec, epochs=epochs, steps=steps), f)
+    table = np.memmap(os.path.join(path, 'weights.dat'), dtype='float32', mode='w+',
+                      shape=(self.k + 1, self._size))
+    flat_weights(self._weights, out=table[self.k])
+    table.flush()
+    procs = [subprocess.Popen([sys.executable, '-m', 'hat.models.localsgd', str(rank), path], env=env,
+                              stdin=subprocess.PIPE, stdout=subprocess.PIPE, universal_newlines=True)
+             for rank in range(self.k)]
+
+    def _receive():
+      """the next message of every trainer, in lockstep"""
+      messages = []
+      for proc in procs:
+        line = proc.stdout.readline()
+        if not line:
+          raise RuntimeError(f'Local SGD trainer failed, exit code {[p.wait() for p in procs]}')
+        messages.append(json.loads(line))
+      return messages
+
+    try:
+      for epoch in range(1, epochs + 1):
+        while True:
+          messages = _receive()
+          if 'epoch' in messages[0]:
+            break
+          # every trainer wrote its weights, write the mean and go on
+          table[self.k] = table[:self.k].mean(axis=0)
+          table.flush()
+          for proc in procs:
+            proc.stdin.write('go\n')
+            proc.stdin.flush()
+        yield epoch, np.mean([m['logs'] for m in messages], axis=0).tolist()
+      for proc in procs:
+        proc.wait()
+      self.model.model.set_weights(unflat_weights(np.array(table[self.k]), self._weights))
+    finally:
+      for proc in procs:
+        if proc.poll() is None:
+          proc.kill()
+          proc.wait()
+      del table
+      shutil.rmtree(path, ignore_errors=True)
+
+  def save(self, filepath):
+    """
+      Save the merged model in the normal h5 format.
+    """
+    self.model.save(filepath)
+
+
+if __name__ == "__main__":
+  if len(sys.argv) == 3:
+    # the trainer process of LocalSGD.fit
+    _trainer(int(sys.argv[1]), sys.argv[2])
+    sys.exit()
+  import hat.datasets
+  from hat.models.standard import lenet
+  dataset = hat.datasets.mnist()
+  model = lenet(DATAINFO=dataset.DATAINFO, built=True)
+  model.compile(optimizer='adam', loss='sparse_categorical_crossentropy', metrics=['accuracy'])
+  trainer = LocalSGD(model, {
+    'dataset': 'mnist', 'lib': 'S', 'model': 'lenet', 'opt': 'adam',
+    'loss': 'sparse_categorical_crossentropy', 'metrics': ['accuracy'], 'batch_size': 128,
+  }, k=2)
+  for epoch, logs in trainer.fit(1, trainer.steps_per_epoch(dataset)):
+    print(epoch, logs)
+  print(model.evaluate(dataset.val_x, dataset.val_y))
@@ -1,11 +1,14 @@
 # pylint: disable=unnecessary-pass
 # pylint: disable=no-name-in-module
 
+import contextlib
+
 import tensorflow as tf
 from tensorflow.python.keras import backend as K
-from tensorflow.python.keras.utils import multi_gpu_model
 from tensorflow.python.keras.models import load_model
 
+from hat.models.distribute import get_strategy, is_worker
+
 __all__ = [
   'NetWork'
 ]
@@ -33,6 +36,7 @@ class NetWork(object):
     self.LOAD = False
     self.model = None
     self.parallel_model = None
+    self.strategy = None
 
     self._kwargs = kwargs
     self._default_list = ['BATCH_SIZE', 'EPOCHS', 'OPT', 'LOSS_MODE', 'METRICS']
@@ -77,8 +81,8 @@ class NetWork(object):
       self.__dict__ = {**self.__dict__, **self._kwargs.pop('DATAINFO')}
     if 'XGPUINFO' in self._kwargs:
       self.__dict__ = {**self.__dict__, **self._kwargs.pop('XGPUINFO')}
-      if self.NGPU <= 1:
-        print(f'\n[WARNING] XGPU Failed. The Number of GPU(NGPU) must more than 1, got {self.NGPU} \n')
+      if self.NGPU <= 1 and not is_worker():
+        print(f'\n[WARNING] XGPU Failed. The Number of replicas(NGPU) must more than 1, got {self.NGPU} \n')
       else:
         self.XGPU = True
     self.__dict__ = {**self.__dict__, **self._kwargs}
@@ -111,26 +115,33 @@ class NetWork(object):
   def ginfo(self):
     return self._default_dict, self._dict
 
+  @contextlib.contextmanager
+  def scope(self):
+    """
+      The distribution strategy scope, do nothing if not XGPU.
+    """
+    if self.strategy is None:
+      yield
+    else:
+      with self.strategy.scope():
+        yield
+
   def build(self, filepath=''):
     """
       Build model
 
+      In XGPU mode, the model is built under a `tf.distribute` strategy,
+      mirrored across NGPU replicas (GPUs or logical CPU devices), or
+      multi-worker if TF_CONFIG is set.
+
       Argument:
         filepath: Str. If something, use this file path to load model.
     """
-    self._load_model(filepath)
     if self.XGPU:
-      try:
-        self.parallel_model = multi_gpu_model(
-          self.model,
-          gpus=self.NGPU,
-        )
-      except ValueError:
-        print(f'\n[WARNING] XGPU Failed. Check out the Numbers of GPU(NGPU), got {self.NGPU} \n')
-        self.XGPU = False
-        self.parallel_model = self.model
-    else:
-      self.parallel_model = self.model
+      self.strategy = get_strategy(self.NGPU)
+    with self.scope():
+      self._load_model(filepath)
+    self.parallel_model = self.model
 
   def compile(self,
               optimizer,
@@ -145,7 +156,10 @@ class NetWork(object):
     """
       Get compile function
     """
-    if not self.XGPU:
+    if self.strategy is not None and not hasattr(tf.distribute, 'MirroredStrategy'):
+      # NOTE: tf 1.13 uses the `distribute` argument instead of the scope
+      distribute = self.strategy
+    with self.scope():
       self.model.compile(
         optimizer=optimizer,
         loss=loss,
@@ -157,18 +171,6 @@ class NetWork(object):
         distribute=distribute,
         **kwargs
       )
-    if self.XGPU:
-      self.parallel_model.compile(
-        optimizer=optimizer,
-        loss=loss,
-        metrics=metrics,
-        loss_weights=loss_weights,
-        sample_weight_mode=sample_weight_mode,
-        weighted_metrics=weighted_metrics,
-        target_tensors=target_tensors,
-        distribute=distribute,
-        **kwargs
-      )
 
   def fit(self,
           x=None,
@@ -259,6 +261,21 @@ class NetWork(object):
       use_multiprocessing=use_multiprocessing
     )
 
+  def train_on_batch(self,
+                     x,
+                     y=None,
+                     sample_weight=None,
+                     class_weight=None):
+    """
+      Get train_on_batch function
+    """
+    return self.parallel_model.train_on_batch(
+      x,
+      y=y,
+      sample_weight=sample_weight,
+      class_weight=class_weight
+    )
+
   def fit_generator(self,
                     generator,
                     steps_per_epoch=None,
@@ -0,0 +1,196 @@
+"""
+  Session 配置
+
+  CPU thread pools, core pinning (per process) and the grappler optimizer
+  flags of the tf session, and a benchmark which sweeps the thread settings.
+"""
+
+# pylint: disable=no-name-in-module
+# pylint: disable=no-member
+
+import itertools
+import json
+import os
+import subprocess
+import sys
+import time
+
+import numpy as np
+import tensorflow as tf
+from tensorflow.core.protobuf import rewriter_config_pb2
+from tensorflow.python.keras import backend as K
+
+
+# import setting
+__all__ = [
+  'parse_cpus',
+  'numa_cpus',
+  'set_affinity',
+  'session_config',
+  'benchmark_threads',
+]
+
+
+_TOGGLE = {
+  'on': rewriter_config_pb2.RewriterConfig.ON,
+  'off': rewriter_config_pb2.RewriterConfig.OFF,
+  'aggressive': rewriter_config_pb2.RewriterConfig.AGGRESSIVE,
+}
+
+
+def parse_cpus(cpus):
+  """
+    Parse a cpu list, e.g. '0-3,8,10-11'.
+
+    Return:
+      A sorted list of Int.
+  """
+  result = set()
+  for item in str(cpus).split(','):
+    item = item.strip()
+    if not item:
+      continue
+    if '-' in item:
+      start, stop = item.split('-')
+      result.update(range(int(start), int(stop) + 1))
+    else:
+      result.add(int(item))
+  return sorted(result)
+
+
+def numa_cpus(node):
+  """
+    The cpus of a NUMA node (linux only), [] if not found.
+  """
+  filename = f'/sys/devices/system/node/node{node}/cpulist'
+  if not os.path.exists(filename):
+    return []
+  with open(filename, 'r') as f:
+    return parse_cpus(f.read())
+
+
+def set_affinity(cpus):
+  """
+    Pin the current process (and the threads created later) to the cpus.
+
+    Return:
+      True if pinned.
+  """
+  if not cpus or not hasattr(os, 'sched_setaffinity'):
+    return False
+  os.sched_setaffinity(0, cpus)
+  return True
+
+
+def session_config(intra=0, inter=0, layout='', remap='', constfold='', allow_growth=True):
+  """
+    Get a tf.ConfigProto.
+
+    Argument:
+      intra: Int. intra_op_parallelism_threads, 0 means the tf default.
+      inter: Int. inter_op_parallelism_threads, 0 means the tf default.
+      layout: Str. layout optimizer, 'on', 'off' or '' (tf default).
+      remap: Str. remapping optimizer, 'on', 'off' or ''.
+      constfold: Str. constant folding, 'on', 'off', 'aggressive' or ''.
+      allow_growth: Boolean. gpu memory.
+  """
+  config = tf.ConfigProto()
+  config.gpu_options.allow_growth = allow_growth
+  config.intra_op_parallelism_threads = int(intra or 0)
+  config.inter_op_parallelism_threads = int(inter or 0)
+  rewrite = config.graph_options.rewrite_options
+  for name, value in [['layout_optimizer', layout],
+                      ['remapping', remap],
+                      ['constant_folding', constfold]]:
+    if not value:
+      continue
+    if value not in _TOGGLE:
+      raise ValueError(f'{name} must be in {list(_TOGGLE)}, got {value}')
+    setattr(rewrite, name, _TOGGLE[value])
+  return config
+
+
+def _measure(spec):
+  """Train steps/sec of one thread setting, in this (fresh) process"""
+  K.set_session(tf.Session(config=session_config(spec['intra'], spec['inter'], **spec['kwargs'])))
+  from hat.models.utils import MLib
+  DATAINFO = dict(spec['DATAINFO'], INPUT_SHAPE=tuple(spec['DATAINFO']['INPUT_SHAPE']))
+  model = getattr(MLib(spec['lib']), spec['model'])(DATAINFO=DATAINFO)
+  model.build()
+  model.compile(optimizer=spec['optimizer'], loss=spec['loss'])
+  x = np.random.rand(spec['batch_size'], *model.INPUT_SHAPE).astype('float32')
+  y = np.random.randint(model.NUM_CLASSES, size=(spec['batch_size'], 1))
+  # warm up, the first step includes building the train function
+  model.train_on_batch(x, y)
+  start_time = time.perf_counter()
+  for _ in range(spec['steps']):
+    model.train_on_batch(x, y)
+  return spec['steps'] / (time.perf_counter() - start_time)
+
+
+def benchmark_threads(model, lib='S', DATAINFO=None, intra_list=None, inter_list=(1, 2), batch_size=32,
+                      steps=10, optimizer='sgd', loss='sparse_categorical_crossentropy', Log=print,
+                      **kwargs):
+  """
+    Sweep the thread settings, measure the train steps/sec of a model.
+
+    NOTE: TF1 creates the intra-op and the inter-op thread pools once per
+      process (with the first session), so every setting runs in a new
+      python process.
+
+    Argument:
+      model: Str. The model name of `lib`, e.g. 'resnet50'.
+      DATAINFO: Dict. INPUT_SHAPE & NUM_CLASSES.
+      intra_list: List of Int. Default 1, 2, 4... up to the available cores.
+      inter_list: List of Int.
+      kwargs: the other args of `session_config`, e.g. layout='off'.
+
+    Return:
+      (best (intra, inter), {(intra, inter): steps/sec})
+  """
+  if intra_list is None:
+    cores = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+    intra_list = [2 ** i for i in range(int(np.log2(cores)) + 1)]
+    if cores not in intra_list:
+      intra_list.append(cores)
+  DATAINFO = DATAINFO or {'INPUT_SHAPE': (32, 32, 3), 'NUM_CLASSES': 10}
+
+  import hat
+  env = dict(os.environ)
+  env['PYTHONPATH'] = os.pathsep.join(
+      [os.path.dirname(os.path.dirname(os.path.abspath(hat.__file__))), env.get('PYTHONPATH', '')])
+  result = {}
+  for intra, inter in itertools.product(intra_list, inter_list):
+    spec = {
+      'model': model,
+      'lib': lib,
+      'DATAINFO': {'INPUT_SHAPE': list(DATAINFO['INPUT_SHAPE']), 'NUM_CLASSES': DATAINFO['NUM_CLASSES']},
+      'intra': intra,
+      'inter': inter,
+      'batch_size': batch_size,
+      'steps': steps,
+      'optimizer': optimizer,
+      'loss': loss,
+      'kwargs': kwargs,
+    }
+    proc = subprocess.run([sys.executable, '-m', 'hat.models.session', '--measure', json.dumps(spec)],
+                          env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    if proc.returncode != 0:
+      Log(f'[threads] intra {intra}, inter {inter}: failed, {proc.stderr.strip().splitlines()[-1:]}')
+      continue
+    result[(intra, inter)] = json.loads(proc.stdout.strip().splitlines()[-1])['sps']
+    Log(f'[threads] intra {intra}, inter {inter}: {result[(intra, inter)]:.2f} steps/sec')
+  if not result:
+    raise RuntimeError('All the thread settings failed.')
+  best = max(result, key=result.get)
+  Log(f'[threads] best intra {best[0]}, inter {best[1]}: {result[best]:.2f} steps/sec')
+  return best, result
+
+
+if __name__ == "__main__":
+  if len(sys.argv) == 3 and sys.argv[1] == '--measure':
+    # the child process of benchmark_threads
+    print(json.dumps({'sps': _measure(json.loads(sys.argv[2]))}))
+    sys.exit()
+  print(parse_cpus('0-3,8,10-11'), numa_cpus(0))
+  benchmark_threads('lenet')
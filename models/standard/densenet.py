@@ -30,6 +30,8 @@ __all__ = [
   'densenet169_32',
   'densenet201_32',
   'densenet264_32',
+  'densenet264_e',
+  'densenet264_32_e',
 ]
 
 
@@ -38,11 +40,14 @@ class densenet(AdvNet):
     DenseNet-BC
   """
 
-  def __init__(self, blocks, k=12, theta=0.5, use_bias=False, name='', **kwargs):
+  def __init__(self, blocks, k=12, theta=0.5, use_bias=False, use_recompute=False, efficient=False,
+               name='', **kwargs):
     self.BLOCKS = blocks
     self.K = k
     self.THETA = theta
     self.BIAS = use_bias
+    self.RECOMPUTE = use_recompute
+    self.EFFICIENT = efficient
     self.NAME = name
     super().__init__(**kwargs)
 
@@ -52,6 +57,8 @@ class densenet(AdvNet):
     self.K = self.K
     self.THETA = self.THETA
     self.BIAS = self.BIAS
+    self.RECOMPUTE = self.RECOMPUTE
+    self.EFFICIENT = self.EFFICIENT
 
     self.CONV = 64
     self.CONV_SIZE = 7
@@ -62,13 +69,13 @@ class densenet(AdvNet):
 
     x = self.conv(x_in, self.CONV, self.CONV_SIZE, self.CONV_STEP)  #1
     
-    x = self.repeat(self._dense, self.BLOCKS[0], self.K)(x)  #2*n 12
+    x = self._dense_block(x, self.BLOCKS[0], self.K)  #2*n 12
     x = self._transition(x)  #1
-    x = self.repeat(self._dense, self.BLOCKS[1], self.K)(x)  #2*n 24
+    x = self._dense_block(x, self.BLOCKS[1], self.K)  #2*n 24
     x = self._transition(x)  #1
-    x = self.repeat(self._dense, self.BLOCKS[2], self.K)(x)  #2*n 48
+    x = self._dense_block(x, self.BLOCKS[2], self.K)  #2*n 48
     x = self._transition(x)  #1
-    x = self.repeat(self._dense, self.BLOCKS[3], self.K)(x)  #2*n 32
+    x = self._dense_block(x, self.BLOCKS[3], self.K)  #2*n 32
     
     x = self.bn(x)
     x = self.relu(x)
@@ -77,6 +84,34 @@ class densenet(AdvNet):
 
     return self.Model(inputs=x_in, outputs=x, name=self.NAME)
 
+  def _dense_block(self, x_in, times, k):
+
+    if not self.EFFICIENT:
+      dense = self.recompute(self._dense) if self.RECOMPUTE else self._dense
+      return self.repeat(dense, times, k)(x_in)
+
+    # Memory-efficient: keep the list of the k-channel features, the
+    # concat-BN-ReLU-1x1 bottleneck is recomputed in backward, so the
+    # concatenated maps are not stored at every depth. One concat at the end.
+    features = [x_in]
+    for i in range(times):
+      x = self.recompute(self._bottleneck)(features if len(features) > 1 else features[0], k)
+      x = self.bn(x)
+      x = self.relu(x)
+      x = self.conv(x, k, 3, use_bias=self.BIAS)
+      features.append(x)
+
+    return self.concat(features)
+
+  def _bottleneck(self, x_in, k):
+
+    x = self.concat(x_in) if isinstance(x_in, list) else x_in
+    x = self.bn(x)
+    x = self.relu(x)
+    x = self.conv(x, 4 * k, 1, use_bias=self.BIAS)
+
+    return x
+
   def _dense(self, x_in, k):
 
     x = self.bn(x_in)
@@ -344,7 +379,59 @@ def densenet264_32(**kwargs):
   )
 
 
+def densenet264_e(**kwargs):
+  """
+    DenseNet-264-BC, memory-efficient
+    ```
+    Blocks: [6, 12, 64, 48]
+    k     : 12
+    theta : 0.5
+    bias  : False
+    ```
+  """
+  return densenet(
+    blocks=[6, 12, 64, 48],
+    k=12,
+    theta=0.5,
+    use_bias=False,
+    efficient=True,
+    name='densenet264_e',
+    **kwargs
+  )
+
+
+def densenet264_32_e(**kwargs):
+  """
+    DenseNet-264-BC, memory-efficient
+    ```
+    Blocks: [6, 12, 64, 48]
+    k     : 32
+    theta : 0.5
+    bias  : False
+    ```
+  """
+  return densenet(
+    blocks=[6, 12, 64, 48],
+    k=32,
+    theta=0.5,
+    use_bias=False,
+    efficient=True,
+    name='densenet264_32_e',
+    **kwargs
+  )
+
+
 # test part
 if __name__ == "__main__":
   mod = densenet121_32(DATAINFO={'INPUT_SHAPE': (32, 32, 3), 'NUM_CLASSES': 10}, built=True)
   mod.summary()
+
+  # memory & throughput, the current builder vs the memory-efficient one
+  import multiprocessing
+  from hat.models.advance.recompute import measure_train
+  ctx = multiprocessing.get_context('spawn')
+  for name in ['densenet121', 'densenet264', 'densenet264_32']:
+    for efficient in [False, True]:
+      with ctx.Pool(1) as pool:
+        mem, step = pool.apply(measure_train, (name, 32), {'efficient': efficient})
+      print(f'{name}, efficient {efficient}: peak RSS {mem:.0f} MiB, {32 / step:.2f} samples/sec')
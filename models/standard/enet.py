@@ -38,7 +38,7 @@ class enet(AdvNet):
   """
   def __init__(self, width_coefficient=1, depth_coefficient=1, resolution=224, drop=0.2,
         depth_divisor=8, min_depth=None, id_skip=True, batch_norm_momentum=0.99,
-        batch_norm_epsilon=1e-3, name='', **kwargs):
+        batch_norm_epsilon=1e-3, use_recompute=False, name='', **kwargs):
     
     self.width_coefficient = width_coefficient
     self.depth_coefficient = depth_coefficient
@@ -49,6 +49,7 @@ class enet(AdvNet):
     self.id_skip = id_skip
     self.batch_norm_momentum = batch_norm_momentum
     self.batch_norm_epsilon = batch_norm_epsilon
+    self.RECOMPUTE = use_recompute
     self.name = name
     
     self.axis = -1
@@ -65,6 +66,7 @@ class enet(AdvNet):
     self.id_skip = self.id_skip
     self.batch_norm_momentum = self.batch_norm_momentum
     self.batch_norm_epsilon = self.batch_norm_epsilon
+    self.RECOMPUTE = self.RECOMPUTE
     self.name = self.name
 
     self.STEM_CONV = 32
@@ -280,8 +282,10 @@ class enet(AdvNet):
     """
     n = self._round_repeats(n, self.depth_coefficient)
     filters = self._round_filters(filters, self.width_coefficient, self.depth_divisor, self.min_depth)
-    x = self.MBConvBlock(x_in, filters, kernel_size, strides, expand_ratio, drop_connect_rate)
-    x = self.repeat(self.MBConvBlock, n-1, filters, kernel_size, 1, expand_ratio, drop_connect_rate)(x)
+    # NOTE: DropConnect would draw a new mask in the recomputation
+    block = self.recompute(self.MBConvBlock) if self.RECOMPUTE and not drop_connect_rate else self.MBConvBlock
+    x = block(x_in, filters, kernel_size, strides, expand_ratio, drop_connect_rate)
+    x = self.repeat(block, n-1, filters, kernel_size, 1, expand_ratio, drop_connect_rate)(x)
     return x
 
 
@@ -77,10 +77,11 @@ class resnet(AdvNet):
     ResNet
   """
 
-  def __init__(self, times, use_se=False, use_group=False, name='', **kwargs):
+  def __init__(self, times, use_se=False, use_group=False, use_recompute=False, name='', **kwargs):
     self.RES_TIMES = times
     self.USE_SE = use_se
     self.USE_GROUP = use_group
+    self.RECOMPUTE = use_recompute
     self.NAME = name
     super().__init__(**kwargs)
 
@@ -89,6 +90,7 @@ class resnet(AdvNet):
     self.RES_TIMES = self.RES_TIMES
     self.USE_SE = self.USE_SE
     self.USE_GROUP = self.USE_GROUP
+    self.RECOMPUTE = self.RECOMPUTE
 
     self.CONV_F = 64
     self.CONV_SIZE = 7
@@ -130,8 +132,9 @@ class resnet(AdvNet):
     return self.Model(inputs=x_in, outputs=x, name=self.NAME)
 
   def _block(self, x_in, times, filters1, filters2, strides=2):
-    x = self._bottle(x_in, filters1, filters2, strides=strides, _t=True)
-    x = self.repeat(self._bottle, times - 1, filters1, filters2)(x)
+    bottle = self.recompute(self._bottle) if self.RECOMPUTE else self._bottle
+    x = bottle(x_in, filters1, filters2, strides=strides, _t=True)
+    x = self.repeat(bottle, times - 1, filters1, filters2)(x)
     return x
 
   def _bottle(self, x_in, filters1, filters2, strides=1, _t=False):
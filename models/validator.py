@@ -0,0 +1,249 @@
+"""
+  异步验证
+
+  After each epoch, the weights are saved as a snapshot and evaluated by a
+  worker process on spare cores, while the next epoch is training.
+
+  The workers are `python -m hat.models.validator` subprocesses (not a
+  multiprocessing Pool, whose spawn children would re-import main.py and
+  build `Args()`), the jobs and results are json lines on stdin/stdout.
+"""
+
+# pylint: disable=no-name-in-module
+# pylint: disable=global-statement
+
+import collections
+import json
+import math
+import os
+import subprocess
+import sys
+import threading
+
+import numpy as np
+
+
+# import setting
+__all__ = [
+  'AsyncValidator',
+  'val_subsample',
+]
+
+
+# worker envs
+_DATASET = None
+_SUBSAMPLE = 0
+_INDEX = None
+
+
+def val_subsample(num, subsample, seed=0):
+  """
+    Get the fixed subsample index of the val set.
+
+    Return:
+      A sorted np.array, or None if subsample is 0 or not less than num.
+  """
+  if not subsample or subsample >= num:
+    return None
+  return np.sort(np.random.RandomState(seed).choice(num, subsample, replace=False))
+
+
+def _init_worker(dataset_name, subsample, seed):
+  """
+    Load the dataset once per worker process
+  """
+  global _DATASET, _SUBSAMPLE, _INDEX
+  # NOTE: import hat.models to register the custom objects
+  import hat.datasets
+  import hat.models  # pylint: disable=unused-import
+  _DATASET = getattr(hat.datasets, dataset_name)()
+  _SUBSAMPLE = subsample
+  if _DATASET.val_x is not None:
+    _INDEX = val_subsample(len(_DATASET.val_x), subsample, seed)
+
+
+def _evaluate(filename, batch_size, full):
+  """
+    Evaluate a snapshot, return [loss, accuracy]
+  """
+  from tensorflow.python.keras import backend as K
+  from tensorflow.python.keras.models import load_model
+  model = load_model(filename)
+  if _DATASET.val_x is None:
+    _DATASET.get_generator(batch_size)
+    steps = None if full or not _SUBSAMPLE else math.ceil(_SUBSAMPLE / batch_size)
+    result = model.evaluate_generator(_DATASET.val_generator, steps=steps)
+  elif full or _INDEX is None:
+    result = model.evaluate(_DATASET.val_x, _DATASET.val_y, batch_size=batch_size, verbose=0)
+  else:
+    result = model.evaluate(_DATASET.val_x[_INDEX], _DATASET.val_y[_INDEX],
+                            batch_size=batch_size, verbose=0)
+  K.clear_session()
+  return [float(i) for i in result]
+
+
+class _Job(object):
+  """A submitted snapshot, `get` waits for its [loss, accuracy]"""
+
+  def __init__(self):
+    self.result = None
+    self.error = None
+    self._event = threading.Event()
+
+  def done(self, result=None, error=None):
+    self.result, self.error = result, error
+    self._event.set()
+
+  def ready(self):
+    return self._event.is_set()
+
+  def get(self, timeout=None):
+    if not self._event.wait(timeout):
+      raise TimeoutError(f'No val result after {timeout} seconds')
+    if self.error is not None:
+      raise RuntimeError(f'Validator: {self.error}')
+    return self.result
+
+
+class _Worker(object):
+  """A validator subprocess, evaluates its jobs one by one in order"""
+
+  def __init__(self, dataset_name, subsample, seed, env):
+    self.jobs = collections.deque()
+    self._lock = threading.Lock()
+    self._proc = subprocess.Popen(
+      [sys.executable, '-m', 'hat.models.validator', dataset_name, str(subsample), str(seed)],
+      env=env, stdin=subprocess.PIPE, stdout=subprocess.PIPE, universal_newlines=True)
+    self._thread = threading.Thread(target=self._read, daemon=True)
+    self._thread.start()
+
+  def _read(self):
+    for line in self._proc.stdout:
+      message = json.loads(line)
+      with self._lock:
+        job = self.jobs.popleft()
+      job.done(message.get('result'), message.get('error'))
+    # EOF, the worker exited
+    with self._lock:
+      jobs, self.jobs = list(self.jobs), collections.deque()
+    for job in jobs:
+      job.done(error=f'the worker exited with code {self._proc.wait()}')
+
+  def submit(self, filename, batch_size, full):
+    job = _Job()
+    with self._lock:
+      self.jobs.append(job)
+    try:
+      self._proc.stdin.write(json.dumps({'filename': filename, 'batch_size': batch_size, 'full': full}) + '\n')
+      self._proc.stdin.flush()
+    except OSError as e:
+      job.done(error=f'the worker is gone, {e}')
+    return job
+
+  def close(self, timeout=60):
+    try:
+      self._proc.stdin.close()
+    except OSError:
+      pass
+    try:
+      self._proc.wait(timeout)
+    except subprocess.TimeoutExpired:
+      self._proc.kill()
+      self._proc.wait()
+    self._thread.join()
+
+
+class AsyncValidator(object):
+  """
+    Asynchronous Validator
+
+    Argument:
+      dataset_name: Str. The worker loads the dataset by itself.
+      batch_size: Int.
+      snapshot_dir: Str. Where the snapshot h5 are saved (removed after evaluated).
+      subsample: Int. Number of val samples for the intermediate estimates, 0 means all.
+      seed: Int. Seed of the fixed subsample.
+      processes: Int. Number of worker processes.
+      timeout: Float. Seconds `poll(wait=True)` waits for a result, then
+        raises TimeoutError.
+
+    Usage:
+    ```python
+      validator = AsyncValidator('cifar10', 128, 'logs/xxx', subsample=2000)
+      validator.submit(1, model, full=False)
+      for epoch, result, weights, full in validator.poll():
+        ...
+      validator.close()
+    ```
+  """
+
+  def __init__(self, dataset_name, batch_size, snapshot_dir, subsample=0, seed=0, processes=1,
+               timeout=3600):
+    self.batch_size = batch_size
+    self.snapshot_dir = snapshot_dir
+    self.timeout = timeout
+    self._pending = []
+    # NOTE: a new process gets a clean tensorflow runtime
+    import hat
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        [os.path.dirname(os.path.dirname(os.path.abspath(hat.__file__))), env.get('PYTHONPATH', '')])
+    self._workers = [_Worker(dataset_name, subsample, seed, env) for _ in range(processes)]
+
+  def submit(self, epoch, model, full=True):
+    """
+      Snapshot the weights of the NetWork and evaluate them asynchronously.
+    """
+    filename = os.path.join(self.snapshot_dir, f'_val_snapshot_{epoch}{"" if full else "_sub"}.h5')
+    model.save(filename)
+    worker = min(self._workers, key=lambda w: len(w.jobs))
+    result = worker.submit(filename, self.batch_size, full)
+    self._pending.append((epoch, result, filename, model.model.get_weights(), full))
+
+  def poll(self, wait=False):
+    """
+      Collect the finished results.
+
+      Argument:
+        wait: Boolean. If True, wait for all the pending results, at most
+          `timeout` seconds each.
+
+      Return:
+        A list of (epoch, [loss, accuracy], weights, full), sorted by epoch.
+    """
+    done = []
+    pending = []
+    for item in self._pending:
+      epoch, result, filename, weights, full = item
+      if wait or result.ready():
+        done.append((epoch, result.get(self.timeout), weights, full))
+        if os.path.exists(filename):
+          os.remove(filename)
+      else:
+        pending.append(item)
+    self._pending = pending
+    return sorted(done, key=lambda i: i[0])
+
+  @property
+  def pending(self):
+    return len(self._pending)
+
+  def close(self):
+    for worker in self._workers:
+      worker.close()
+
+
+if __name__ == "__main__":
+  # the worker process of AsyncValidator
+  _out = sys.stdout
+  # NOTE: the prints of the dataset/keras go to stderr, stdout is the results
+  sys.stdout = sys.stderr
+  _init_worker(sys.argv[1], int(sys.argv[2]), int(sys.argv[3]))
+  for _line in sys.stdin:
+    _job = json.loads(_line)
+    try:
+      _message = {'result': _evaluate(_job['filename'], _job['batch_size'], _job['full'])}
+    except Exception as e:  # pylint: disable=broad-except
+      _message = {'error': f'{type(e).__name__}: {e}'}
+    _out.write(json.dumps(_message) + '\n')
+    _out.flush()
@@ -0,0 +1,135 @@
+"""
+  XLA JIT
+
+  Opt-in XLA JIT compilation of the session (train step, evaluate and
+  `NetWork.predict`), fusing the small ops such as BN+ReLU, Swish+SE and
+  the reshapes of Shuffle. Models with custom layers XLA can not compile
+  fall back to the normal session.
+"""
+
+# pylint: disable=no-name-in-module
+# pylint: disable=no-member
+
+import time
+
+import numpy as np
+import tensorflow as tf
+from tensorflow.python.keras import backend as K
+from tensorflow.python.keras.models import Model
+
+from hat.models.session import session_config
+
+
+# import setting
+__all__ = [
+  'XLA_UNSUPPORTED',
+  'set_jit',
+  'unsupported_layers',
+  'xla_probe',
+  'benchmark_xla',
+]
+
+
+# custom layers which break the XLA clusters, e.g. `DropConnect` draws the
+# random mask of dynamic shape.
+XLA_UNSUPPORTED = ['ExtendRGB', 'DropConnect']
+
+
+def set_jit(config, level='ON_1'):
+  """
+    Turn on the global XLA JIT of a tf.ConfigProto.
+
+    Argument:
+      level: Str. 'ON_1' or 'ON_2', 'OFF' turns it off.
+  """
+  config.graph_options.optimizer_options.global_jit_level = getattr(tf.OptimizerOptions, level)
+  return config
+
+
+def unsupported_layers(model, unsupported=None):
+  """
+    Names of the layers (including nested models) XLA can not compile.
+  """
+  unsupported = XLA_UNSUPPORTED if unsupported is None else unsupported
+  names = []
+  for layer in model.layers:
+    if isinstance(layer, Model):
+      names.extend(unsupported_layers(layer, unsupported))
+    elif type(layer).__name__ in unsupported:
+      names.append(layer.name)
+  return names
+
+
+def xla_probe(model):
+  """
+    Run one predict step, return '' if XLA compiles the model, else the error.
+  """
+  x = np.zeros((1, *model.INPUT_SHAPE), dtype='float32')
+  try:
+    model.predict(x, verbose=0)
+  except (tf.errors.InvalidArgumentError,
+          tf.errors.UnimplementedError,
+          tf.errors.InternalError) as e:
+    return f'{type(e).__name__}: {e.message.splitlines()[0]}'
+  return ''
+
+
+def _steps_per_sec(model_fn, jit, batch_size, steps, mode):
+  K.clear_session()
+  config = session_config()
+  if jit:
+    set_jit(config)
+  K.set_session(tf.Session(config=config))
+  model = model_fn()
+  model.build()
+  model.compile(optimizer='sgd', loss='sparse_categorical_crossentropy')
+  if jit and unsupported_layers(model.model):
+    return None
+  x = np.random.rand(batch_size, *model.INPUT_SHAPE).astype('float32')
+  y = np.random.randint(model.NUM_CLASSES, size=(batch_size, 1))
+  func = (lambda: model.train_on_batch(x, y)) if mode == 'train' else (lambda: model.model.predict_on_batch(x))
+  # warm up, the first step includes building the function (and compiling)
+  func()
+  start_time = time.perf_counter()
+  for _ in range(steps):
+    func()
+  return steps / (time.perf_counter() - start_time)
+
+
+def benchmark_xla(names, lib='S', DATAINFO=None, batch_size=32, steps=10, Log=print):
+  """
+    Steps/sec with and without XLA JIT of several models (train & predict).
+
+    Argument:
+      names: List of Str. Model names of the lib.
+      lib: Str. Model lib.
+      DATAINFO: Dict. Default cifar10 shape.
+
+    Return:
+      List of Str, the benchmark table.
+  """
+  from hat.models.utils import MLib
+  lib = MLib(lib)
+  DATAINFO = DATAINFO or {'INPUT_SHAPE': (32, 32, 3), 'NUM_CLASSES': 10}
+  table = [
+    '| model | mode | no-jit steps/sec | jit steps/sec | speedup |',
+    '| --- | --- | --- | --- | --- |',
+  ]
+  for name in names:
+    model_fn = lambda: getattr(lib, name)(DATAINFO=DATAINFO)  # pylint: disable=cell-var-from-loop
+    for mode in ['train', 'predict']:
+      base = _steps_per_sec(model_fn, False, batch_size, steps, mode)
+      jit = _steps_per_sec(model_fn, True, batch_size, steps, mode)
+      if jit is None:
+        table.append(f'| {name} | {mode} | {base:.2f} | fallback | - |')
+      else:
+        table.append(f'| {name} | {mode} | {base:.2f} | {jit:.2f} | {jit / base:.2f}x |')
+      Log(table[-1])
+  K.clear_session()
+  return table
+
+
+if __name__ == "__main__":
+  print('\n'.join(benchmark_xla([
+    'mlp', 'lenet', 'alexnet', 'vgg16', 'resnet50', 'resnext50', 'densenet121',
+    'mobilenetv2', 'enetb0'])))
@@ -0,0 +1,26 @@
+'''
+  tools 子包的init文件
+
+  导出/部署相关的工具，在训练好的模型上做一次性的变换。
+
+  NOTE: 工具模块在第一次用到时才导入(`hat.tools.prune_report`,
+  `from hat.tools import *`)，`import hat.tools.npnet` 不会导入 TensorFlow。
+'''
+
+import importlib as _importlib
+
+
+# the tool modules, their `__all__` are the names of this package
+_MODULES = ['bench', 'graph', 'fold', 'predict', 'quantize', 'lowrank', 'prune', 'cascade', 'ensemble', 'npnet']
+
+
+def __getattr__(name):
+  if name == '__all__':
+    # `from hat.tools import *`
+    return [n for m in _MODULES for n in _importlib.import_module(f'hat.tools.{m}').__all__]
+  for m in _MODULES:
+    module = _importlib.import_module(f'hat.tools.{m}')
+    if name in module.__all__:
+      globals()[name] = getattr(module, name)
+      return globals()[name]
+  raise AttributeError(f"module 'hat.tools' has no attribute '{name}'")
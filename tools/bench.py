@@ -0,0 +1,98 @@
+"""
+  Bench
+
+  The shared measurements of the tool reports: the latency (ms per batch,
+  ms per image), the top-1 and the fixed samples of the val split.
+
+  NumPy only, `func` is any predict callable, e.g. `model.predict_on_batch`.
+"""
+
+import time
+
+import numpy as np
+
+
+# import setting
+__all__ = [
+  'ms_per_batch',
+  'ms_per_image',
+  'top1',
+  'val_sample',
+  'split_val',
+]
+
+
+def ms_per_batch(func, x, steps=20):
+  """
+    Mean latency (ms) of `func(x)` on the whole batch, after one warm-up call.
+  """
+  func(x)
+  start_time = time.perf_counter()
+  for _ in range(steps):
+    func(x)
+  return (time.perf_counter() - start_time) / steps * 1000
+
+
+def ms_per_image(func, x, steps=50):
+  """
+    Mean latency (ms) of `func` on one image, the images of `x` in turn.
+  """
+  func(x[:1])
+  start_time = time.perf_counter()
+  for i in range(steps):
+    func(x[i % len(x):i % len(x) + 1])
+  return (time.perf_counter() - start_time) / steps * 1000
+
+
+def top1(y_pred, y_true):
+  """
+    Top-1 accuracy, `y_true` is sparse or one-hot.
+  """
+  y_true = np.asarray(y_true)
+  if y_true.ndim > 1 and y_true.shape[-1] > 1:
+    y_true = np.argmax(y_true, axis=-1)
+  return float(np.mean(np.argmax(y_pred, axis=-1) == y_true.reshape(-1)))
+
+
+def val_sample(dataset, num, batch_size=32, seed=0, skip=0):
+  """
+    A fixed sample of the val split, (x, y), from the arrays or the generator.
+
+    `skip` samples of the same order are left out first, e.g.
+    `val_sample(dataset, 200, skip=1000)` is disjoint from `val_sample(dataset, 1000)`.
+  """
+  if dataset.val_x is not None:
+    index = np.random.RandomState(seed).permutation(len(dataset.val_x))[skip:skip + num]
+    return np.asarray(dataset.val_x[index], dtype='float32'), np.asarray(dataset.val_y[index])
+  dataset.get_generator(batch_size)
+  xs, ys = [], []
+  for i in range(len(dataset.val_generator)):
+    x, y = dataset.val_generator[i]
+    xs.append(x)
+    ys.append(y)
+    if sum(len(j) for j in xs) >= skip + num:
+      break
+  return np.concatenate(xs)[skip:skip + num].astype('float32'), np.concatenate(ys)[skip:skip + num]
+
+
+def split_val(dataset, num, other, batch_size=32, seed=0):
+  """
+    Two disjoint samples of the val split, `num` and `other` samples. If
+    the val split is smaller than `num + other`, it is shared between them
+    in that proportion.
+
+    Return:
+      ((x, y), (other_x, other_y))
+  """
+  total = len(dataset.val_x) if dataset.val_x is not None else getattr(dataset, 'NUM_VAL', 0)
+  if total and num + other > total:
+    num = min(max(int(round(total * num / (num + other))), 1), total)
+    other = total - num
+  first = val_sample(dataset, num, batch_size, seed)
+  return first, val_sample(dataset, other, batch_size, seed, skip=len(first[0]))
+
+
+# test part
+if __name__ == "__main__":
+  x = np.random.rand(8, 4).astype('float32')
+  print(top1(x, np.argmax(x, axis=-1)), f'{ms_per_batch(lambda i: i @ i.T, x):.3f} ms/batch')
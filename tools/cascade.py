@@ -0,0 +1,229 @@
+"""
+  Cascade
+
+  Chain the models of the zoo trained on the same dataset, from the
+  cheapest to the largest, e.g. `lenet -> resnet50 -> resnet152`. A sample
+  is answered by the first model whose softmax confidence (the max prob)
+  passes the threshold of its stage, the uncertain samples are escalated
+  to the next model in one batch. The last stage answers all the rest.
+
+  The thresholds are calibrated on the val split for a target top-1
+  (`calibrate`), `cascade_report` gives the top-1, the expected FLOPs and
+  latency vs always using the largest model on held-out val samples.
+"""
+
+# pylint: disable=no-name-in-module
+
+import json
+import time
+
+import numpy as np
+from tensorflow.python.keras import backend as K
+from tensorflow.python.keras.models import load_model
+
+from hat.models.network import NetWork
+from hat.tools.bench import ms_per_batch, top1, val_sample
+
+
+# import setting
+__all__ = [
+  'Cascade',
+  'calibrate',
+  'cascade_report',
+]
+
+
+class Cascade(object):
+  """
+    Confidence-based cascade of keras models.
+
+    Argument:
+      models: List of keras Models (or NetWork), cheapest first.
+      thresholds: List of Float, one per stage except the last. Default 1.0
+        (only the fully confident samples stop early).
+
+    Usage:
+    ```python
+      cascade = Cascade.load(['lenet.h5', 'resnet50.h5', 'resnet152.h5'], 'cascade.json')
+      probs, stages = cascade.predict(x)
+    ```
+  """
+
+  def __init__(self, models, thresholds=None):
+    self.models = [getattr(m, 'model', m) for m in models]
+    thresholds = list(thresholds) if thresholds is not None else [1.] * (len(models) - 1)
+    if len(thresholds) != len(models) - 1:
+      raise ValueError(f'Need {len(models) - 1} thresholds, got {len(thresholds)}')
+    self.thresholds = thresholds
+
+  @classmethod
+  def load(cls, filepaths, thresholds=None):
+    """
+      Argument:
+        thresholds: List of Float, or the json path written by `cascade_report`.
+    """
+    if isinstance(thresholds, str):
+      with open(thresholds, 'r') as f:
+        thresholds = json.load(f)['thresholds']
+    return cls([load_model(i, compile=False) for i in filepaths], thresholds)
+
+  def predict(self, x, batch_size=32):
+    """
+      Return:
+        (probs, stages)
+        probs: Array (N, C), the probs of the answering model.
+        stages: Array (N,), the index of the answering model.
+    """
+    index = np.arange(len(x))
+    probs = None
+    stages = np.full(len(x), len(self.models) - 1, dtype='int32')
+    for stage, model in enumerate(self.models):
+      prob = model.predict(x[index], batch_size=batch_size)
+      if probs is None:
+        probs = np.zeros((len(x), prob.shape[-1]), dtype=prob.dtype)
+      if stage == len(self.models) - 1:
+        probs[index] = prob
+        break
+      done = prob.max(axis=-1) >= self.thresholds[stage]
+      probs[index[done]] = prob[done]
+      stages[index[done]] = stage
+      index = index[~done]
+      if not len(index):
+        break
+    return probs, stages
+
+
+def _route(confs, thresholds):
+  """The answering stage of each sample, thresholds + [0] for the last"""
+  stages = np.full(confs.shape[1], len(confs) - 1, dtype='int32')
+  undecided = np.ones(confs.shape[1], dtype=bool)
+  for stage, threshold in enumerate(thresholds):
+    done = undecided & (confs[stage] >= threshold)
+    stages[done] = stage
+    undecided &= ~done
+  return stages
+
+
+def calibrate(probs, y_true, target, grid=np.linspace(0., 1., 201)):
+  """
+    Pick the thresholds, stage by stage from the cheapest, as the lowest
+    grid value whose cascade top-1 is still at least `target` (the later
+    stages escalate everything while it is picked).
+
+    Argument:
+      probs: List of Array (N, C), the val probs of every model.
+      target: Float. The target top-1 of the cascade.
+
+    Return:
+      (thresholds, stages of the val samples, top-1)
+  """
+  y_true = np.asarray(y_true)
+  if y_true.ndim > 1 and y_true.shape[-1] > 1:
+    y_true = np.argmax(y_true, axis=-1)
+  y_true = y_true.reshape(-1)
+  confs = np.stack([p.max(axis=-1) for p in probs])
+  correct = np.stack([np.argmax(p, axis=-1) == y_true for p in probs])
+
+  def _acc(thresholds):
+    stages = _route(confs, thresholds)
+    return float(np.mean(correct[stages, np.arange(len(y_true))])), stages
+
+  # inf: never answer
+  thresholds = [np.inf] * (len(probs) - 1)
+  for stage in range(len(thresholds)):
+    for value in grid:
+      thresholds[stage] = float(value)
+      if _acc(thresholds)[0] >= target:
+        break
+    else:
+      thresholds[stage] = np.inf
+  acc, stages = _acc(thresholds)
+  return [t if np.isfinite(t) else 1.01 for t in thresholds], stages, acc
+
+
+def _file_flops(filepath):
+  """FLOPs via NetWork.flops, in a fresh graph"""
+  K.clear_session()
+  net = NetWork()
+  net.build(filepath)
+  return net.flops()
+
+
+def cascade_report(filepaths, dataset, target=None, max_drop=0.005, batch_size=32, num_val=1000,
+                   out=None, Log=print):
+  """
+    Calibrate the thresholds of a cascade on one half of a val sample and
+    report the top-1 and the expected FLOPs/latency vs the last (largest)
+    model on the other half.
+
+    Argument:
+      filepaths: List of Str, the h5 of the models, cheapest first.
+      target: Float. The target top-1, default the top-1 of the largest
+        model (on the calibration half) minus `max_drop`.
+      out: Str. If something, write the thresholds json.
+
+    Return:
+      (thresholds, the report table)
+  """
+  val_x, val_y = val_sample(dataset, num_val)
+  # NOTE: calibrate on one half, report on the other
+  half = len(val_x) // 2
+  cal_x, cal_y, val_x, val_y = val_x[:half], val_y[:half], val_x[half:], val_y[half:]
+  flops = [_file_flops(i) for i in filepaths]
+  K.clear_session()
+  K.set_learning_phase(0)
+  cascade = Cascade.load(filepaths)
+  cal_probs = [m.predict(cal_x, batch_size=batch_size) for m in cascade.models]
+  target = top1(cal_probs[-1], cal_y) - max_drop if target is None else target
+  thresholds = calibrate(cal_probs, cal_y, target)[0]
+  cascade.thresholds = thresholds
+
+  probs = [m.predict(val_x, batch_size=batch_size) for m in cascade.models]
+  ms = [ms_per_batch(m.predict_on_batch, val_x[:batch_size]) for m in cascade.models]
+  accs = [top1(p, val_y) for p in probs]
+  start_time = time.perf_counter()
+  cascade_probs, stages = cascade.predict(val_x, batch_size=batch_size)
+  cascade_time = time.perf_counter() - start_time
+  acc = top1(cascade_probs, val_y)
+  # the fraction of the samples which reach each stage
+  reach = [float(np.mean(stages >= i)) for i in range(len(filepaths))]
+  exp_flops = sum(r * f for r, f in zip(reach, flops))
+  exp_ms = sum(r * m for r, m in zip(reach, ms))
+  start_time = time.perf_counter()
+  cascade.models[-1].predict(val_x, batch_size=batch_size)
+  largest_time = time.perf_counter() - start_time
+
+  table = [
+    f'| stage | model | threshold | reach | answered | top-1 ({len(val_x)} val) | FLOPs | ms/batch ({batch_size}) |',
+    '| --- | --- | --- | --- | --- | --- | --- | --- |',
+  ]
+  for i, filepath in enumerate(filepaths):
+    threshold = f'{thresholds[i]:.3f}' if i < len(thresholds) else '-'
+    table.append(f'| {i} | {filepath} | {threshold} | {reach[i]:.3f} | {np.mean(stages == i):.3f} '
+                 f'| {accs[i]:.4f} | {flops[i]:,} | {ms[i]:.2f} |')
+  table.append(f'| cascade | target {target:.4f} | - | - | - | {acc:.4f} | {int(exp_flops):,} '
+               f'({exp_flops / flops[-1]:.1%}) | {exp_ms:.2f} ({exp_ms / ms[-1]:.1%}) |')
+  for row in table[2:]:
+    Log(row)
+  Log(f'[cascade] calibrated on {len(cal_x)} val images, reported on the other {len(val_x)}')
+  Log(f'[cascade] {len(val_x)} val images: {cascade_time:.2f}s cascade vs {largest_time:.2f}s largest model')
+  if out:
+    with open(out, 'w') as f:
+      json.dump({'models': list(filepaths), 'thresholds': thresholds, 'target': target, 'top1': acc}, f)
+  K.clear_session()
+  return thresholds, table
+
+
+# test part
+if __name__ == "__main__":
+  import argparse
+  from hat import datasets
+  parser = argparse.ArgumentParser(description='Calibrate a confidence cascade')
+  parser.add_argument('dataset')
+  parser.add_argument('h5', nargs='+', help='cheapest first')
+  parser.add_argument('--target', type=float, default=None, help='target top-1')
+  parser.add_argument('--max-drop', type=float, default=0.005, help='vs the largest if no target')
+  parser.add_argument('--out', default='cascade.json')
+  args = parser.parse_args()
+  print('\n'.join(cascade_report(args.h5, getattr(datasets, args.dataset)(), target=args.target,
+                                 max_drop=args.max_drop, out=args.out)[1]))
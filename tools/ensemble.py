@@ -0,0 +1,130 @@
+"""
+  Ensemble
+
+  Several trained models and a TTA policy in one inference graph: a shared
+  input, the views made in-graph as a batch expansion (`TTA`), every model
+  runs once on the `n * batch` views, the log-probs are averaged
+  (`TTAMean`). The input pipeline reads and preprocesses the images once,
+  the CPU gets one large batch instead of `models * views` predict calls.
+"""
+
+# pylint: disable=no-name-in-module
+
+import time
+
+import numpy as np
+from tensorflow.python.keras import backend as K
+from tensorflow.python.keras.layers import Input
+from tensorflow.python.keras.models import Model, load_model
+
+from hat.models.advance import TTA, TTAMean, TTA_POLICIES
+from hat.tools.bench import top1, val_sample
+
+
+# import setting
+__all__ = [
+  'build_ensemble',
+  'ensemble_report',
+]
+
+
+def _load(members):
+  """h5 paths, keras Models or NetWorks -> keras Models"""
+  return [load_model(m, compile=False) if isinstance(m, str) else getattr(m, 'model', m)
+          for m in members]
+
+
+def build_ensemble(members, policy='flip', mode='logits', crop_ratio=0.875, name='ensemble'):
+  """
+    Build the ensemble/TTA inference model.
+
+    Argument:
+      members: List of h5 paths, keras Models or NetWorks, with the same
+        input shape and classes.
+      policy: Str (a key of TTA_POLICIES) or List of the TTA ops.
+      mode: Str. 'logits' or 'probs', see TTAMean.
+
+    Return:
+      keras Model, (batch, ...) -> (batch, classes)
+  """
+  models = _load(members)
+  shapes = set(m.input_shape[1:] for m in models)
+  if len(shapes) != 1:
+    raise ValueError(f'The members must have the same input shape, got {shapes}')
+  policy = TTA_POLICIES[policy] if isinstance(policy, str) else list(policy)
+  for i, model in enumerate(models):
+    # NOTE: the nested models need unique names
+    model._name = f'member{i}_{model.name}'  # pylint: disable=protected-access
+  inputs = Input(shape=models[0].input_shape[1:])
+  x = inputs if policy == ['id'] else TTA(policy, crop_ratio)(inputs)
+  outputs = [model(x) for model in models]
+  x = TTAMean(len(policy), mode)(outputs if len(outputs) > 1 else outputs[0])
+  return Model(inputs, x, name=name)
+
+
+def ensemble_report(filepaths, dataset, policy='flip', mode='logits', batch_size=32, num_val=1000,
+                    Log=print):
+  """
+    Top-1 and wall time of the single-graph ensemble vs one predict call
+    per model and per view (the views made by their own graph each time),
+    on a sample of the val split.
+
+    Return:
+      List of Str, the report table.
+  """
+  val_x, val_y = val_sample(dataset, num_val)
+  policy = TTA_POLICIES[policy] if isinstance(policy, str) else list(policy)
+  K.clear_session()
+  K.set_learning_phase(0)
+  ensemble = build_ensemble(filepaths, policy, mode)
+  models = [layer for layer in ensemble.layers if isinstance(layer, Model)]
+  views = [K.function([ensemble.input], [TTA([op])(ensemble.input)]) for op in policy]
+  table = [
+    f'| model | views | top-1 ({len(val_x)} val) | seconds |',
+    '| --- | --- | --- | --- |',
+  ]
+
+  # separate calls
+  start_time = time.perf_counter()
+  logits = []
+  for model in models:
+    for view in views:
+      x = np.concatenate([view([val_x[i:i + batch_size]])[0] for i in range(0, len(val_x), batch_size)])
+      prob = model.predict(x, batch_size=batch_size)
+      logits.append(np.log(np.clip(prob, K.epsilon(), 1.)) if mode == 'logits' else prob)
+  separate = np.mean(logits, axis=0)
+  separate_time = time.perf_counter() - start_time
+  for i, model in enumerate(models):
+    # the first view of the policy, e.g. `crop_c` of crop5
+    table.append(f'| {model.name} | {policy[0]} | {top1(logits[i * len(views)], val_y):.4f} | - |')
+  table.append(f'| separate calls | {"+".join(policy)} | {top1(separate, val_y):.4f} | {separate_time:.2f} |')
+
+  # one graph, the batch is the images, the models see `views * batch`
+  ensemble.predict(val_x[:batch_size], batch_size=batch_size)
+  start_time = time.perf_counter()
+  prob = ensemble.predict(val_x, batch_size=batch_size)
+  ensemble_time = time.perf_counter() - start_time
+  table.append(f'| one graph | {"+".join(policy)} | {top1(prob, val_y):.4f} | {ensemble_time:.2f} |')
+  for row in table[2:]:
+    Log(row)
+  Log(f'[ensemble] {len(models)} models x {len(policy)} views, {separate_time / ensemble_time:.2f}x faster')
+  K.clear_session()
+  return table
+
+
+# test part
+if __name__ == "__main__":
+  import argparse
+  from hat import datasets
+  parser = argparse.ArgumentParser(description='Ensemble/TTA in one graph')
+  parser.add_argument('dataset')
+  parser.add_argument('h5', nargs='+')
+  parser.add_argument('--policy', default='flip', choices=list(TTA_POLICIES))
+  parser.add_argument('--mode', default='logits', choices=['logits', 'probs'])
+  parser.add_argument('--save', default='', help='save the ensemble h5')
+  args = parser.parse_args()
+  print('\n'.join(ensemble_report(args.h5, getattr(datasets, args.dataset)(), policy=args.policy,
+                                  mode=args.mode)))
+  if args.save:
+    K.set_learning_phase(0)
+    build_ensemble(args.h5, args.policy, args.mode).save(args.save, include_optimizer=False)
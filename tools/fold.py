@@ -0,0 +1,252 @@
+"""
+  Fold
+
+  Fold the fixed layers into the next (or previous) layer and strip the
+  train-only layers at export time, the inference model computes the same.
+"""
+
+# pylint: disable=no-name-in-module
+
+import numpy as np
+from tensorflow.python.keras import backend as K
+from tensorflow.python.keras.models import Model, load_model
+
+from hat.models.advance.extendrgb import color_weight
+from hat.tools.bench import ms_per_batch
+from hat.tools.graph import bypass, consumers, functional, inbound_names, rebuild
+
+
+# import setting
+__all__ = [
+  'STRIP_LAYERS',
+  'FOLD_BN_LAYERS',
+  'fold_extend_rgb',
+  'strip_dropout',
+  'fold_bn',
+  'optimize_for_inference',
+  'export_inference',
+  'benchmark_fold',
+]
+
+
+# identity at inference
+STRIP_LAYERS = ['Dropout', 'SpatialDropout1D', 'SpatialDropout2D', 'SpatialDropout3D',
+                'AlphaDropout', 'GaussianDropout', 'GaussianNoise', 'DropConnect']
+# the layers which take the BN folding, the output channel is the last
+# axis of the kernel (GroupConv packs its groups on it too)
+FOLD_BN_LAYERS = ['Conv1D', 'Conv2D', 'Conv3D', 'Dense', 'DepthwiseConv2D', 'GroupConv']
+
+
+def fold_extend_rgb(model):
+  """
+    Fold the ExtendRGB layers into the following Conv2D.
+
+    ExtendRGB is a bias-free 1x1 conv, so `conv(exrgb(x))` equals a conv of
+    `x` with the kernel `W @ K` (3 input channels). Exact, for any padding.
+    The ExtendRGB layers which feed other layers are kept.
+
+    Argument:
+      model: A functional keras Model (e.g. `NetWork.model`).
+
+    Return:
+      (new model, names of the folded layers)
+  """
+  model = functional(model)
+  config = model.get_config()
+  weights = {}
+  folded = []
+  for layer in list(config['layers']):
+    if layer['class_name'] != 'ExtendRGB':
+      continue
+    nexts = consumers(config, layer['name'])
+    if not nexts or any(n['class_name'] != 'Conv2D' for n in nexts):
+      continue
+    weight = color_weight(layer['config']['k'])
+    for n in nexts:
+      kernel, *others = model.get_layer(n['name']).get_weights()
+      weights[n['name']] = [np.einsum('ij,hwjf->hwif', weight, kernel)] + others
+    bypass(config, layer['name'])
+    folded.append(layer['name'])
+  if not folded:
+    return model, folded
+  return rebuild(model, config, weights), folded
+
+
+def strip_dropout(model):
+  """
+    Remove the Dropout/DropConnect/noise layers (STRIP_LAYERS).
+
+    Return:
+      (new model, names of the removed layers)
+  """
+  model = functional(model)
+  config = model.get_config()
+  stripped = [layer['name'] for layer in config['layers'] if layer['class_name'] in STRIP_LAYERS]
+  if not stripped:
+    return model, stripped
+  for name in stripped:
+    bypass(config, name)
+  return rebuild(model, config), stripped
+
+
+def _bn_scale(bn_layer):
+  """BN as y = x * scale + shift"""
+  config = bn_layer.get_config()
+  weights = bn_layer.get_weights()
+  gamma = weights.pop(0) if config['scale'] else 1.
+  beta = weights.pop(0) if config['center'] else 0.
+  mean, var = weights
+  scale = gamma / np.sqrt(var + config['epsilon'])
+  return scale, beta - mean * scale
+
+
+def _channel_axis(layer_config, ndim):
+  if layer_config['class_name'] == 'Dense':
+    return ndim - 1
+  if layer_config['config'].get('data_format') == 'channels_first':
+    return 1
+  return ndim - 1
+
+
+def fold_bn(model):
+  """
+    Fold the BatchNormalization layers into the previous conv/dense.
+
+    BN at inference is `x * scale + shift` per channel, so `bn(conv(x))`
+    equals a conv with the kernel `K * scale` and the bias
+    `b * scale + shift`. Only the BN whose input is a FOLD_BN_LAYERS layer
+    with no activation, not shared and feeding this BN only, is folded.
+
+    Return:
+      (new model, names of the folded BN layers)
+  """
+  model = functional(model)
+  config = model.get_config()
+  layers = {layer['name']: layer for layer in config['layers']}
+  outputs = [output[0] for output in config['output_layers']]
+  weights = {}
+  folded = []
+  for layer in list(config['layers']):
+    if layer['class_name'] != 'BatchNormalization':
+      continue
+    sources = inbound_names(layer)
+    if len(layer['inbound_nodes']) != 1 or len(sources) != 1:
+      continue
+    prev = layers[sources[0]]
+    if prev['class_name'] not in FOLD_BN_LAYERS \
+        or prev['config'].get('activation', 'linear') != 'linear' \
+        or len(prev['inbound_nodes']) != 1 \
+        or prev['name'] in outputs \
+        or len(consumers(config, prev['name'])) != 1:
+      continue
+    bn_layer = model.get_layer(layer['name'])
+    ndim = len(bn_layer.input_shape)
+    axis = layer['config']['axis']
+    axis = axis[0] if isinstance(axis, (list, tuple)) and len(axis) == 1 else axis
+    if not isinstance(axis, int) or axis % ndim != _channel_axis(prev, ndim):
+      continue
+
+    scale, shift = _bn_scale(bn_layer)
+    kernel, *bias = weights.get(prev['name']) or model.get_layer(prev['name']).get_weights()
+    bias = bias[0] if bias else np.zeros(scale.shape, dtype=kernel.dtype)
+    if prev['class_name'] == 'DepthwiseConv2D':
+      # output channel c * multiplier + m
+      kernel = kernel * scale.reshape(kernel.shape[-2:])
+    else:
+      kernel = kernel * scale
+    weights[prev['name']] = [kernel, bias * scale + shift]
+    prev['config']['use_bias'] = True
+    bypass(config, layer['name'])
+    folded.append(layer['name'])
+  if not folded:
+    return model, folded
+  return rebuild(model, config, weights), folded
+
+
+def optimize_for_inference(model):
+  """
+    strip_dropout -> fold_bn -> fold_extend_rgb
+
+    Return:
+      (new model, {step: names of the removed layers})
+  """
+  info = {}
+  model, info['strip'] = strip_dropout(model)
+  model, info['bn'] = fold_bn(model)
+  model, info['exrgb'] = fold_extend_rgb(model)
+  return model, info
+
+
+def _parity(model, new_model, x):
+  return float(np.abs(model.predict(x) - new_model.predict(x)).max())
+
+
+def export_inference(src, dst, batch_size=32, atol=1e-3, Log=print):
+  """
+    h5 -> the inference optimised h5 (no optimizer), check the parity.
+
+    Return:
+      (max abs diff, latency (ms) before, after)
+  """
+  model = load_model(src, compile=False)
+  new_model, info = optimize_for_inference(model)
+  x = np.random.rand(batch_size, *model.input_shape[1:]).astype('float32')
+  diff = _parity(model, new_model, x)
+  if diff > atol:
+    raise ValueError(f'Parity check failed, max abs diff {diff} > {atol}')
+  before, after = ms_per_batch(model.predict_on_batch, x), ms_per_batch(new_model.predict_on_batch, x)
+  new_model.save(dst, include_optimizer=False)
+  Log(f'[fold] {dst}: strip {len(info["strip"])}, bn {len(info["bn"])}, exrgb {len(info["exrgb"])}'
+      f' layers, max abs diff {diff:.2e}, {before:.2f} -> {after:.2f} ms/batch')
+  return diff, before, after
+
+
+def _randomize_bn(model):
+  """Random BN stats & affine, a fresh BN is almost the identity"""
+  for layer in model.layers:
+    if isinstance(layer, Model):
+      _randomize_bn(layer)
+    elif type(layer).__name__ == 'BatchNormalization':
+      layer.set_weights([
+        np.random.uniform(0.5, 1.5, w.shape) if 'variance' in v.name or 'gamma' in v.name
+        else np.random.uniform(-0.5, 0.5, w.shape)
+        for v, w in zip(layer.weights, layer.get_weights())])
+
+
+def benchmark_fold(names, lib='S', DATAINFO=None, batch_size=32, Log=print):
+  """
+    Parity and latency of optimize_for_inference on several models.
+
+    Return:
+      List of Str, the benchmark table.
+  """
+  from hat.models.utils import MLib
+  lib = MLib(lib)
+  DATAINFO = DATAINFO or {'INPUT_SHAPE': (32, 32, 3), 'NUM_CLASSES': 10}
+  table = [
+    '| model | layers | folded BN | stripped | max abs diff | ms/batch | folded ms/batch | speedup |',
+    '| --- | --- | --- | --- | --- | --- | --- | --- |',
+  ]
+  for name in names:
+    K.clear_session()
+    model = getattr(lib, name)(DATAINFO=DATAINFO, built=True).model
+    _randomize_bn(model)
+    new_model, info = optimize_for_inference(model)
+    x = np.random.rand(batch_size, *DATAINFO['INPUT_SHAPE']).astype('float32')
+    diff = _parity(model, new_model, x)
+    before, after = ms_per_batch(model.predict_on_batch, x), ms_per_batch(new_model.predict_on_batch, x)
+    table.append(f'| {name} | {len(model.layers)} -> {len(new_model.layers)} | {len(info["bn"])} '
+                 f'| {len(info["strip"])} | {diff:.2e} | {before:.2f} | {after:.2f} | {before / after:.2f}x |')
+    Log(table[-1])
+  K.clear_session()
+  return table
+
+
+# test part
+if __name__ == "__main__":
+  import sys
+  if len(sys.argv) == 3:
+    # python fold.py save_3.h5 save_3_inference.h5
+    export_inference(sys.argv[1], sys.argv[2])
+    sys.exit()
+  print('\n'.join(benchmark_fold(['lenet', 'vgg16', 'resnet50', 'densenet121', 'mobilenetv2', 'enetb0'])))
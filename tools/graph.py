@@ -0,0 +1,102 @@
+"""
+  Graph rewrite
+
+  Rewrite the config of a functional keras Model (remove a layer, rewire
+  its consumers) and rebuild it with the old weights.
+"""
+
+# pylint: disable=no-name-in-module
+
+from tensorflow.python.keras.models import Model, Sequential
+
+from hat.models.advance.util import _CUSTOM_OBJECTS
+
+
+# import setting
+__all__ = [
+  'functional',
+  'inbound_names',
+  'consumers',
+  'bypass',
+  'insert_before',
+  'rebuild',
+]
+
+
+def functional(model):
+  """
+    The functional Model of a keras Model (e.g. Sequential), the same layers.
+  """
+  if not isinstance(model, Sequential):
+    return model
+  return Model(model.inputs, model.outputs, name=model.name)
+
+
+def inbound_names(layer_config):
+  """
+    Names of the layers feeding a layer (of the model config).
+  """
+  return [inbound[0] for node in layer_config['inbound_nodes'] for inbound in node]
+
+
+def consumers(config, name):
+  """
+    The layer configs which take the output of layer `name`.
+  """
+  return [layer for layer in config['layers'] if name in inbound_names(layer)]
+
+
+def bypass(config, name):
+  """
+    Remove a single input layer, its consumers (and the model outputs)
+    take its input instead. The config is changed in place.
+  """
+  layers = {layer['name']: layer for layer in config['layers']}
+  layer = layers[name]
+  if len(layer['inbound_nodes']) != 1 or len(layer['inbound_nodes'][0]) != 1:
+    raise ValueError(f'Only the single input layer can be bypassed, got {name}')
+  source = layer['inbound_nodes'][0][0]
+  for other in config['layers']:
+    for node in other['inbound_nodes']:
+      for inbound in node:
+        if inbound[0] == name:
+          inbound[0], inbound[1], inbound[2] = source[0], source[1], source[2]
+  for output in config['output_layers']:
+    if output[0] == name:
+      output[0], output[1], output[2] = source[0], source[1], source[2]
+  config['layers'].remove(layer)
+  return config
+
+
+def insert_before(config, name, layer_config):
+  """
+    Insert a single input layer before layer `name`, it takes the inputs
+    of `name` and feeds `name`. The config is changed in place.
+  """
+  layers = config['layers']
+  layer = next(layer for layer in layers if layer['name'] == name)
+  if len(layer['inbound_nodes']) != 1:
+    raise ValueError(f'Only the layer called once can be rewired, got {name}')
+  layer_config['inbound_nodes'] = layer['inbound_nodes']
+  layer['inbound_nodes'] = [[[layer_config['name'], 0, 0, {}]]]
+  layers.insert(layers.index(layer), layer_config)
+  return config
+
+
+def rebuild(model, config, weights=None):
+  """
+    Build a new Model of the config, the layers take the weights of the
+    same name in the old model.
+
+    Argument:
+      weights: Dict. {layer name: list of arrays}, replace the old weights.
+  """
+  weights = weights or {}
+  new_model = Model.from_config(config, custom_objects=_CUSTOM_OBJECTS)
+  old_layers = {layer.name: layer for layer in model.layers}
+  for layer in new_model.layers:
+    if layer.name in weights:
+      layer.set_weights(weights[layer.name])
+    elif layer.name in old_layers and layer.weights:
+      layer.set_weights(old_layers[layer.name].get_weights())
+  return new_model
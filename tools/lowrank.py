@@ -0,0 +1,203 @@
+"""
+  Low rank
+
+  Replace the large Dense layers (e.g. the `self.local` layers after
+  `flatten` in alexnet/zfnet/vgg) of a trained model with two low-rank
+  Dense layers by truncated SVD, `W (in, out) ~ (U_r * s_r) @ V_r`, which
+  costs `r * (in + out)` instead of `in * out`.
+"""
+
+# pylint: disable=no-name-in-module
+
+import copy
+import os
+
+import numpy as np
+from tensorflow.python.keras import backend as K
+from tensorflow.python.keras.models import load_model
+from tensorflow.python.keras.optimizers import SGD
+
+from hat.tools.bench import ms_per_batch, split_val, top1, val_sample
+from hat.tools.graph import functional, insert_before, rebuild
+
+
+# import setting
+__all__ = [
+  'energy_rank',
+  'dense_layers',
+  'factorize_dense',
+  'pick_ranks',
+  'lowrank_report',
+]
+
+
+def energy_rank(s, energy):
+  """
+    The smallest rank keeping `energy` of the squared singular values.
+  """
+  ratio = np.cumsum(np.square(s)) / np.sum(np.square(s))
+  return int(np.searchsorted(ratio, energy) + 1)
+
+
+def dense_layers(model, min_params=1000000):
+  """
+    Names of the Dense layers with more than `min_params` kernel parameters.
+  """
+  return [layer.name for layer in model.layers
+          if type(layer).__name__ == 'Dense' and np.prod(K.int_shape(layer.kernel)) > min_params]
+
+
+def _svd(model, name):
+  kernel = model.get_layer(name).get_weights()[0]
+  return np.linalg.svd(kernel, full_matrices=False)
+
+
+def factorize_dense(model, ranks):
+  """
+    Replace the Dense layers with `Dense(r, linear, no bias) -> Dense(out)`.
+
+    The second one keeps the name, activation and bias of the layer. The
+    layers whose rank does not save parameters are kept.
+
+    Argument:
+      ranks: Dict. {Dense layer name: rank}.
+
+    Return:
+      (new model, {name: rank} of the factorized layers)
+  """
+  model = functional(model)
+  config = model.get_config()
+  weights = {}
+  done = {}
+  for layer in config['layers']:
+    name = layer['name']
+    if name not in ranks or layer['class_name'] != 'Dense':
+      continue
+    kernel, *bias = model.get_layer(name).get_weights()
+    rank = ranks[name]
+    if rank * sum(kernel.shape) >= kernel.size:
+      continue
+    u, s, v = np.linalg.svd(kernel, full_matrices=False)
+    first = copy.deepcopy(layer)
+    first['name'] = first['config']['name'] = f'{name}_svd'
+    first['config'].update({'units': rank, 'activation': 'linear', 'use_bias': False,
+                            'bias_regularizer': None, 'bias_constraint': None,
+                            'activity_regularizer': None})
+    insert_before(config, name, first)
+    weights[first['name']] = [u[:, :rank] * s[:rank]]
+    weights[name] = [v[:rank]] + bias
+    done[name] = rank
+  if not done:
+    return model, done
+  return rebuild(model, config, weights), done
+
+
+def pick_ranks(model, names, energy=None, x=None, y=None, max_drop=0.01,
+               energies=(0.5, 0.6, 0.7, 0.8, 0.9, 0.95, 0.99)):
+  """
+    The rank of each layer, from an energy budget, or the smallest rank
+    whose top-1 drop on (x, y) is at most `max_drop` (the other layers
+    unchanged).
+
+    Return:
+      Dict. {name: rank}
+  """
+  if energy is not None:
+    return {name: energy_rank(_svd(model, name)[1], energy) for name in names}
+  base = top1(model.predict(x, batch_size=64), y)
+  ranks = {}
+  for name in names:
+    s = _svd(model, name)[1]
+    ranks[name] = len(s)
+    for e in energies:
+      rank = energy_rank(s, e)
+      new_model, done = factorize_dense(model, {name: rank})
+      if not done:
+        break
+      if base - top1(new_model.predict(x, batch_size=64), y) <= max_drop:
+        ranks[name] = rank
+        break
+  return ranks
+
+
+def _params(model):
+  return int(sum(np.prod(K.int_shape(w)) for w in model.weights))
+
+
+def lowrank_report(src, dst, dataset, energy=None, max_drop=0.01, min_params=1000000,
+                   finetune_epochs=0, lr=1e-4, batch_size=32, num_val=1000, num_select=500, Log=print):
+  """
+    Factorize the large Dense layers of a h5, optionally fine-tune on the
+    train split, write the new h5 and report params, size, latency and
+    top-1 on a sample of the val split.
+
+    Argument:
+      energy: Float. The energy budget, None means the accuracy budget `max_drop`.
+      num_select: Int. The val samples `max_drop` picks the ranks on,
+        disjoint from the report samples; a small val split is shared in
+        proportion by `split_val`.
+
+    Return:
+      List of Str, the report table.
+  """
+  sel_x, sel_y = None, None
+  if energy is None:
+    # NOTE: pick the ranks on other val samples than the report ones
+    (val_x, val_y), (sel_x, sel_y) = split_val(dataset, num_val, num_select)
+    if not len(sel_x):
+      raise ValueError(f'The val split has no samples left to pick the ranks, reduce num_val ({num_val})')
+  else:
+    val_x, val_y = val_sample(dataset, num_val)
+  model = load_model(src, compile=False)
+  names = dense_layers(model, min_params)
+  ranks = pick_ranks(model, names, energy, sel_x, sel_y, max_drop)
+  new_model, done = factorize_dense(model, ranks)
+  Log(f'[lowrank] ranks {done}')
+
+  def _finetune():
+    new_model.compile(optimizer=SGD(lr=lr, momentum=0.9), loss='sparse_categorical_crossentropy',
+                      metrics=['accuracy'])
+    if dataset.train_x is not None:
+      new_model.fit(dataset.train_x, dataset.train_y, batch_size=batch_size, epochs=finetune_epochs)
+    else:
+      dataset.get_generator(batch_size)
+      new_model.fit_generator(dataset.trian_generator, epochs=finetune_epochs)
+
+  rows = [['float', model, src]]
+  if done:
+    lowrank_acc = top1(new_model.predict(val_x, batch_size=64), val_y)
+    if finetune_epochs:
+      _finetune()
+    new_model.save(dst, include_optimizer=False)
+    rows.append([f'low rank{f" + {finetune_epochs} epochs" if finetune_epochs else ""}', new_model, dst])
+  table = [
+    f'| model | params | size MiB | ms/batch ({batch_size}) | top-1 ({len(val_x)} val) |',
+    '| --- | --- | --- | --- | --- |',
+  ]
+  x = val_x[:batch_size]
+  for tag, _model, filename in rows:
+    acc = top1(_model.predict(val_x, batch_size=64), val_y)
+    table.append(f'| {tag} | {_params(_model):,} | {os.path.getsize(filename) / 2 ** 20:.2f} '
+                 f'| {ms_per_batch(_model.predict_on_batch, x):.2f} | {acc:.4f} |')
+    Log(table[-1])
+  if done and finetune_epochs:
+    Log(f'[lowrank] top-1 before fine-tuning {lowrank_acc:.4f}')
+  return table
+
+
+# test part
+if __name__ == "__main__":
+  import argparse
+  from hat import datasets
+  parser = argparse.ArgumentParser(description='SVD low rank Dense')
+  parser.add_argument('src')
+  parser.add_argument('dst')
+  parser.add_argument('dataset')
+  parser.add_argument('--energy', type=float, default=None, help='energy budget, e.g. 0.9')
+  parser.add_argument('--max-drop', type=float, default=0.01, help='top-1 budget if no energy')
+  parser.add_argument('--min-params', type=int, default=1000000)
+  parser.add_argument('--finetune', type=int, default=0, help='fine-tuning epochs')
+  args = parser.parse_args()
+  print('\n'.join(lowrank_report(args.src, args.dst, getattr(datasets, args.dataset)(),
+                                 energy=args.energy, max_drop=args.max_drop,
+                                 min_params=args.min_params, finetune_epochs=args.finetune)))
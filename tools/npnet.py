@@ -0,0 +1,461 @@
+"""
+  NPNet
+
+  A NumPy-only runtime of the small exported models (mlp, lenet, cnn32,
+  alexnet on small inputs...), no TensorFlow import at startup.
+
+  `export_npnet` (needs TF) writes the layer graph to `{prefix}.json` and
+  the weights to `{prefix}.npz`, after `optimize_for_inference` (BN folded,
+  Dropout stripped). `NPNet` (needs NumPy only) runs them, the convs are
+  im2col + one matmul, the 'same' padding is the TF one (the extra pixel
+  at the bottom/right). Only channels_last.
+
+  This file imports nothing of hat/TF at module level, and the hat and
+  hat.tools inits are lazy, so `from hat.tools.npnet import NPNet` does not
+  import TF either. It can also be copied next to the scoring script, or
+  run as a file:
+
+    python npnet.py lenet_car10 x.npy -o probs.npy
+"""
+
+# pylint: disable=no-name-in-module
+
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+
+
+# import setting
+__all__ = [
+  'NP_LAYERS',
+  'NPNet',
+  'export_npnet',
+  'benchmark_npnet',
+]
+
+
+# Activations
+
+def _sigmoid(x):
+  return 0.5 * (np.tanh(0.5 * x) + 1.)
+
+
+def _softmax(x, axis=-1):
+  x = np.exp(x - x.max(axis=axis, keepdims=True))
+  return x / x.sum(axis=axis, keepdims=True)
+
+
+def _elu(x, alpha=1.):
+  return np.where(x > 0, x, alpha * np.expm1(np.minimum(x, 0)))
+
+
+ACTIVATIONS = {
+  'linear': lambda x: x,
+  'relu': lambda x: np.maximum(x, 0),
+  'relu6': lambda x: np.clip(x, 0, 6),
+  'sigmoid': _sigmoid,
+  'hard_sigmoid': lambda x: np.clip(0.2 * x + 0.5, 0, 1),
+  'tanh': np.tanh,
+  'softmax': _softmax,
+  'swish': lambda x: x * _sigmoid(x),
+  'elu': _elu,
+  'selu': lambda x: 1.0507009873554805 * _elu(x, 1.6732632423543772),
+  'softplus': lambda x: np.logaddexp(0, x),
+  'softsign': lambda x: x / (1 + np.abs(x)),
+}
+
+
+def _activation(x, name):
+  if isinstance(name, dict):
+    name = name['class_name']
+  if name is None:
+    return x
+  if name not in ACTIVATIONS:
+    raise ValueError(f'Unsupported activation {name}')
+  return ACTIVATIONS[name](x)
+
+
+# Windows
+
+def _pad(x, kernel_size, strides, dilation_rate, padding, value=0.):
+  """TF padding, 'same' puts the odd pixel at the bottom/right"""
+  if padding == 'valid':
+    return x
+  pads = [(0, 0)]
+  for size, k, s, d in zip(x.shape[1:3], kernel_size, strides, dilation_rate):
+    k = (k - 1) * d + 1
+    total = max((-(-size // s) - 1) * s + k - size, 0)
+    pads.append((total // 2, total - total // 2))
+  pads.append((0, 0))
+  return np.pad(x, pads, mode='constant', constant_values=value)
+
+
+def _windows(x, kernel_size, strides, dilation_rate):
+  """(n, h, w, c) -> (n, oh, ow, kh, kw, c), a view, no copy"""
+  n, h, w, c = x.shape
+  (kh, kw), (sh, sw), (dh, dw) = kernel_size, strides, dilation_rate
+  oh = (h - (kh - 1) * dh - 1) // sh + 1
+  ow = (w - (kw - 1) * dw - 1) // sw + 1
+  bn, bh, bw, bc = x.strides
+  return as_strided(x, (n, oh, ow, kh, kw, c), (bn, bh * sh, bw * sw, bh * dh, bw * dw, bc),
+                    writeable=False)
+
+
+def _conv_args(config):
+  return (tuple(config['kernel_size']), tuple(config['strides']),
+          tuple(config.get('dilation_rate', (1, 1))), config['padding'])
+
+
+# Layers, f(config, weights, inputs) -> output
+
+def _conv2d(config, weights, x):
+  kernel_size, strides, dilation_rate, padding = _conv_args(config)
+  kernel = weights[0]
+  n = x.shape[0]
+  if kernel_size == (1, 1) and strides == (1, 1):
+    y = x.reshape(-1, x.shape[-1]) @ kernel.reshape(kernel.shape[-2:])
+    y = y.reshape(*x.shape[:3], -1)
+  else:
+    # im2col, the copy is (n * oh * ow, kh * kw * c)
+    cols = _windows(_pad(x, kernel_size, strides, dilation_rate, padding),
+                    kernel_size, strides, dilation_rate)
+    oh, ow = cols.shape[1:3]
+    y = cols.reshape(n * oh * ow, -1) @ kernel.reshape(-1, kernel.shape[-1])
+    y = y.reshape(n, oh, ow, -1)
+  if len(weights) > 1:
+    y += weights[1]
+  return _activation(y, config.get('activation', 'linear'))
+
+
+def _depthwise_conv2d(config, weights, x):
+  kernel_size, strides, dilation_rate, padding = _conv_args(config)
+  kernel = weights[0]
+  cols = _windows(_pad(x, kernel_size, strides, dilation_rate, padding),
+                  kernel_size, strides, dilation_rate)
+  # output channel c * multiplier + m
+  y = np.einsum('nhwijc,ijcm->nhwcm', cols, kernel, optimize=True)
+  y = y.reshape(*y.shape[:3], -1)
+  if len(weights) > 1:
+    y += weights[1]
+  return _activation(y, config.get('activation', 'linear'))
+
+
+def _dense(config, weights, x):
+  y = x @ weights[0]
+  if len(weights) > 1:
+    y += weights[1]
+  return _activation(y, config['activation'])
+
+
+def _batch_norm(config, weights, x):
+  weights = list(weights)
+  gamma = weights.pop(0) if config['scale'] else 1.
+  beta = weights.pop(0) if config['center'] else 0.
+  mean, var = weights
+  scale = gamma / np.sqrt(var + config['epsilon'])
+  return x * scale + (beta - mean * scale)
+
+
+def _pool(config, x, reduce):
+  pool_size, strides = tuple(config['pool_size']), tuple(config['strides'])
+  value = -np.inf if reduce is np.max else 0.
+  padded = _pad(x, pool_size, strides, (1, 1), config['padding'], value)
+  y = reduce(_windows(padded, pool_size, strides, (1, 1)), axis=(3, 4))
+  if reduce is np.sum:
+    # TF does not count the padding
+    ones = _pad(np.ones((1, *x.shape[1:3], 1), x.dtype), pool_size, strides, (1, 1), config['padding'])
+    y /= _windows(ones, pool_size, strides, (1, 1)).sum(axis=(3, 4))
+  return y
+
+
+def _zero_padding(config, weights, x):
+  (top, bottom), (left, right) = config['padding']
+  return np.pad(x, [(0, 0), (top, bottom), (left, right), (0, 0)], mode='constant')
+
+
+def _relu(config, weights, x):
+  threshold = config.get('threshold', 0.) or 0.
+  slope = config.get('negative_slope', 0.) or 0.
+  y = np.where(x >= threshold, x, slope * (x - threshold))
+  if config.get('max_value') is not None:
+    y = np.minimum(y, config['max_value'])
+  return y
+
+
+def _squeeze_excitation(config, weights, x):
+  """The same as SqueezeExcitation.call: GAP, FC, FC, activation, scale"""
+  kernel1, kernel2, *biases = weights
+  w = x.mean(axis=(1, 2)) @ kernel1
+  if biases:
+    w += biases[0]
+  w = w @ kernel2
+  if biases:
+    w += biases[1]
+  w = _activation(w, config['activation'])
+  return x * w[:, None, None, :]
+
+
+def _shuffle(config, weights, *inputs):
+  x = np.concatenate(inputs, axis=config['axis'])
+  channels, groups = x.shape[config['axis']], len(inputs)
+  _hc = channels // groups
+  index = [(j % groups) * _hc + j // groups for j in range(channels)]
+  return np.take(x, index, axis=config['axis'])
+
+
+def _identity(config, weights, x):
+  return x
+
+
+NP_LAYERS = {
+  'InputLayer': _identity,
+  'Conv2D': _conv2d,
+  'DepthwiseConv2D': _depthwise_conv2d,
+  'Dense': _dense,
+  'BatchNormalization': _batch_norm,
+  'MaxPooling2D': lambda config, weights, x: _pool(config, x, np.max),
+  'AveragePooling2D': lambda config, weights, x: _pool(config, x, np.sum),
+  'GlobalAveragePooling2D': lambda config, weights, x: x.mean(axis=(1, 2)),
+  'GlobalMaxPooling2D': lambda config, weights, x: x.max(axis=(1, 2)),
+  'ZeroPadding2D': _zero_padding,
+  'Flatten': lambda config, weights, x: x.reshape(len(x), -1),
+  'Reshape': lambda config, weights, x: x.reshape(len(x), *config['target_shape']),
+  'Activation': lambda config, weights, x: _activation(x, config['activation']),
+  'ReLU': _relu,
+  'LeakyReLU': lambda config, weights, x: np.where(x > 0, x, config['alpha'] * x),
+  'Softmax': lambda config, weights, x: _softmax(x, config.get('axis', -1)),
+  'Swish': lambda config, weights, x: x * _sigmoid(x),
+  'SqueezeExcitation': _squeeze_excitation,
+  'Add': lambda config, weights, *x: sum(x[1:], x[0]),
+  'Subtract': lambda config, weights, a, b: a - b,
+  'Multiply': lambda config, weights, *x: np.prod(np.stack(x), axis=0),
+  'Average': lambda config, weights, *x: np.mean(np.stack(x), axis=0),
+  'Maximum': lambda config, weights, *x: np.max(np.stack(x), axis=0),
+  'Minimum': lambda config, weights, *x: np.min(np.stack(x), axis=0),
+  'Concatenate': lambda config, weights, *x: np.concatenate(x, axis=config['axis']),
+  'Shuffle': _shuffle,
+  # ExtendRGB is exported as its fixed 1x1 kernel
+  'ExtendRGB': lambda config, weights, x: _conv2d(
+      {'kernel_size': (1, 1), 'strides': (1, 1), 'padding': 'same'}, weights, x),
+  # identity at inference
+  'Dropout': _identity,
+  'SpatialDropout2D': _identity,
+  'AlphaDropout': _identity,
+  'GaussianDropout': _identity,
+  'GaussianNoise': _identity,
+  'DropConnect': _identity,
+}
+
+
+class NPNet(object):
+  """
+    Run an exported model with NumPy
+
+    Usage:
+    ```python
+      net = NPNet('logs/lenet_car10')  # lenet_car10.json + lenet_car10.npz
+      probs = net.predict(x, batch_size=64)
+    ```
+  """
+
+  def __init__(self, prefix):
+    with open(f'{prefix}.json', 'r') as f:
+      graph = json.load(f)
+    with np.load(f'{prefix}.npz') as npz:
+      weights = {k: npz[k] for k in npz.files}
+    self.name = graph['name']
+    self.input_shape = tuple(graph['input_shape'])
+    self.layers = []
+    for layer in graph['layers']:
+      if layer['class_name'] not in NP_LAYERS:
+        raise ValueError(f"Unsupported layer {layer['name']} ({layer['class_name']})")
+      self.layers.append([
+        layer['name'],
+        NP_LAYERS[layer['class_name']],
+        layer['config'],
+        [weights[f"{layer['name']}:{i}"] for i in range(layer['weights'])],
+        layer['inbound'],
+      ])
+    self.inputs = graph['inputs']
+    self.outputs = graph['outputs']
+    # free the tensors after their last use
+    self._last_use = {}
+    for i, (_, _, _, _, inbound) in enumerate(self.layers):
+      for name in inbound:
+        self._last_use[name] = i
+
+  def __call__(self, *x):
+    tensors = dict(zip(self.inputs, [np.asarray(i, dtype='float32') for i in x]))
+    for i, (name, func, config, weights, inbound) in enumerate(self.layers):
+      if name not in tensors:
+        tensors[name] = func(config, weights, *[tensors[n] for n in inbound])
+      for n in inbound:
+        if self._last_use[n] == i and n not in self.outputs:
+          del tensors[n]
+    outputs = [tensors[n] for n in self.outputs]
+    return outputs[0] if len(outputs) == 1 else outputs
+
+  def predict(self, x, batch_size=32):
+    return np.concatenate([self(x[i:i + batch_size]) for i in range(0, len(x), batch_size)])
+
+
+def export_npnet(model, prefix, optimize=True):
+  """
+    Write `{prefix}.json` (the layer graph) and `{prefix}.npz` (the weights).
+
+    Argument:
+      model: Str (h5), keras Model or NetWork.
+      optimize: Bool. Strip Dropout and fold BN first (optimize_for_inference).
+
+    Return:
+      Str, the prefix.
+  """
+  from tensorflow.python.keras.models import load_model
+  from hat.models.advance.extendrgb import color_weight
+  from hat.tools.fold import optimize_for_inference
+  from hat.tools.graph import functional, inbound_names
+
+  if isinstance(model, str):
+    model = load_model(model, compile=False)
+  model = functional(getattr(model, 'model', model))
+  if optimize:
+    model, _ = optimize_for_inference(model)
+  config = json.loads(model.to_json())['config']
+  layers, weights = [], {}
+  for layer in config['layers']:
+    name, kind = layer['name'], layer['class_name']
+    if kind not in NP_LAYERS:
+      raise ValueError(f'Unsupported layer {name} ({kind}), NP_LAYERS has {sorted(NP_LAYERS)}')
+    if len(layer['inbound_nodes']) > 1:
+      raise ValueError(f'Shared layer {name} is not supported')
+    if layer['config'].get('data_format') == 'channels_first':
+      raise ValueError(f'Layer {name}: only channels_last is supported')
+    if kind == 'BatchNormalization' and layer['config']['axis'] not in [-1, [-1]] \
+        and layer['config']['axis'] not in [len(model.get_layer(name).input_shape) - 1,
+                                            [len(model.get_layer(name).input_shape) - 1]]:
+      raise ValueError(f'Layer {name}: only the BN of the last axis is supported')
+    if kind == 'ExtendRGB':
+      values = [color_weight(layer['config']['k']).reshape(1, 1, 3, -1)]
+    else:
+      values = model.get_layer(name).get_weights()
+    for i, value in enumerate(values):
+      weights[f'{name}:{i}'] = value.astype('float32')
+    layers.append({
+      'name': name,
+      'class_name': kind,
+      'config': layer['config'],
+      'inbound': inbound_names(layer),
+      'weights': len(values),
+    })
+  graph = {
+    'name': model.name,
+    'input_shape': list(model.input_shape[1:]),
+    'inputs': [i[0] for i in config['input_layers']],
+    'outputs': [i[0] for i in config['output_layers']],
+    'layers': layers,
+  }
+  dirname = os.path.dirname(prefix)
+  if dirname:
+    os.makedirs(dirname, exist_ok=True)
+  with open(f'{prefix}.json', 'w') as f:
+    json.dump(graph, f)
+  np.savez(f'{prefix}.npz', **weights)
+  return prefix
+
+
+def _cold_start(args, env=None):
+  start_time = time.perf_counter()
+  subprocess.run(args, check=True, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+  return time.perf_counter() - start_time
+
+
+def benchmark_npnet(names, lib='S', DATAINFO=None, batch_size=32, Log=print):
+  """
+    Parity (max abs diff of the probs), cold start (a new process: import,
+    load, predict one batch) and per-batch latency, NPNet vs keras.
+
+    The NPNet cold start is measured through `from hat.tools.npnet import
+    NPNet` (the process fails if TF got imported) and as a copied file.
+
+    Argument:
+      names: List of Str, the models of `lib`, or `{lib}/{name}`, e.g. 'A/cnn32'.
+
+    Return:
+      List of Str, the benchmark table.
+  """
+  from tensorflow.python.keras import backend as K
+  import hat
+  from hat.models.utils import MLib
+  from hat.tools.bench import ms_per_batch
+  from hat.tools.fold import _randomize_bn
+
+  DATAINFO = DATAINFO or {'INPUT_SHAPE': (32, 32, 3), 'NUM_CLASSES': 10}
+  env = dict(os.environ)
+  env['PYTHONPATH'] = os.pathsep.join(
+      [os.path.dirname(os.path.dirname(os.path.abspath(hat.__file__))), env.get('PYTHONPATH', '')])
+  table = [
+    f'| model | max abs diff | cold start s (keras) | cold start s (hat.tools.npnet) '
+    f'| cold start s (npnet.py) | ms/batch {batch_size} (keras) | ms/batch {batch_size} (numpy) |',
+    '| --- | --- | --- | --- | --- | --- | --- |',
+  ]
+  with tempfile.TemporaryDirectory() as tmp:
+    x = np.random.rand(batch_size, *DATAINFO['INPUT_SHAPE']).astype('float32')
+    x_name = os.path.join(tmp, 'x.npy')
+    np.save(x_name, x)
+    for name in names:
+      _lib, _, name = name.rpartition('/')
+      K.clear_session()
+      model = getattr(MLib(_lib or lib), name)(DATAINFO=DATAINFO, built=True).model
+      _randomize_bn(model)
+      h5_name, prefix = os.path.join(tmp, f'{name}.h5'), os.path.join(tmp, name)
+      model.save(h5_name, include_optimizer=False)
+      export_npnet(model, prefix)
+      net = NPNet(prefix)
+      diff = float(np.abs(model.predict(x) - net(x)).max())
+      keras_ms = ms_per_batch(model.predict_on_batch, x)
+      numpy_ms = ms_per_batch(net, x)
+      keras_cold = _cold_start([sys.executable, '-c', (
+          'import numpy as np, hat.models\n'
+          'from tensorflow.python.keras.models import load_model\n'
+          f'load_model({h5_name!r}, compile=False).predict(np.load({x_name!r}))')], env)
+      import_cold = _cold_start([sys.executable, '-c', (
+          'import sys, numpy as np\n'
+          'from hat.tools.npnet import NPNet\n'
+          f'NPNet({prefix!r}).predict(np.load({x_name!r}))\n'
+          "assert 'tensorflow' not in sys.modules, 'hat.tools.npnet imported TensorFlow'")], env)
+      numpy_cold = _cold_start([sys.executable, os.path.abspath(__file__), prefix, x_name])
+      table.append(f'| {name} | {diff:.2e} | {keras_cold:.2f} | {import_cold:.2f} | {numpy_cold:.2f} '
+                   f'| {keras_ms:.2f} | {numpy_ms:.2f} |')
+      Log(table[-1])
+  K.clear_session()
+  return table
+
+
+# test part
+if __name__ == "__main__":
+  import argparse
+  parser = argparse.ArgumentParser(description='NumPy runtime of the exported models')
+  parser.add_argument('prefix', nargs='?', help='the exported {prefix}.json/.npz')
+  parser.add_argument('x', nargs='?', help='the inputs .npy')
+  parser.add_argument('-o', '--output', default='', help='save the outputs .npy')
+  parser.add_argument('--batch-size', type=int, default=32)
+  parser.add_argument('--export', default='', help='export this h5 to prefix (needs TF)')
+  parser.add_argument('--bench', action='store_true', help='parity/latency vs keras (needs TF)')
+  args = parser.parse_args()
+  if args.bench:
+    print('\n'.join(benchmark_npnet(['mlp', 'lenet', 'A/cnn32', 'alexnet'])))
+  elif args.export:
+    export_npnet(args.export, args.prefix)
+  else:
+    _net = NPNet(args.prefix)
+    _y = _net.predict(np.load(args.x), args.batch_size)
+    if args.output:
+      np.save(args.output, _y)
+    else:
+      print(np.argmax(_y, axis=-1))
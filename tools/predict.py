@@ -0,0 +1,159 @@
+"""
+  Batched prediction
+
+  Run a model over an array (e.g. `test_x`) or a folder of images. The
+  images are decoded by a thread pool one batch ahead of the model, the
+  top-k results stream into a memory-mapped `.npy` and a CSV.
+"""
+
+# pylint: disable=no-name-in-module
+
+import csv
+import os
+import time
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+from PIL import Image
+
+
+# import setting
+__all__ = [
+  'IMAGE_SUFFIX',
+  'list_images',
+  'dataset_decoder',
+  'predict_topk',
+]
+
+
+IMAGE_SUFFIX = ('.jpg', '.jpeg', '.png', '.bmp', '.gif', '.webp')
+
+
+def list_images(directory):
+  """
+    The image files of a folder (recursive), sorted.
+  """
+  files = []
+  for root, _, names in os.walk(directory):
+    files.extend(os.path.join(root, name) for name in names if name.lower().endswith(IMAGE_SUFFIX))
+  return sorted(files)
+
+
+def dataset_decoder(dataset, exrgb_k=0):
+  """
+    The image decoder of a dataset, the same as the training arrays were
+    built with, the source is a filename or a file object.
+
+    * `img_func(filename)` (imagenet) or `_image_reshape(filename)` (car10);
+    * `dsb.img_func(filename, dsb.mode)`, the DSBuilder datasets (dogs,
+      flower5, car10a, ...);
+    * `RESCALE` (mnist, fashion_mnist, cifar): resize to INPUT_SHAPE, in
+      grayscale if 1 channel, and divided by RESCALE like the arrays.
+
+    Argument:
+      exrgb_k: Int. If something, ExtendRGB the decoded image as the
+        dataset was (`exrgb=`).
+
+    Raise:
+      ValueError, the dataset has no faithful image decoder.
+  """
+  func = None
+  for name in ['img_func', '_image_reshape']:
+    if callable(getattr(dataset, name, None)):
+      func = getattr(dataset, name)
+      break
+  dsb = getattr(dataset, 'dsb', None)
+  if func is None and dsb is not None and getattr(dsb, 'mode', None):
+    def func(filename):
+      return dsb.img_func(filename, dsb.mode)
+  if func is None and getattr(dataset, 'RESCALE', None):
+    height, width = dataset.INPUT_SHAPE[:2]
+    gray = dataset.INPUT_SHAPE[-1] == 1 and not exrgb_k
+    def func(filename):
+      img = Image.open(filename).convert('L' if gray else 'RGB').resize((width, height))
+      img = np.array(img, dtype='float32') / dataset.RESCALE
+      return img[..., None] if gray else img
+  if func is None:
+    raise ValueError(f'{type(dataset).__name__} has no image decoder, predict on test_x instead.')
+  if not exrgb_k:
+    return func
+  from hat.models.advance.extendrgb import extend_rgb
+  def _decode(filename):
+    return extend_rgb(np.asarray(func(filename))[None], exrgb_k)[0]
+  return _decode
+
+
+def _topk(probs, k):
+  index = np.argsort(-probs, axis=-1)[:, :k]
+  return index.astype('int32'), np.take_along_axis(probs, index, axis=-1).astype('float32')
+
+
+def predict_topk(model, source, filename, k=5, batch_size=256, decode=None, workers=8, Log=print):
+  """
+    Predict the top-k classes.
+
+    Argument:
+      model: A NetWork or keras Model.
+      source: Array of inputs, or List of Str (image files, need `decode`).
+      filename: Str. The output name without suffix, writes
+        `{filename}.npy` (structured, fields `index` and `prob` of (N, k))
+        and `{filename}.csv`.
+      decode: Callable. filename -> image array.
+      workers: Int. Threads of decoding.
+
+    Return:
+      Float, images/sec.
+  """
+  is_file = isinstance(source, (list, tuple))
+  if is_file and decode is None:
+    raise ValueError('`decode` is needed to predict the image files.')
+  num = len(source)
+  k = min(k, model.NUM_CLASSES if hasattr(model, 'NUM_CLASSES') else model.output_shape[-1])
+  dtype = np.dtype([('index', 'int32', (k,)), ('prob', 'float32', (k,))])
+  result = np.lib.format.open_memmap(f'{filename}.npy', mode='w+', dtype=dtype, shape=(num,))
+  batches = [(i, min(i + batch_size, num)) for i in range(0, num, batch_size)]
+
+  pool = ThreadPool(workers) if is_file else None
+  def _load(start, stop):
+    if is_file:
+      return pool.map_async(decode, source[start:stop])
+    return source[start:stop]
+  def _get(item):
+    return np.asarray(item.get() if is_file else item, dtype='float32')
+
+  start_time = time.perf_counter()
+  try:
+    with open(f'{filename}.csv', 'w', newline='') as f:
+      writer = csv.writer(f)
+      writer.writerow(['name'] + [f'top{j + 1}' for j in range(k)] + [f'prob{j + 1}' for j in range(k)])
+      pending = _load(*batches[0]) if batches else None
+      for inx, (start, stop) in enumerate(batches):
+        x = _get(pending)
+        # decode the next batch while predicting this one
+        if inx + 1 < len(batches):
+          pending = _load(*batches[inx + 1])
+        index, prob = _topk(model.predict(x, batch_size=batch_size, verbose=0), k)
+        result['index'][start:stop] = index
+        result['prob'][start:stop] = prob
+        for j in range(stop - start):
+          name = source[start + j] if is_file else start + j
+          writer.writerow([name, *index[j], *[f'{p:.6f}' for p in prob[j]]])
+        f.flush()
+  finally:
+    if pool is not None:
+      pool.close()
+    result.flush()
+    del result
+  cost = time.perf_counter() - start_time
+  speed = num / cost if cost else 0.
+  Log(f'[predict] {num} images, {cost:.2f}s, {speed:.1f} images/sec')
+  return speed
+
+
+# test part
+if __name__ == "__main__":
+  from tensorflow.python.keras.layers import Dense, Flatten
+  from tensorflow.python.keras.models import Sequential
+  mod = Sequential([Flatten(input_shape=(8, 8, 3)), Dense(10, activation='softmax')])
+  predict_topk(mod, np.random.rand(1000, 8, 8, 3), 'predict_test', k=3, batch_size=128)
+  print(np.load('predict_test.npy', mmap_mode='r')[:2])
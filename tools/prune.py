@@ -0,0 +1,321 @@
+"""
+  Prune
+
+  Structured channel pruning: remove the low L1-norm output channels of
+  the Conv2D layers and rebuild a thinner model.
+
+  The channels are traced through the graph, so the removal stays
+  consistent:
+    * the channel-wise layers (BN, activations, DepthwiseConv2D, pooling...)
+      keep the channels of their input, their weights are sliced;
+    * the element-wise merges (Add of resnet) tie the channels of all the
+      inputs into one group (union-find), the group is pruned as a whole;
+    * Concatenate (densenet) lays the groups of its inputs side by side;
+    * GroupConv, GroupConv2D, DepthwiseConv2D with depth_multiplier != 1,
+      Flatten, Reshape, Lambda, Shuffle and the unknown layers freeze their
+      input (and output) channels, as well as the model inputs and outputs.
+
+  NOTE: The group convolutions are not pruned (a group needs the same count
+  of channels kept per group), so resnext/sext only lose the channels of
+  their plain Conv2D layers outside the frozen groups.
+
+  The unstructured magnitude pruning is the callback
+  `hat.models.callbacks.MagnitudePrune`.
+"""
+
+# pylint: disable=no-name-in-module
+
+import os
+import tempfile
+
+import numpy as np
+from tensorflow.python.keras import backend as K
+from tensorflow.python.keras.models import load_model
+from tensorflow.python.keras.optimizers import SGD
+
+from hat.models.callbacks import MagnitudePrune
+from hat.models.network import NetWork
+from hat.tools.bench import ms_per_batch, top1, val_sample
+from hat.tools.graph import functional, inbound_names, rebuild
+
+
+# import setting
+__all__ = [
+  'CHANNEL_WISE',
+  'ELEMENT_WISE',
+  'channel_groups',
+  'prune_channels',
+  'prune_report',
+]
+
+
+# keep the channels of the input
+CHANNEL_WISE = [
+  'BatchNormalization', 'Activation', 'ReLU', 'LeakyReLU', 'ELU', 'Softmax', 'Swish',
+  'DepthwiseConv2D', 'MaxPooling2D', 'AveragePooling2D', 'GlobalAveragePooling2D',
+  'GlobalMaxPooling2D', 'ZeroPadding2D', 'Cropping2D', 'UpSampling2D', 'Dropout',
+  'SpatialDropout2D', 'GaussianNoise', 'GaussianDropout', 'AlphaDropout', 'DropConnect',
+]
+# tie the channels of the inputs
+ELEMENT_WISE = ['Add', 'Subtract', 'Multiply', 'Average', 'Maximum', 'Minimum']
+
+
+class _UnionFind(object):
+
+  def __init__(self):
+    self.parent = {}
+    self.frozen = set()
+
+  def find(self, x):
+    self.parent.setdefault(x, x)
+    while self.parent[x] != x:
+      self.parent[x] = self.parent[self.parent[x]]
+      x = self.parent[x]
+    return x
+
+  def union(self, x, y):
+    x, y = self.find(x), self.find(y)
+    if x != y:
+      self.parent[y] = x
+      if y in self.frozen:
+        self.frozen.add(x)
+
+  def freeze(self, x):
+    self.frozen.add(self.find(x))
+
+  def is_frozen(self, x):
+    return self.find(x) in self.frozen
+
+
+def _channels_last(layer_config):
+  return layer_config['config'].get('data_format') != 'channels_first'
+
+
+def channel_groups(model):
+  """
+    Trace the channels of a functional model.
+
+    Return:
+      (segments, groups)
+      segments: {layer name: [[group, size], ...]}, the channels of the
+        output of each layer, as the segments of the channel groups.
+      groups: {group: [Conv2D names]}, the prunable groups.
+  """
+  config = model.get_config()
+  uf = _UnionFind()
+  segments = {}
+  producers = {}
+
+  def _freeze(segs):
+    for group, _ in segs:
+      uf.freeze(group)
+
+  for layer in config['layers']:
+    name, kind = layer['name'], layer['class_name']
+    sources = inbound_names(layer)
+    inputs = [segments[n] for n in sources]
+    shape = model.get_layer(name).output_shape
+    channels = shape[-1] if isinstance(shape, tuple) else None
+
+    if len(layer['inbound_nodes']) > 1:
+      # shared layer
+      for segs in inputs:
+        _freeze(segs)
+      segments[name] = [[name, channels]]
+      uf.freeze(name)
+    elif kind == 'Conv2D' and _channels_last(layer):
+      segments[name] = [[name, channels]]
+      producers[name] = [name]
+    elif (kind in CHANNEL_WISE and len(inputs) == 1 and _channels_last(layer)
+          and layer['config'].get('depth_multiplier', 1) == 1):
+      segments[name] = inputs[0]
+    elif kind in ELEMENT_WISE:
+      first = inputs[0]
+      if all([s for _, s in segs] == [s for _, s in first] for segs in inputs):
+        for segs in inputs[1:]:
+          for (a, _), (b, _) in zip(first, segs):
+            uf.union(a, b)
+      else:
+        for segs in inputs:
+          _freeze(segs)
+      segments[name] = first
+    elif kind == 'Concatenate' and layer['config']['axis'] in [-1, len(shape) - 1]:
+      segments[name] = [seg for segs in inputs for seg in segs]
+    elif kind == 'Dense' and len(shape) == 2:
+      # the input channels can be sliced, the units are kept
+      segments[name] = [[name, channels]]
+      uf.freeze(name)
+    else:
+      # InputLayer, GroupConv, GroupConv2D, DepthwiseConv2D (depth_multiplier
+      # != 1), Flatten, Reshape, Lambda, Shuffle, SqueezeExcitation, nested Models...
+      for segs in inputs:
+        _freeze(segs)
+      segments[name] = [[name, channels]]
+      uf.freeze(name)
+
+  for output in config['output_layers']:
+    _freeze(segments[output[0]])
+
+  groups = {}
+  for name in producers:
+    if not uf.is_frozen(name):
+      groups.setdefault(uf.find(name), []).append(name)
+  # the segments refer to the groups
+  segments = {name: [[uf.find(g), s] for g, s in segs] for name, segs in segments.items()}
+  return segments, groups
+
+
+def _index(segs, keep):
+  """The kept channel indexes of a tensor of the segments"""
+  index, start = [], 0
+  for group, size in segs:
+    index.append(start + (keep[group] if group in keep else np.arange(size)))
+    start += size
+  return np.concatenate(index)
+
+
+def prune_channels(model, ratio):
+  """
+    Remove `ratio` of the channels of each prunable group, by the L1 norm
+    of the filters (summed over the Conv2D layers of the group).
+
+    Return:
+      (new model, {group: kept channels})
+  """
+  model = functional(model)
+  segments, groups = channel_groups(model)
+  keep = {}
+  for group, names in groups.items():
+    score = sum(np.abs(w).sum(axis=(0, 1, 2)) / (np.abs(w).sum() + 1e-12)
+                for w in [model.get_layer(n).get_weights()[0] for n in names])
+    num = max(int(round(len(score) * (1 - ratio))), 1)
+    keep[group] = np.sort(np.argsort(-score)[:num])
+  if not keep:
+    return model, {}
+
+  config = model.get_config()
+  weights = {}
+  for layer in config['layers']:
+    name, kind = layer['name'], layer['class_name']
+    old = model.get_layer(name).get_weights()
+    if not old:
+      continue
+    sources = inbound_names(layer)
+    in_index = _index(segments[sources[0]], keep) if len(sources) == 1 else None
+    if kind == 'Conv2D':
+      out_index = _index(segments[name], keep)
+      layer['config']['filters'] = len(out_index)
+      kernel = old[0][:, :, in_index][..., out_index]
+      weights[name] = [kernel] + [b[out_index] for b in old[1:]]
+    elif kind == 'DepthwiseConv2D':
+      multiplier = old[0].shape[-1]
+      out_index = (in_index[:, None] * multiplier + np.arange(multiplier)).ravel()
+      weights[name] = [old[0][:, :, in_index]] + [b[out_index] for b in old[1:]]
+    elif kind == 'BatchNormalization':
+      weights[name] = [w[in_index] for w in old]
+    elif kind == 'Dense' and in_index is not None and len(in_index) != old[0].shape[0]:
+      weights[name] = [old[0][in_index]] + old[1:]
+  return rebuild(model, config, weights), {g: len(k) for g, k in keep.items()}
+
+
+def _unprunable(model):
+  """The names of the layers frozen by kind: the group convs and the depth multipliers"""
+  return [layer.name for layer in model.layers
+          if type(layer).__name__ in ['GroupConv', 'GroupConv2D']
+          or getattr(layer, 'depth_multiplier', 1) != 1]
+
+
+def _flops(model):
+  """FLOPs via NetWork.flops, in a fresh graph"""
+  with tempfile.TemporaryDirectory() as tmp:
+    filename = os.path.join(tmp, 'flops.h5')
+    model.save(filename, include_optimizer=False)
+    K.clear_session()
+    net = NetWork()
+    net.build(filename)
+    flops = net.flops()
+    result = net.model
+  return flops, result
+
+
+def _finetune(model, dataset, epochs, lr, batch_size, callbacks=None):
+  model.compile(optimizer=SGD(lr=lr, momentum=0.9), loss='sparse_categorical_crossentropy',
+                metrics=['accuracy'])
+  if dataset.train_x is not None:
+    model.fit(dataset.train_x, dataset.train_y, batch_size=batch_size, epochs=epochs,
+              callbacks=callbacks)
+  else:
+    dataset.get_generator(batch_size)
+    model.fit_generator(dataset.trian_generator, epochs=epochs, callbacks=callbacks)
+
+
+def prune_report(filepath, dataset, ratios=(0.25, 0.5, 0.75), mode='structured',
+                 finetune_epochs=0, lr=1e-3, batch_size=32, num_val=1000, save_prefix='', Log=print):
+  """
+    Prune a h5 at several sparsity levels, optionally fine-tune, report
+    FLOPs (`NetWork.flops`), params, latency and top-1 on a val sample.
+
+    Argument:
+      mode: Str. 'structured' (remove channels, `ratio` of each group) or
+        'magnitude' (zero `ratio` of each kernel while fine-tuning).
+      save_prefix: Str. If something, write `{save_prefix}_{ratio}.h5`.
+
+    NOTE: GroupConv/GroupConv2D and DepthwiseConv2D with depth_multiplier
+    != 1 are not pruned (with the channels around them), the report says so.
+
+    Return:
+      List of Str, the report table.
+  """
+  val_x, val_y = val_sample(dataset, num_val)
+  x = val_x[:batch_size]
+  table = [
+    f'| {mode} | FLOPs | params | ms/batch ({batch_size}) | top-1 ({len(val_x)} val) |',
+    '| --- | --- | --- | --- | --- |',
+  ]
+  for ratio in (0,) + tuple(ratios):
+    K.clear_session()
+    model = load_model(filepath, compile=False)
+    if not ratio:
+      frozen = _unprunable(model)
+    if ratio and mode == 'structured':
+      model, kept = prune_channels(model, ratio)
+      Log(f'[prune] ratio {ratio}: {len(kept)} channel groups pruned')
+      if finetune_epochs:
+        _finetune(model, dataset, finetune_epochs, lr, batch_size)
+    elif ratio and mode == 'magnitude':
+      # NOTE: zeros give no speedup on the dense kernels
+      prune = MagnitudePrune(ratio)
+      _finetune(model, dataset, max(finetune_epochs, 1), lr, batch_size, [prune])
+      Log(f'[prune] ratio {ratio}: mean sparsity {np.mean(list(prune.sparsity_of().values())):.3f}')
+    if ratio and save_prefix:
+      model.save(f'{save_prefix}_{ratio}.h5', include_optimizer=False)
+    flops, model = _flops(model)
+    acc = top1(model.predict(val_x, batch_size=64), val_y)
+    ms = ms_per_batch(model.predict_on_batch, x)
+    table.append(f'| {ratio} | {flops:,} | {model.count_params():,} | {ms:.2f} '
+                 f'| {acc:.4f} |')
+    Log(table[-1])
+  if mode == 'structured' and frozen:
+    table.append(f'NOTE: {len(frozen)} group conv / depth multiplier layers are not pruned, '
+                 f'e.g. {", ".join(frozen[:3])}')
+    Log(table[-1])
+  K.clear_session()
+  return table
+
+
+# test part
+if __name__ == "__main__":
+  import argparse
+  from hat import datasets
+  parser = argparse.ArgumentParser(description='Prune a trained h5')
+  parser.add_argument('h5')
+  parser.add_argument('dataset')
+  parser.add_argument('--mode', default='structured', choices=['structured', 'magnitude'])
+  parser.add_argument('--ratios', default='0.25,0.5,0.75')
+  parser.add_argument('--finetune', type=int, default=0, help='fine-tuning epochs')
+  parser.add_argument('--save', default='', help='save prefix of the pruned h5')
+  args = parser.parse_args()
+  print('\n'.join(prune_report(args.h5, getattr(datasets, args.dataset)(),
+                               ratios=[float(r) for r in args.ratios.split(',')],
+                               mode=args.mode, finetune_epochs=args.finetune,
+                               save_prefix=args.save)))
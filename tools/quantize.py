@@ -0,0 +1,168 @@
+"""
+  Quantize
+
+  Post-training quantization of a trained h5 to TFLite: float, dynamic
+  range (int8 weights) and full int8 (weights & activations, calibrated on
+  a sample of the val split), with a size/latency/top-1 report.
+
+  The model is first optimised for inference (`optimize_for_inference`):
+  Dropout/DropConnect are stripped (their train-phase `cond` can not be
+  converted) and BN is folded. The custom layers are plain builtin ops
+  after that, e.g. GroupConv (depthwise conv + sum), SqueezeExcitation
+  (pool, dense, mul), Swish (x * sigmoid), Shuffle (pack + reshape).
+"""
+
+# pylint: disable=no-name-in-module
+# pylint: disable=no-member
+
+import os
+import tempfile
+
+import numpy as np
+import tensorflow as tf
+from tensorflow.python.keras import backend as K
+from tensorflow.python.keras.models import load_model
+
+from hat.tools.bench import ms_per_image, split_val, top1
+from hat.tools.fold import optimize_for_inference
+
+
+# import setting
+__all__ = [
+  'QUANT_MODES',
+  'to_tflite',
+  'TFLiteModel',
+  'quantize_report',
+]
+
+
+QUANT_MODES = ['float', 'dynamic', 'int8']
+
+
+def to_tflite(filepath, mode='dynamic', calib=None, calib_batch=1):
+  """
+    Convert a h5 (inference optimised first) to TFLite.
+
+    Argument:
+      mode: Str. 'float', 'dynamic' (int8 weights) or 'int8' (full int8
+        ops with float input/output).
+      calib: Array. Calibration inputs of 'int8'.
+
+    Return:
+      Bytes, the flatbuffer.
+  """
+  if mode not in QUANT_MODES:
+    raise ValueError(f'mode must be in {QUANT_MODES}, got {mode}')
+  K.clear_session()
+  K.set_learning_phase(0)
+  model, _ = optimize_for_inference(load_model(filepath, compile=False))
+  with tempfile.TemporaryDirectory() as tmp:
+    tmp_name = os.path.join(tmp, 'inference.h5')
+    model.save(tmp_name, include_optimizer=False)
+    converter = tf.lite.TFLiteConverter.from_keras_model_file(tmp_name)
+    if mode in ['dynamic', 'int8']:
+      if hasattr(tf.lite, 'Optimize'):
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+      else:
+        # tf 1.13
+        converter.post_training_quantize = True
+    if mode == 'int8':
+      if calib is None:
+        raise ValueError('`calib` is needed to quantize the activations.')
+      if not hasattr(converter, 'representative_dataset'):
+        raise ValueError('Full int8 needs tensorflow>=1.14.')
+      def _representative():
+        for i in range(0, len(calib), calib_batch):
+          yield [np.asarray(calib[i:i + calib_batch], dtype='float32')]
+      converter.representative_dataset = _representative
+      converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+    result = converter.convert()
+  K.clear_session()
+  return result
+
+
+class TFLiteModel(object):
+  """
+    Run a TFLite flatbuffer, `predict` like a keras Model (batch 1 inside).
+  """
+
+  def __init__(self, content):
+    self.interpreter = tf.lite.Interpreter(model_content=content)
+    self.interpreter.allocate_tensors()
+    self._input = self.interpreter.get_input_details()[0]
+    self._output = self.interpreter.get_output_details()[0]
+
+  def _quant(self, x, detail):
+    scale, zero = detail['quantization']
+    if detail['dtype'] in [np.uint8, np.int8] and scale:
+      return np.round(x / scale + zero).astype(detail['dtype'])
+    return x.astype(detail['dtype'])
+
+  def _dequant(self, y, detail):
+    scale, zero = detail['quantization']
+    if detail['dtype'] in [np.uint8, np.int8] and scale:
+      return (y.astype('float32') - zero) * scale
+    return y
+
+  def predict(self, x):
+    outputs = []
+    for item in x:
+      self.interpreter.set_tensor(self._input['index'], self._quant(item[None], self._input))
+      self.interpreter.invoke()
+      outputs.append(self._dequant(self.interpreter.get_tensor(self._output['index']), self._output)[0])
+    return np.array(outputs)
+
+
+def quantize_report(filepath, dataset, out_prefix=None, num_val=1000, num_calib=200, Log=print):
+  """
+    Convert a h5 to float/dynamic/int8 TFLite, report the size, the
+    latency (ms/image) and the top-1 (delta vs the keras float model) on a
+    sample of the val split. The int8 calibration uses other val samples,
+    a small val split is shared by `split_val`.
+
+    Argument:
+      dataset: A hat Dataset.
+      out_prefix: Str. Write `{out_prefix}_{mode}.tflite`, default next to the h5.
+
+    Return:
+      List of Str, the report table.
+  """
+  out_prefix = out_prefix or os.path.splitext(filepath)[0]
+  # NOTE: calibrate on other val samples than the report ones
+  (val_x, val_y), (calib, _) = split_val(dataset, num_val, num_calib)
+  if not len(calib):
+    raise ValueError(f'The val split has no samples left for the int8 calibration, reduce num_val ({num_val})')
+
+  K.clear_session()
+  K.set_learning_phase(0)
+  model = load_model(filepath, compile=False)
+  base = top1(model.predict(val_x, batch_size=64), val_y)
+  base_ms = ms_per_image(lambda x: model.predict_on_batch(x), val_x)
+  table = [
+    f'| model | size MiB | ms/image | top-1 ({len(val_x)} val) | delta |',
+    '| --- | --- | --- | --- | --- |',
+    f'| keras h5 | {os.path.getsize(filepath) / 2 ** 20:.2f} | {base_ms:.2f} | {base:.4f} | - |',
+  ]
+  Log(table[-1])
+
+  for mode in QUANT_MODES:
+    content = to_tflite(filepath, mode, calib=calib)
+    filename = f'{out_prefix}_{mode}.tflite'
+    with open(filename, 'wb') as f:
+      f.write(content)
+    lite = TFLiteModel(content)
+    acc = top1(lite.predict(val_x), val_y)
+    table.append(f'| tflite {mode} | {len(content) / 2 ** 20:.2f} | {ms_per_image(lite.predict, val_x):.2f} '
+                 f'| {acc:.4f} | {acc - base:+.4f} |')
+    Log(table[-1])
+  # NOTE: the learning phase is reset too
+  K.clear_session()
+  return table
+
+
+# test part
+if __name__ == "__main__":
+  import sys
+  from hat import datasets
+  # python quantize.py save_3.h5 car10
+  print('\n'.join(quantize_report(sys.argv[1], getattr(datasets, sys.argv[2])())))
@@ -0,0 +1,369 @@
+"""
+  Inference server
+
+  Serve a trained h5 (`save_N.h5`) over local HTTP or a Unix socket. The
+  concurrent requests are coalesced into micro-batches (max batch size,
+  max wait time), each micro-batch is one predict call.
+
+  Request:
+    POST /predict?k=5  body: a `.npy` of one input `INPUT_SHAPE` or a batch
+      `(n, *INPUT_SHAPE)`, or an image file if served with `--dataset`
+      (decoded by `dataset_decoder`, the same as the training arrays)
+    GET /health
+
+  Response:
+    {"index": [[...k], ...], "prob": [[...k], ...]}
+
+  Usage:
+    python -m hat.tools.server logs/S/resnet50_car10/save_3.h5 --port 8500
+    python -m hat.tools.server save_3.h5 --unix /tmp/hat.sock
+    python -m hat.tools.server save_3.h5 --dataset car10
+    python -m hat.tools.server save_3.h5 --bench
+"""
+
+# pylint: disable=no-name-in-module
+# pylint: disable=invalid-name
+
+import argparse
+import http.client
+import io
+import json
+import os
+import queue
+import socket
+import socketserver
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+import tensorflow as tf
+from tensorflow.python.keras import backend as K
+
+from hat.models.network import NetWork
+from hat.tools.predict import dataset_decoder
+from hat.utils.config import Config
+
+
+# import setting
+__all__ = [
+  'load_network',
+  'config_exrgb',
+  'Batcher',
+  'serve',
+  'benchmark_server',
+]
+
+
+def load_network(filepath):
+  """
+    Load a `save_N.h5` into a NetWork via `NetWork.build(filepath)`.
+  """
+  model = NetWork()
+  model.build(filepath)
+  model.INPUT_SHAPE = tuple(model.model.input_shape[1:])
+  model.NUM_CLASSES = model.model.output_shape[-1]
+  return model
+
+
+def config_exrgb(filepath):
+  """
+    The `exrgb=` of the run which saved the h5, from the config.ini next to it.
+  """
+  filename = os.path.join(os.path.dirname(os.path.abspath(filepath)), 'config')
+  if not os.path.exists(f'{filename}.ini'):
+    return 0
+  return int(Config(filename).get('param', 'exrgb_k') or 0)
+
+
+class _Request(object):
+  """A pending request, `wait` returns the outputs"""
+
+  def __init__(self, x):
+    self.x = x
+    self.y = None
+    self.error = None
+    self._event = threading.Event()
+
+  def done(self, y=None, error=None):
+    self.y, self.error = y, error
+    self._event.set()
+
+  def wait(self):
+    self._event.wait()
+    if self.error is not None:
+      raise self.error
+    return self.y
+
+
+class Batcher(object):
+  """
+    Dynamic batching
+
+    One thread takes the queued requests, waits at most `max_wait` seconds
+    after the first one for more, up to `max_batch` samples, and runs them
+    through one predict call.
+
+    Argument:
+      model: A NetWork or keras Model.
+      max_batch: Int. Max samples of a micro-batch.
+      max_wait: Float. Seconds to wait for a micro-batch to fill.
+  """
+
+  def __init__(self, model, max_batch=32, max_wait=0.005):
+    self.model = model
+    self.max_batch = max_batch
+    self.max_wait = max_wait
+    self.batches = 0
+    self.samples = 0
+    self._queue = queue.Queue()
+    # NOTE: tf1 keras predicts in another thread with the graph & session
+    # of this one, and the predict function built beforehand
+    self._graph = tf.get_default_graph()
+    self._session = K.get_session()
+    self._input_shape = tuple(getattr(model, 'INPUT_SHAPE', None) or model.input_shape[1:])
+    self._predict(np.zeros((1, *self._input_shape), dtype='float32'))
+    self._thread = threading.Thread(target=self._loop, daemon=True)
+    self._thread.start()
+
+  def _predict(self, x):
+    with self._graph.as_default(), self._session.as_default():
+      return self.model.predict(x, batch_size=len(x), verbose=0)
+
+  def _loop(self):
+    while True:
+      requests = [self._queue.get()]
+      size = len(requests[0].x)
+      deadline = time.perf_counter() + self.max_wait
+      while size < self.max_batch:
+        timeout = deadline - time.perf_counter()
+        if timeout <= 0:
+          break
+        try:
+          request = self._queue.get(timeout=timeout)
+        except queue.Empty:
+          break
+        requests.append(request)
+        size += len(request.x)
+      try:
+        y = self._predict(np.concatenate([r.x for r in requests]))
+      except Exception as e:  # pylint: disable=broad-except
+        for r in requests:
+          r.done(error=e)
+        continue
+      self.batches += 1
+      self.samples += size
+      start = 0
+      for r in requests:
+        r.done(y[start:start + len(r.x)])
+        start += len(r.x)
+
+  def predict(self, x):
+    """
+      Blocking, x is one input or a batch, return the outputs of the batch.
+    """
+    x = np.asarray(x, dtype='float32')
+    if x.shape == self._input_shape:
+      x = x[None]
+    if x.shape[1:] != self._input_shape:
+      # NOTE: check before queueing, a bad shape would fail the whole micro-batch
+      raise ValueError(f'Input shape must be {self._input_shape} or (n, *{self._input_shape}), '
+                       f'got {x.shape}')
+    request = _Request(x)
+    self._queue.put(request)
+    return request.wait()
+
+
+def _decode(body, content_type, decode=None):
+  if content_type in ['application/x-npy', 'application/octet-stream']:
+    return np.load(io.BytesIO(body), allow_pickle=False)
+  if decode is None:
+    raise ValueError('Images need the dataset decoder (serve with `dataset`), or post a .npy')
+  return decode(io.BytesIO(body))
+
+
+def _handler(batcher, decode=None):
+
+  class _Handler(BaseHTTPRequestHandler):
+
+    def _send(self, code, data):
+      body = json.dumps(data).encode('utf8')
+      self.send_response(code)
+      self.send_header('Content-Type', 'application/json')
+      self.send_header('Content-Length', str(len(body)))
+      self.end_headers()
+      self.wfile.write(body)
+
+    def do_GET(self):
+      if urlparse(self.path).path == '/health':
+        self._send(200, {'batches': batcher.batches, 'samples': batcher.samples})
+      else:
+        self._send(404, {'error': 'not found'})
+
+    def do_POST(self):
+      url = urlparse(self.path)
+      if url.path != '/predict':
+        self._send(404, {'error': 'not found'})
+        return
+      try:
+        k = int(parse_qs(url.query).get('k', ['5'])[0])
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        x = _decode(body, self.headers.get('Content-Type', ''), decode)
+        y = batcher.predict(x)
+      except Exception as e:  # pylint: disable=broad-except
+        self._send(400, {'error': f'{type(e).__name__}: {e}'})
+        return
+      index = np.argsort(-y, axis=-1)[:, :k]
+      self._send(200, {
+        'index': index.tolist(),
+        'prob': np.take_along_axis(y, index, axis=-1).tolist()})
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+      pass
+
+  return _Handler
+
+
+class _ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+  daemon_threads = True
+
+
+class _ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+  daemon_threads = True
+
+
+def serve(model, host='127.0.0.1', port=8500, unix='', max_batch=32, max_wait=0.005, block=True,
+          dataset=None, exrgb_k=None):
+  """
+    Start the server.
+
+    Argument:
+      model: A NetWork, keras Model, or Str (h5 filepath).
+      unix: Str. Unix socket path, use it instead of host/port.
+      block: Boolean. If False, serve in a thread and return the server.
+      dataset: A Dataset or Str (the name in hat.datasets). If something,
+        the image requests are decoded by its `dataset_decoder`, else only
+        `.npy` is accepted.
+      exrgb_k: Int. The `exrgb=` the model was trained with, default from
+        the config.ini next to the h5.
+  """
+  if exrgb_k is None:
+    exrgb_k = config_exrgb(model) if isinstance(model, str) else 0
+  if isinstance(model, str):
+    model = load_network(model)
+  if isinstance(dataset, str):
+    from hat import datasets
+    dataset = getattr(datasets, dataset)()
+  decode = dataset_decoder(dataset, exrgb_k) if dataset is not None else None
+  batcher = Batcher(model, max_batch=max_batch, max_wait=max_wait)
+  if unix:
+    if os.path.exists(unix):
+      os.remove(unix)
+    server = _ThreadingUnixHTTPServer(unix, _handler(batcher, decode))
+  else:
+    server = _ThreadingHTTPServer((host, port), _handler(batcher, decode))
+  server.batcher = batcher
+  if block:
+    print(f'[server] serving on {unix or f"http://{host}:{server.server_address[1]}"}')
+    server.serve_forever()
+  else:
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+  return server
+
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+
+  def __init__(self, path):
+    super(_UnixHTTPConnection, self).__init__('localhost')
+    self._path = path
+
+  def connect(self):
+    self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    self.sock.connect(self._path)
+
+
+def _client(target):
+  if isinstance(target, str):
+    return _UnixHTTPConnection(target)
+  return http.client.HTTPConnection(*target)
+
+
+def _load(target, body, concurrency, requests):
+  latency = []
+  lock = threading.Lock()
+
+  def _worker():
+    conn = _client(target)
+    for _ in range(requests):
+      start_time = time.perf_counter()
+      conn.request('POST', '/predict?k=1', body, {'Content-Type': 'application/x-npy'})
+      conn.getresponse().read()
+      with lock:
+        latency.append(time.perf_counter() - start_time)
+    conn.close()
+
+  threads = [threading.Thread(target=_worker) for _ in range(concurrency)]
+  start_time = time.perf_counter()
+  for t in threads:
+    t.start()
+  for t in threads:
+    t.join()
+  cost = time.perf_counter() - start_time
+  latency = np.array(latency) * 1000
+  return np.percentile(latency, 50), np.percentile(latency, 99), len(latency) / cost
+
+
+def benchmark_server(model, concurrency=(1, 4, 16, 64), requests=50, max_batch=32, max_wait=0.005,
+                     unix='', Log=print):
+  """
+    Load generator, p50/p99 latency (ms) and throughput (req/sec) of one
+    image requests at several concurrency levels, with batching off
+    (max batch 1) and on.
+
+    Return:
+      List of Str, the benchmark table.
+  """
+  if isinstance(model, str):
+    model = load_network(model)
+  input_shape = tuple(getattr(model, 'INPUT_SHAPE', None) or model.input_shape[1:])
+  buffer = io.BytesIO()
+  np.save(buffer, np.random.rand(*input_shape).astype('float32'))
+  body = buffer.getvalue()
+  table = [
+    '| max batch | concurrency | p50 ms | p99 ms | req/sec | mean batch |',
+    '| --- | --- | --- | --- | --- | --- |',
+  ]
+  for _max_batch in [1, max_batch]:
+    server = serve(model, port=0, unix=unix, max_batch=_max_batch, max_wait=max_wait, block=False)
+    target = unix or server.server_address
+    _load(target, body, 1, 5)
+    for c in concurrency:
+      batches, samples = server.batcher.batches, server.batcher.samples
+      p50, p99, qps = _load(target, body, c, requests)
+      mean = (server.batcher.samples - samples) / max(server.batcher.batches - batches, 1)
+      table.append(f'| {_max_batch} | {c} | {p50:.2f} | {p99:.2f} | {qps:.1f} | {mean:.1f} |')
+      Log(table[-1])
+    server.shutdown()
+    server.server_close()
+  return table
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description='HAT inference server')
+  parser.add_argument('h5', help='the save_N.h5 to serve')
+  parser.add_argument('--host', default='127.0.0.1')
+  parser.add_argument('--port', type=int, default=8500)
+  parser.add_argument('--unix', default='', help='serve on a Unix socket instead')
+  parser.add_argument('--max-batch', type=int, default=32)
+  parser.add_argument('--max-wait-ms', type=float, default=5.)
+  parser.add_argument('--dataset', default='', help='decode the image requests like this dataset')
+  parser.add_argument('--exrgb', type=int, default=None, help='the exrgb= of the training, default from the config')
+  parser.add_argument('--bench', action='store_true', help='run the load generator benchmark')
+  args = parser.parse_args()
+  if args.bench:
+    print('\n'.join(benchmark_server(args.h5, max_batch=args.max_batch,
+                                     max_wait=args.max_wait_ms / 1000, unix=args.unix)))
+  else:
+    serve(args.h5, args.host, args.port, args.unix, args.max_batch, args.max_wait_ms / 1000,
+          dataset=args.dataset or None, exrgb_k=args.exrgb)
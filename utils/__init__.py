@@ -2,3 +2,5 @@ from hat.utils.Log import Log
 from hat.utils.timer import Timer
 from hat.utils.counter import Counter
 from hat.utils.config import Config
+from hat.utils.memory import rss, peak_rss
+from hat.utils.profiler import Profiler
@@ -11,7 +11,8 @@ class Config(object):
     self.file = f'{filename}{ext}'
     self._create()
     self.config.read(self.file)
-    self._log_num = len(self.config.sections())
+    # NOTE: count the log sections only, there may be other sections (e.g. session)
+    self._log_num = len([i for i in self.config.sections() if i.startswith('log_')]) + 1
 
   # private method
 
@@ -61,10 +62,15 @@ class Config(object):
     return self.config.get(section, name)
 
   def get_dict(self, section):
-    if self.config.has_section(section):
+    if not self.config.has_section(section):
       return {}
-    return
-    # to do
+    return dict(self.config.items(section))
+
+  def set_dict(self, section, dicts):
+    self._check_section(section)
+    for item in dicts:
+      self.config.set(section, item, str(dicts[item]))
+    self._upgrade()
 
   def if_param(self):
     return self.config.options('param') and True or False
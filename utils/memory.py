@@ -0,0 +1,70 @@
+"""
+  内存统计
+
+  rss:      当前进程常驻内存(MiB)
+  peak_rss: 当前进程常驻内存峰值(MiB)
+"""
+
+import os
+import sys
+
+try:
+  import resource
+except ImportError:
+  # NOTE: `resource` is not available on Windows
+  resource = None
+
+
+__all__ = [
+  'rss',
+  'peak_rss',
+]
+
+
+def rss():
+  """
+    Get the Resident Set Size of the current process.
+
+    Return:
+      A `float`, MiB. 0 if it can not be measured.
+  """
+  try:
+    with open('/proc/self/statm', 'r') as f:
+      pages = int(f.read().split()[1])
+    return pages * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+  except (OSError, ValueError, AttributeError):
+    pass
+  try:
+    import psutil
+    return psutil.Process().memory_info().rss / 2 ** 20
+  except ImportError:
+    return 0.
+
+
+def peak_rss():
+  """
+    Get the peak Resident Set Size of the current process.
+
+    NOTE: The peak never decreases during the lifetime of the process.
+
+    Return:
+      A `float`, MiB. Fall back to `rss()` if it can not be measured.
+  """
+  if resource is not None:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is Byte on macOS, KiB on Linux
+    if sys.platform == 'darwin':
+      return peak / 2 ** 20
+    return peak / 2 ** 10
+  try:
+    import psutil
+    info = psutil.Process().memory_info()
+    return getattr(info, 'peak_wset', info.rss) / 2 ** 20
+  except ImportError:
+    return rss()
+
+
+if __name__ == "__main__":
+  print(rss(), peak_rss())
+  a = [0.] * 2 ** 24
+  print(rss(), peak_rss())
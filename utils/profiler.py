@@ -0,0 +1,190 @@
+"""
+  高精度的嵌套计时器
+
+  Spans are measured by `time.perf_counter_ns`, can be nested, aggregated
+  into a tree and exported as Chrome trace-event JSON (chrome://tracing).
+"""
+
+import contextlib
+import json
+import os
+import threading
+import time
+
+
+__all__ = [
+  'Profiler',
+]
+
+
+def _now_ns():
+  """perf_counter_ns(python>=3.7) or the float fallback"""
+  if hasattr(time, 'perf_counter_ns'):
+    return time.perf_counter_ns()
+  return int(time.perf_counter() * 1e9)
+
+
+class _Span(contextlib.ContextDecorator):
+  """
+    A span, used as a context manager or a decorator.
+  """
+
+  def __init__(self, profiler, name, args):
+    self._profiler = profiler
+    self.name = name
+    self.args = args
+
+  def __enter__(self):
+    self._profiler.begin(self.name, **self.args)
+    return self
+
+  def __exit__(self, *exc):
+    self._profiler.end()
+    return False
+
+
+class Profiler(object):
+  """
+    Nested Span Profiler
+
+    Usage:
+    ```python
+      profiler = Profiler()
+
+      with profiler.span('epoch', epoch=1):
+        with profiler.span('train'):
+          ...
+
+      @profiler.span('save')
+      def save():
+        ...
+
+      profiler.summary()        # list of str, tree view
+      profiler.export('a.json') # Chrome trace-event JSON
+    ```
+  """
+
+  def __init__(self):
+    self.events = []
+    self._local = threading.local()
+    self._lock = threading.Lock()
+    self._origin = _now_ns()
+    self._pid = os.getpid()
+
+  # private method
+
+  @property
+  def _stack(self):
+    if not hasattr(self._local, 'stack'):
+      self._local.stack = []
+    return self._local.stack
+
+  # public method
+
+  def span(self, name, **args):
+    """
+      Return a span, which can be used as a context manager or a decorator.
+
+      Argument:
+        name: Str. The span name, spans with the same name and the same
+          parents are aggregated in the tree.
+        args: Extra infomation, shown in the trace viewer.
+    """
+    return _Span(self, name, args)
+
+  def begin(self, name, **args):
+    """
+      Begin a span, must be closed by `end()`
+    """
+    path = (self._stack[-1][1] if self._stack else ()) + (name,)
+    self._stack.append((name, path, args, _now_ns()))
+
+  def end(self):
+    """
+      End the latest span, return the cost time (ns).
+    """
+    stop = _now_ns()
+    name, path, args, start = self._stack.pop()
+    with self._lock:
+      self.events.append({
+        'name': name,
+        'path': path,
+        'args': args,
+        'start': start - self._origin,
+        'dur': stop - start,
+        'tid': threading.get_ident(),
+      })
+    return stop - start
+
+  def tree(self):
+    """
+      Aggregate the spans into a tree.
+
+      Return:
+        Dict. {name: {'count': int, 'total': ns, 'children': {...}}}
+    """
+    root = {}
+    for event in sorted(self.events, key=lambda e: len(e['path'])):
+      node = {'children': root}
+      for name in event['path']:
+        node = node['children'].setdefault(name, {'count': 0, 'total': 0, 'children': {}})
+      node['count'] += 1
+      node['total'] += event['dur']
+    return root
+
+  def summary(self, tree=None, depth=0):
+    """
+      Return a list of str, the tree view of the spans.
+    """
+    lines = []
+    tree = self.tree() if tree is None else tree
+    for name, node in sorted(tree.items(), key=lambda i: -i[1]['total']):
+      lines.append(f"{'  ' * depth}{name}: {node['total'] / 1e9:.6f} s / {node['count']} call(s)")
+      lines.extend(self.summary(node['children'], depth + 1))
+    return lines
+
+  def totals(self):
+    """
+      Return a dict, {'path/to/span': total seconds}
+    """
+    totals = {}
+    for event in self.events:
+      path = '/'.join(event['path'])
+      totals[path] = totals.get(path, 0.) + event['dur'] / 1e9
+    return totals
+
+  def export(self, filename):
+    """
+      Export the spans as Chrome trace-event JSON.
+    """
+    trace = []
+    for event in self.events:
+      trace.append({
+        'name': event['name'],
+        'cat': 'hat',
+        'ph': 'X',
+        'ts': event['start'] / 1e3,
+        'dur': event['dur'] / 1e3,
+        'pid': self._pid,
+        'tid': event['tid'],
+        'args': {k: str(v) for k, v in event['args'].items()},
+      })
+    with open(filename, 'w') as f:
+      json.dump({'traceEvents': trace, 'displayTimeUnit': 'ms'}, f)
+    return filename
+
+
+if __name__ == "__main__":
+  p = Profiler()
+
+  @p.span('inner')
+  def inner():
+    time.sleep(0.01)
+
+  with p.span('outer'):
+    for i in range(3):
+      with p.span('epoch', epoch=i + 1):
+        inner()
+  print('\n'.join(p.summary()))
+  print(p.totals())
+  print(p.export('trace.json'))
@@ -3,8 +3,9 @@ import time
 
 class Timer(object):
 
-  def __init__(self, Log, *args, **kwargs):
+  def __init__(self, Log, profiler=None, *args, **kwargs):
     self.Log = Log
+    self.profiler = profiler
     return super().__init__(*args, **kwargs)
 
   @property
@@ -17,12 +18,17 @@ class Timer(object):
   def timer(self, text, func, *args, **kwargs):
     start_time = self.time
     self.Log(start_time, _T=f'{text} Start:')
-    result = func(*args, **kwargs)
+    _start = time.perf_counter()
+    if self.profiler is not None:
+      with self.profiler.span(text):
+        result = func(*args, **kwargs)
+    else:
+      result = func(*args, **kwargs)
+    cost_time = time.perf_counter() - _start
     stop_time = self.time
     self.Log(stop_time, _T=f'{text} Stop:')
-    cost_time = self.mktime(stop_time) - self.mktime(start_time)
     self.Log(cost_time, _T=f'{text} cost time (second):')
     time_dict = {f'{text}_start_time'.upper(): start_time,
                  f'{text}_stop_time'.upper(): stop_time,
                  f'{text}_cost_time'.upper(): cost_time}
-    return time_dict, result
\ No newline at end of file
+    return time_dict, result